@@ -12,6 +12,7 @@ from satlas.models.summodel import *
 from satlas.models import *
 from satlas.utilities import utilities
 from satlas.utilities import *
+from satlas.utilities import _plotting
 from satlas.stats import fitting
 from satlas.stats.fitting import *
 try:
@@ -29,3 +30,10 @@ __all__.extend(linkedmodel.__all__)
 __all__.extend(utilities.__all__)
 __all__.extend(fitting.__all__)
 __all__.extend(summodel.__all__)
+
+def __getattr__(name):
+    # Plotting routines are loaded on first use, see satlas.utilities.
+    if name in _plotting:
+        from satlas.utilities import plotting
+        return getattr(plotting, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
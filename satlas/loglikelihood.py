@@ -27,7 +27,9 @@ def poisson_llh(y, f, x):
     -------
     array_like
         Array with loglikelihoods for the data."""
-    l = np.hstack(f(x))
+    # During a fit, the model writes its response in its workspace
+    workspace = getattr(f, 'workspace', None)
+    l = np.ravel(f(x) if workspace is None else workspace.response(f, x))
     return y * np.log(l) - l
 
 def create_gaussian_llh(yerr=1, xerr=None, func=None):
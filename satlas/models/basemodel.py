@@ -5,12 +5,11 @@ Implementation of base class for extension to models describing actual data.
 .. moduleauthor:: Ruben de Groote <ruben.degroote@kuleuven.be>
 """
 import copy
+import itertools
 
 import lmfit as lm
 from satlas.loglikelihood import create_gaussian_priormap
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from copy import deepcopy
 
 __all__ = ['load_model']
@@ -29,8 +28,10 @@ class SATLASParameters(lm.Parameters):
 
     def __deepcopy__(self, memo):
         """Parameters deepcopy needs to make sure that
-        asteval is available and that all individula
-        parameter objects are copied"""
+        asteval is available and that all individual
+        parameter objects are copied. The parameters are
+        copied attribute by attribute, without the validation
+        done when creating and adding new parameters."""
         _pars = SATLASParameters()
 
         # find the symbols that were added by users, not during construction
@@ -39,30 +40,358 @@ class SATLASParameters(lm.Parameters):
                               for key in sym_unique}
         _pars._asteval.symtable.update(unique_symbols)
 
-        # we're just about to add a lot of Parameter objects to the newly
-        parameter_list = []
+        symtable = _pars._asteval.symtable
         for key, par in self.items():
-            if isinstance(par, lm.Parameter):
-                param = lm.Parameter(name=par.name,
-                                  value=par.value,
-                                  min=par.min,
-                                  max=par.max)
-                param.vary = par.vary
-                param.stderr = par.stderr
-                param.correl = par.correl
-                param.init_value = par.init_value
-                param.expr = par.expr
-                parameter_list.append(param)
-
-        _pars.add_many(*parameter_list)
+            param = lm.Parameter.__new__(lm.Parameter)
+            param.__dict__.update(par.__dict__)
+            # The parsed expression is shared, the interpreter and the
+            # mutable attributes belong to the copy
+            param._expr_eval = _pars._asteval
+            param._expr_deps = list(par._expr_deps)
+            param.correl = deepcopy(par.correl, memo)
+            param.user_data = deepcopy(par.user_data, memo)
+            param.setup_bounds()
+            dict.__setitem__(_pars, key, param)
+            symtable[key] = param._val
+        _pars.update_constraints()
         _pars._prefix = self._prefix
         return _pars
 
+    def view(self, prefix=''):
+        """Parameters object holding the same Parameter objects, and
+        using the same interpreter for the expressions. Changes to the
+        parameters are seen in both objects. Only the parameters of
+        which the name starts with the prefix are included.
+        Can also be called with an lmfit.Parameters object.
+
+        Parameters
+        ----------
+        prefix: str, optional
+            Prefix used to look up the names without prefix.
+
+        Returns
+        -------
+        SATLASParameters"""
+        view = SATLASParameters.__new__(SATLASParameters)
+        dict.update(view, [(name, par) for name, par in self.items() if name.startswith(prefix)])
+        view._asteval = self._asteval
+        view._ast_msgs = self._ast_msgs
+        view._prefix = prefix
+        return view
+
+class ParameterMap(object):
+
+    """Precompiled map between a vector with the values of the varying
+    parameters and the values of all parameters of a model. The fixed values
+    and the expressions are resolved on creation, so evaluating the
+    map does not involve the lmfit.Parameters object.
+
+    Parameters
+    ----------
+    params: lmfit.Parameters
+        Parameters of the model. The order of the varying parameters
+        is the order in which they appear in *params*."""
+
+    def __init__(self, params):
+        super(ParameterMap, self).__init__()
+        self.names = list(params.keys())
+        self.varying = [name for name in self.names if params[name].vary]
+        self.index = np.array([self.names.index(name) for name in self.varying], dtype='int')
+        self.fixed = np.array([params[name].value for name in self.names], dtype='float')
+        self.min = np.array([-np.inf if params[name].min is None else params[name].min for name in self.varying], dtype='float')
+        self.max = np.array([np.inf if params[name].max is None else params[name].max for name in self.varying], dtype='float')
+        # The expressions are compiled and ordered so that every
+        # expression only uses values that are already known.
+        expressions = {}
+        for name in self.names:
+            if params[name].expr is not None:
+                expressions[name] = compile(params[name].expr, name, 'eval')
+        self.expressions = []
+        while expressions:
+            known = [name for name, code in expressions.items() if not any([n in expressions for n in code.co_names])]
+            if len(known) == 0:
+                raise ValueError('The expressions of the parameters form a circular dependency!')
+            for name in known:
+                par = params[name]
+                bounds = (-np.inf if par.min is None else par.min, np.inf if par.max is None else par.max)
+                self.expressions.append((name, self.names.index(name), expressions.pop(name), bounds))
+        # Functions and constants used in the expressions
+        symtable = params._asteval.symtable
+        names = set([n for _, _, code, _ in self.expressions for n in code.co_names])
+        self._symbols = {n: symtable[n] for n in names if n not in params and n in symtable}
+
+    def vector(self, params):
+        """Gather the values of the varying parameters from *params*.
+
+        Parameters
+        ----------
+        params: lmfit.Parameters
+            Parameters with the same structure as used to create the map.
+
+        Returns
+        -------
+        NumPy array"""
+        return np.array([params[name].value for name in self.varying], dtype='float')
+
+    def resolve(self, theta):
+        """Calculate the values of all parameters.
+
+        Parameters
+        ----------
+        theta: array_like
+            Values of the varying parameters. As for lmfit.Parameter,
+            values outside of the boundaries are clipped.
+
+        Returns
+        -------
+        dict
+            Dictionary with the value of each parameter."""
+        values = self.fixed.copy()
+        values[self.index] = np.clip(theta, self.min, self.max)
+        if self.expressions:
+            namespace = dict(zip(self.names, values.tolist()))
+            namespace.update(self._symbols)
+            for name, i, code, (low, high) in self.expressions:
+                value = min(max(eval(code, namespace), low), high)
+                values[i] = value
+                namespace[name] = value
+        return dict(zip(self.names, values.tolist()))
+
+    def resolve_batch(self, theta):
+        """Calculate the values of all parameters for several
+        sets of values of the varying parameters.
+
+        Parameters
+        ----------
+        theta: array_like
+            Array with a row of values of the varying parameters for each set.
+
+        Returns
+        -------
+        dict
+            Dictionary with an array of the values of each parameter."""
+        theta = np.atleast_2d(np.asarray(theta, dtype='float'))
+        values = np.repeat(self.fixed[np.newaxis, :], theta.shape[0], axis=0)
+        values[:, self.index] = np.clip(theta, self.min, self.max)
+        if self.expressions:
+            namespace = dict(zip(self.names, values.T))
+            namespace.update(self._symbols)
+            for name, i, code, (low, high) in self.expressions:
+                values[:, i] = np.clip(eval(code, namespace), low, high)
+                namespace[name] = values[:, i]
+        return dict(zip(self.names, values.T))
+
+class Workspace(object):
+
+    """Arrays which only depend on the values of *x*, kept for repeated
+    evaluations of a model in the same values, as during a fit. A model
+    uses the workspace assigned to :attr:`.BaseModel.workspace` when it
+    is called with the array *x* of the workspace itself, so the values
+    in *x* should not be changed while the workspace is in use.
+
+    Parameters
+    ----------
+    x: array_like or list of array_like
+        Values in which the model is evaluated, a list for
+        a :class:`.LinkedModel`. The workspace of each array
+        in a list is found in :attr:`parts`."""
+
+    def __init__(self, x):
+        super(Workspace, self).__init__()
+        self.x = x
+        self.parts = [Workspace(X) for X in x] if isinstance(x, (list, tuple)) else []
+        self._arrays = {}
+
+    def array(self, key, calculate):
+        """Array stored under the given key, calculated on first use.
+
+        Parameters
+        ----------
+        key: hashable
+            Key identifying the array, including everything
+            besides *x* that the array depends on.
+        calculate: callable
+            Function without arguments returning the array, for
+            example a Vandermonde matrix or an empty output buffer.
+
+        Returns
+        -------
+        NumPy array"""
+        try:
+            return self._arrays[key]
+        except KeyError:
+            array = self._arrays[key] = calculate()
+            return array
+
+    def response(self, f, x):
+        """Response of the model in *x*. If *x* is the array of the
+        workspace, the response is written in an array of the workspace,
+        which is overwritten by the next call, so only the first
+        call allocates the response.
+
+        Parameters
+        ----------
+        f: :class:`.BaseModel`
+            Model to be evaluated.
+        x: array_like or list of array_like
+            Values in which the model is evaluated.
+
+        Returns
+        -------
+        NumPy array"""
+        if x is not self.x:
+            return f(x)
+        key = ('output', id(f))
+        try:
+            out = self._arrays[key]
+        except KeyError:
+            out = self._arrays[key] = np.array(f(x), dtype='float')
+            return out
+        return f(x, out=out)
+
+class EvaluationPlan(object):
+
+    """Evaluation of a tree of models as a whole, created by
+    :meth:`.BaseModel.compile`. The tree is flattened into segments of the
+    data, one for each array in *x*. The peaks of all models evaluated in a
+    segment are gathered into one table per lineshape, and their backgrounds
+    into one polynomial, so each segment takes a single broadcasted evaluation
+    per lineshape. Models which can not be flattened, such as models with
+    sidepeaks, bins or a region of interest, are called as usual and added.
+    The values of the parameters are read from the models at each
+    evaluation, so the plan remains valid when the parameters change.
+    Adding or removing models requires a new plan.
+
+    Parameters
+    ----------
+    model: :class:`.BaseModel`
+        Root of the tree of models.
+    block_size: int, optional
+        Maximum number of (peak, x) combinations that are evaluated
+        at once, defaults to 2**18."""
+
+    def __init__(self, model, block_size=2**18):
+        super(EvaluationPlan, self).__init__()
+        self.model = model
+        self.block_size = block_size
+        # Each leaf is stored with the path of indices to its array in x
+        self.leaves = model._leaves(())
+        self.segments = []
+        for path, leaf in self.leaves:
+            if path not in self.segments:
+                self.segments.append(path)
+
+    def offsets(self, x):
+        """Start of each segment in the output, and the total size.
+
+        Parameters
+        ----------
+        x: array_like or list of array_like
+            Values in which the tree is evaluated.
+
+        Returns
+        -------
+        NumPy array"""
+        return np.cumsum([0] + [np.size(self._segment(x, path)) for path in self.segments])
+
+    @staticmethod
+    def _segment(x, path):
+        for i in path:
+            x = x[i]
+        return x
+
+    def __call__(self, x, out=None):
+        """Response of the tree of models, in the same order as
+        the response of the model itself.
+
+        Parameters
+        ----------
+        x: array_like or list of array_like
+            Values in which the tree is evaluated.
+
+        Other parameters
+        ----------------
+        out: NumPy array, optional
+            Array in which the response is written.
+
+        Returns
+        -------
+        NumPy array"""
+        segments = [self._segment(x, path) for path in self.segments]
+        flat = [np.asarray(X, dtype='float').ravel() for X in segments]
+        sizes = np.array([X.size for X in flat])
+        offsets = np.cumsum(np.append(0, sizes))
+        if out is None:
+            out = np.empty(offsets[-1])
+
+        # The segments are the rows of a matrix, padded with their last value
+        padded = np.zeros((len(flat), sizes.max()))
+        for row, X in zip(padded, flat):
+            row[:X.size] = X
+            row[X.size:] = X[-1] if X.size > 0 else 0
+        valid = np.arange(padded.shape[1]) < sizes[:, np.newaxis]
+
+        # Gather the peaks and backgrounds of the models which can be flattened
+        coefficients = [[0.0] for _ in self.segments]
+        groups = {}
+        rest = []
+        for path, leaf in self.leaves:
+            segment = self.segments.index(path)
+            peaks = leaf._flat()
+            if peaks is None:
+                rest.append((segment, leaf))
+                continue
+            template, scale, background = peaks
+            c = coefficients[segment]
+            coefficients[segment] = [a + b for a, b in itertools.zip_longest(c, background, fillvalue=0.0)]
+            key = (type(template), template.ampIsArea) + tuple([template.__dict__.get(attr) for attr in template._bank_scalars])
+            groups.setdefault(key, []).append((segment, template, scale))
+
+        degree = max([len(c) for c in coefficients])
+        coefficients = np.array([c + [0.0] * (degree - len(c)) for c in coefficients])
+        total = np.polynomial.polynomial.polyval(padded, coefficients.T[:, :, np.newaxis], tensor=False)
+        for group in groups.values():
+            self._add_peaks(total, padded, sizes, group)
+        out[...] = total[valid]
+        for segment, leaf in rest:
+            out[offsets[segment]:offsets[segment + 1]] += np.ravel(leaf(segments[segment]))
+        return out
+
+    def _add_peaks(self, total, padded, sizes, group):
+        # Stacks the evaluation templates of the banks into a single table, with
+        # the amplitudes multiplied with the scale. Each peak is evaluated in the
+        # row of its segment, and the peaks of a segment are summed. The longest
+        # segments come first, so the padding of the shorter ones can be skipped.
+        group = sorted(group, key=lambda entry: (-sizes[entry[0]], entry[0]))
+        stacked = copy.copy(group[0][1])
+        for attr in stacked._bank_attributes:
+            if attr in stacked.__dict__:
+                stacked.__dict__[attr] = np.concatenate([template.__dict__[attr] for segment, template, scale in group])
+        stacked.__dict__['_amp'] = np.concatenate([template.__dict__['_amp'] * scale for segment, template, scale in group])
+        rows = np.concatenate([np.full(len(template.__dict__['_amp']), segment) for segment, template, scale in group])
+        first = np.flatnonzero(np.append(True, rows[1:] != rows[:-1]))
+        lengths = sizes[rows]
+        step = max(1, self.block_size // rows.size)
+        for start in range(0, padded.shape[1], step):
+            block = slice(start, start + step)
+            n = np.count_nonzero(lengths > start)
+            if n == 0:
+                break
+            selection = copy.copy(stacked)
+            if n < rows.size:
+                for attr in selection._bank_attributes:
+                    if attr in selection.__dict__:
+                        selection.__dict__[attr] = selection.__dict__[attr][:n]
+            starts = first[first < n]
+            total[rows[starts], block] += np.add.reduceat(selection(padded[rows[:n], block]), starts, axis=0)
+
 class BaseModel(object):
 
     """Abstract baseclass for all models. For input, see these
     classes."""
 
+    _workspace = None
+
     def __init__(self):
         super(BaseModel, self).__init__()
         self._expr = {}
@@ -75,14 +404,17 @@ class BaseModel(object):
 
     def _set_prefix(self, value):
         for p in self._parameters:
+            expr = self._parameters[p].expr
+            if expr is None:
+                continue
             if len(self._prefix) > 0:
-                if self._parameters[p].expr is not None:
-                    self._parameters[p].expr = self._parameters[p].expr.replace(self._prefix, value)
+                expr = expr.replace(self._prefix, value)
             else:
-                if self._parameters[p].expr is not None:
-                    for P in self._parameters:
-                        if P in self._parameters[p].expr:
-                            self._parameters[p].expr = self._parameters[p].expr.replace(P, value + P)
+                for P in self._parameters:
+                    if P in expr:
+                        expr = expr.replace(P, value + P)
+            # The expression is only parsed once
+            self._parameters[p].expr = expr
         for p in list(self._parameters.keys()):
             if len(self._prefix) > 0:
                 self._parameters[p].name = self._parameters[p].name[len(self._prefix):]
@@ -258,7 +590,7 @@ class BaseModel(object):
                 par[key].expr = self._expr[self._prefix + key]
             except KeyError:
                 pass
-        return par.copy()
+        return par
 
     def get_chisquare_mapping(self):
         return np.array([self._chisquare_mapping[k](self.params[k].value) for k in self._chisquare_mapping.keys()])
@@ -275,7 +607,8 @@ class BaseModel(object):
                     leftbound, rightbound = par.min, par.max
                 leftbound = -np.inf if leftbound is None else leftbound
                 rightbound = np.inf if rightbound is None else rightbound
-                if not leftbound < par.value < rightbound:
+                # The bounds transformation of lmfit can return the boundary itself
+                if not leftbound <= par.value <= rightbound:
                     return -np.inf
         # If defined, calculate the lnprior for each seperate parameter
         return_value = 1.0
@@ -404,6 +737,8 @@ class BaseModel(object):
             Dateframe with MultiIndex, using the variable names as main column names
             and either two subcolumns for the value and the uncertainty, or
             four subcolumns for the value, uncertainty and bounds."""
+        import pandas as pd
+
         if method.lower() == 'chisquare':
             if scaled:
                 p = copy.deepcopy(self.chisq_res_par)
@@ -496,11 +831,321 @@ class BaseModel(object):
     def _sanitize_input(self, x, y, yerr=None):
         return x, y, yerr
 
+    @property
+    def workspace(self):
+        """:class:`.Workspace` with the arrays used when the model is
+        called with the same *x*, or *None*. The fitting routines assign
+        a workspace for the data during the fit."""
+        return self._workspace
+
+    @workspace.setter
+    def workspace(self, value):
+        self._workspace = value
+
+    def _workspace_for(self, x):
+        # Workspace of the model if it was made for this x, otherwise None.
+        workspace = self._workspace
+        if workspace is not None and x is workspace.x:
+            return workspace
+        return None
+
     def seperate_response(self, x):
         """Wraps the output of the :meth:`__call__` in a list, for
         ease of coding in the fitting routines."""
         return [self(x)]
 
+    def compile_parameters(self):
+        """Create a :class:`.ParameterMap` for the current parameters,
+        to be used in :meth:`.evaluate`. Changing which parameters vary,
+        their expressions or the fixed values requires a new map.
+
+        Returns
+        -------
+        :class:`.ParameterMap`"""
+        return ParameterMap(self.params)
+
+    def compile(self, block_size=2**18):
+        """Create an :class:`.EvaluationPlan` which evaluates the model,
+        and all models it contains, as a single table of peaks
+        for each array of the input.
+
+        Other parameters
+        ----------------
+        block_size: int, optional
+            Maximum number of (peak, x) combinations that are
+            evaluated at once, defaults to 2**18.
+
+        Returns
+        -------
+        :class:`.EvaluationPlan`"""
+        return EvaluationPlan(self, block_size=block_size)
+
+    def _leaves(self, path):
+        # Models without submodels, with the path to their array in x.
+        return [(path, self)]
+
+    def _flat(self):
+        # Evaluation template of the peaks, the scale and the coefficients of
+        # the background if the response is their plain sum, otherwise None.
+        return None
+
+    def evaluate(self, theta, x, parameter_map=None):
+        """Response of the model for the given values of the varying parameters,
+        without creating an lmfit.Parameters object. The values of the
+        parameters of the model are updated.
+
+        Parameters
+        ----------
+        theta: array_like
+            Values of the varying parameters, in the order of
+            :attr:`.ParameterMap.varying`.
+        x: array_like
+            Values to evaluate the model in.
+
+        Other parameters
+        ----------------
+        parameter_map: :class:`.ParameterMap`, optional
+            Map created by :meth:`.compile_parameters`. If *None*,
+            a new map is created.
+
+        Returns
+        -------
+        float or NumPy array"""
+        if parameter_map is None:
+            parameter_map = self.compile_parameters()
+        self._set_values(parameter_map.resolve(np.asarray(theta, dtype='float')))
+        return self(x)
+
+    def _share_parameters(self, params):
+        # Uses the Parameter objects of the SumModel or LinkedModel
+        # containing this model, without copying them.
+        self._parameters = self._check_variation(SATLASParameters.view(params, self._prefix))
+
+    def _values_changed(self, values):
+        # Called with all values after the shared parameters have been changed.
+        pass
+
+    def _fresh(self):
+        # False if something besides the values of the parameters changed
+        # since the last response, for models that keep their response.
+        return True
+
+    def _set_values(self, values):
+        # Assigns the dictionary of values to the parameters. Subclasses
+        # can avoid the copy of the parameters made by the setter.
+        params = self.params
+        for name, value in values.items():
+            params[name].value = value
+        self.params = params
+
+    def evaluate_batch(self, theta, x, parameter_map=None, block_size=2**22):
+        """Response of the model for many sets of values of the varying
+        parameters at once, see :meth:`.evaluate`. The parameters of
+        the model are not changed.
+
+        Parameters
+        ----------
+        theta: array_like
+            Array with a row of values of the varying parameters for each set,
+            in the order of :attr:`.ParameterMap.varying`.
+        x: array_like
+            Values to evaluate the model in.
+
+        Other parameters
+        ----------------
+        parameter_map: :class:`.ParameterMap`, optional
+            Map created by :meth:`.compile_parameters`. If *None*,
+            a new map is created.
+        block_size: int, optional
+            Maximum number of values that are calculated at once. Larger
+            batches are evaluated in chunks of parameter sets to limit
+            the memory usage. Defaults to 2**22.
+
+        Returns
+        -------
+        NumPy array
+            Array with the response for each set of values as a row."""
+        if parameter_map is None:
+            parameter_map = self.compile_parameters()
+        values = parameter_map.resolve_batch(theta)
+        sets = values[parameter_map.names[0]].size
+        step = max(1, block_size // max(1, self._batch_size(x)))
+        return np.vstack([self._batch_response(dict([(name, value[start:start + step]) for name, value in values.items()]), x) for start in range(0, sets, step)])
+
+    def _batch_size(self, x):
+        # Number of values calculated for a single set of parameters.
+        return np.hstack(x).size
+
+    def _batch_response(self, values, x):
+        # Evaluates the sets of values one by one, subclasses can provide
+        # a vectorized calculation. The parameters are restored afterwards.
+        params = self.params.copy()
+        sets = len(values[list(values.keys())[0]])
+        try:
+            response = []
+            for i in range(sets):
+                self._set_values(dict([(name, value[i]) for name, value in values.items()]))
+                response.append(np.ravel(self(x)))
+        finally:
+            self.params = params
+        return np.vstack(response)
+
+    def jacobian(self, x):
+        """Jacobian of the response with respect to the varying parameters,
+        in the order of :attr:`params`. Calculated with central differences,
+        subclasses can provide an analytical result.
+
+        Parameters
+        ----------
+        x: array_like
+            Values to evaluate the Jacobian in.
+
+        Returns
+        -------
+        NumPy array
+            Array with a row for each value of *x* and a column
+            for each varying parameter."""
+        # The values are assigned without copying the parameters, so
+        # models only recalculate what depends on the changed value.
+        parameter_map = self.compile_parameters()
+        theta = parameter_map.vector(self.params)
+        original = parameter_map.resolve(theta)
+        columns = []
+        for i, value in enumerate(theta):
+            step = 1e-6 * max(abs(value), 1)
+            shifted = theta.copy()
+            shifted[i] = min(value + step, parameter_map.max[i])
+            self._set_values(parameter_map.resolve(shifted))
+            response = np.ravel(self(x))
+            up = shifted[i]
+            shifted[i] = max(value - step, parameter_map.min[i])
+            self._set_values(parameter_map.resolve(shifted))
+            columns.append((response - np.ravel(self(x))) / (up - shifted[i]))
+        self._set_values(original)
+        return np.column_stack(columns) if columns else np.zeros((np.size(np.ravel(self(x))), 0))
+
+    def _numerical_derivative(self, name, x):
+        # Central difference of the response with respect to a single parameter,
+        # keeping all other parameters (including the expressions) fixed.
+        params = self.params
+        original = dict([(n, par.value) for n, par in params.items()])
+        values = dict(original)
+        value = original[name]
+        step = 1e-6 * max(abs(value), 1)
+        low = -np.inf if params[name].min is None else params[name].min
+        high = np.inf if params[name].max is None else params[name].max
+        values[name] = up = min(value + step, high)
+        self._set_values(values)
+        response = np.ravel(self(x))
+        values[name] = down = max(value - step, low)
+        self._set_values(values)
+        response = (response - np.ravel(self(x))) / (up - down)
+        self._set_values(original)
+        return response
+
+    def _parameter_derivatives(self):
+        # Derivatives of the values of the parameters with respect to the
+        # varying parameters, following the expressions. Returns the names of
+        # the varying parameters and a dictionary with the derivatives.
+        params = copy.deepcopy(self.params)
+        names = [name for name, par in params.items() if par.vary]
+        dependent = [name for name, par in params.items() if par.expr is not None]
+        derivatives = {name: row for name, row in zip(names, np.eye(len(names)))}
+        for name in dependent:
+            derivatives[name] = np.zeros(len(names))
+        for i, name in enumerate(names):
+            value = params[name].value
+            step = 1e-6 * max(abs(value), 1)
+            params[name].value = value + step
+            up = params[name].value
+            params.update_constraints()
+            high = [params[d].value for d in dependent]
+            params[name].value = value - step
+            down = params[name].value
+            params.update_constraints()
+            low = [params[d].value for d in dependent]
+            params[name].value = value
+            for d, h, l in zip(dependent, high, low):
+                derivatives[d][i] = (h - l) / (up - down)
+        return names, derivatives
+
+    def derivative(self, x, dx=1e-5):
+        """Derivative of the response with respect to *x*, used for the
+        uncertainty on *x* in the fitting routines. Calculated with
+        a central difference, subclasses can provide an analytical result.
+
+        Parameters
+        ----------
+        x: array_like
+            Values to evaluate the derivative in.
+        dx: float, optional
+            Step size for the central difference. Defaults to 1e-5.
+
+        Returns
+        -------
+        array_like
+            Derivative of the response for each value of *x*."""
+        return (self(x + dx) - self(x - dx)) / (2 * dx)
+
+    def linear_parameters(self):
+        """Names of the varying parameters which enter the response linearly.
+        The fitting routines can solve for these parameters directly
+        instead of including them in the search of the minimizer,
+        see :func:`.chisquare_fit`.
+
+        Returns
+        -------
+        list of str
+            Names of the parameters, empty if the model has no
+            linear parameters."""
+        return []
+
+    def _independent_parameters(self, names):
+        # Selects the parameters which vary and are independent: not given by
+        # an expression, not used in an expression and without a literature value.
+        params = self.params
+        used = set()
+        for par in params.values():
+            if par.expr is not None:
+                used.update(compile(par.expr, par.name, 'eval').co_names)
+        mapped = set(self._lnprior_mapping.keys()) | set(self._chisquare_mapping.keys())
+        return [name for name in names if name in params and params[name].vary and params[name].expr is None and
+                name not in used and name not in mapped]
+
+    def linear_basis(self, x, names):
+        """Splits the response in the contributions of the given linear
+        parameters and the remainder, so the response equals
+        *rest + basis.dot(values)*. Calculated by evaluating the model
+        with each parameter set to 1 and the others to 0, subclasses
+        can provide a direct calculation.
+
+        Parameters
+        ----------
+        x: array_like
+            Values to evaluate the model in.
+        names: list of str
+            Names of the linear parameters, see :meth:`linear_parameters`.
+
+        Returns
+        -------
+        basis, rest: NumPy arrays
+            Array with a row for each value of *x* and a column for
+            each parameter, and the response without the contributions
+            of the parameters."""
+        values = dict([(name, par.value) for name, par in self.params.items()])
+        zero = values.copy()
+        zero.update([(name, 0.0) for name in names])
+        self._set_values(zero)
+        rest = np.ravel(self(x))
+        basis = np.zeros((rest.size, len(names)))
+        for i, name in enumerate(names):
+            unit = zero.copy()
+            unit[name] = 1.0
+            self._set_values(unit)
+            basis[:, i] = np.ravel(self(x)) - rest
+        self._set_values(values)
+        return basis, rest
+
     def __add__(self, other):
         """Add two spectra together to get an :class:`.SumModel`.
 
@@ -526,7 +1171,7 @@ class BaseModel(object):
         else:
             return self.__add__(other)
 
-    def __call__(self, x):
+    def __call__(self, x, out=None):
         raise NotImplementedError("Method has to be implemented in subclass!")
 
 def load_model(path):
@@ -5,17 +5,18 @@ Implementation of a class for the analysis of hyperfine structure spectra.
 .. moduleauthor:: Ruben de Groote <ruben.degroote@kuleuven.be>
 """
 import copy
+import itertools
+import math
 from fractions import Fraction
 
 import lmfit as lm
 from satlas.models.basemodel import BaseModel, SATLASParameters
 from satlas.utilities import poisson_interval
 import satlas.profiles as p
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import scipy.optimize as optimize
-from sympy.physics.wigner import wigner_6j, wigner_3j
+from scipy import interpolate
+from satlas.wigner import wigner_6j, wigner_3j, racah_intensities
 
 W6J = wigner_6j
 W3J = wigner_3j
@@ -35,8 +36,15 @@ class HFSModel(BaseModel):
                   'voigt': p.Voigt,
                   'pseudovoigt': p.PseudoVoigt,
                   'asymmlorentzian': p.AsymmLorentzian}
+    __sidepeak_methods__ = ['exact', 'broadcast', 'interpolate']
+    __structure__ = ['F', 'J', 'num_lower', 'num_upper', 'C', 'D', 'E', 'ftof',
+                     'transition_indices', 'racah_amplitudes', 'saturated_amplitudes']
 
-    def __init__(self, I, J, ABC, centroid, fwhm=[50.0, 50.0], scale=1.0, background_params=[0.001], shape='voigt', use_racah=False, use_saturation=False, saturation=0.001, shared_fwhm=True, sidepeak_params={'N': 0, 'Poisson': 0.68, 'Offset': 0}, crystalballparams={'Taillocation': 1, 'Tailamplitude': 1}, pseudovoigtparams={'Eta': 0.5, 'A': 0}, asymmetryparams={'a': 0}):
+    # Levels and transitions for each combination of I and J, shared
+    # by all models with the same spins.
+    _structures = {}
+
+    def __init__(self, I, J, ABC, centroid, fwhm=[50.0, 50.0], scale=1.0, background_params=[0.001], shape='voigt', use_racah=False, use_saturation=False, saturation=0.001, shared_fwhm=True, sidepeak_params={'N': 0, 'Poisson': 0.68, 'Offset': 0}, crystalballparams={'Taillocation': 1, 'Tailamplitude': 1}, pseudovoigtparams={'Eta': 0.5, 'A': 0}, asymmetryparams={'a': 0}, voigt_backend='wofz', binned=False, sidepeak_method='exact', roi=None, frozen_shape=False):
         """Builds the HFS with the given atomic and nuclear information.
 
         Parameters
@@ -107,6 +115,22 @@ class HFSModel(BaseModel):
                 Describes the mixing percentage of the Gaussian and Lorentzian shapes
             A: float
                 Describes the asymmetry of the peak.
+        voigt_backend: string, optional
+            Sets the calculation of the Voigt profile, see :attr:`.Voigt.backend`
+            for the possible values. Only used for the Voigt shape. Defaults to 'wofz'.
+            With *shared_fwhm*, 'table' evaluates all peaks from a single cached table.
+        binned: boolean, optional
+            If True, the model is called with the edges of the frequency bins
+            and returns the average response in each bin. Defaults to False.
+        sidepeak_method: string, optional
+            Sets the calculation of the sidepeaks, see :attr:`sidepeak_method`
+            for the possible values. Defaults to 'exact'.
+        roi: list of tuples or float, optional
+            Region of interest in which the peaks are evaluated, see
+            :attr:`roi`. Defaults to *None*, evaluating the peaks everywhere.
+        frozen_shape: boolean, optional
+            Allows shifting a precalculated line pattern when only the centroid,
+            scale and background vary, see :attr:`frozen_shape`. Defaults to False.
 
         Note
         ----
@@ -155,14 +179,15 @@ class HFSModel(BaseModel):
                                     (True, 1), (False, 0))
                               }
         self.shape = shape
+        self._voigt_backend = voigt_backend
+        self._binned = binned
+        self.sidepeak_method = sidepeak_method
         self._use_racah = use_racah
         self._use_saturation = use_saturation
         self.shared_fwhm = shared_fwhm
         self.I = I
         self.J = J
-        self._calculate_F_levels()
-        self._calculate_energy_coefficients()
-        self._calculate_transitions()
+        self._set_structure()
 
         self._vary = {}
         self._constraints = {}
@@ -171,7 +196,15 @@ class HFSModel(BaseModel):
         self.ratioB = (None, 'lower')
         self.ratioC = (None, 'lower')
 
-        self._roi = (-np.inf, np.inf)
+        self._roi = roi
+        self._frozen_shape = frozen_shape
+
+        # Values used in the last update of the peaks, the last response,
+        # the grid of the frozen line pattern and the last checked values
+        self._values = {}
+        self._response = None
+        self._grid = None
+        self._state = None
 
         self._populateparams(ABC, centroid, fwhm, scale, saturation,
                               background_params,
@@ -190,6 +223,7 @@ class HFSModel(BaseModel):
         self._locations = np.array(locations)
         for p, l in zip(self.parts, locations):
             p.mu = l
+        self._response = None
 
     @property
     def use_racah(self):
@@ -200,6 +234,7 @@ class HFSModel(BaseModel):
     @use_racah.setter
     def use_racah(self, value):
         self._use_racah = value
+        self._reset()
         self.params['Scale'].vary = self._use_racah or self._use_saturation
         for label in self.ftof:
             self.params['Amp' + label].vary = not (self._use_racah or self._use_saturation)
@@ -213,11 +248,175 @@ class HFSModel(BaseModel):
     @use_saturation.setter
     def use_saturation(self, value):
         self._use_saturation = value
+        self._reset()
         self.params['Saturation'].vary = value
         self.params['Scale'].vary = self._use_racah or self._use_saturation
         for label in self.ftof:
             self.params['Amp' + label].vary = not (self._use_racah or self._use_saturation)
 
+    @property
+    def tolerance(self):
+        """Relative tolerance used for the windowed evaluation of the peaks.
+        If *None*, each peak is evaluated over the full range of the input.
+        See :attr:`.ProfileBank.tolerance` for more information."""
+        return self._bank.tolerance
+
+    @tolerance.setter
+    def tolerance(self, value):
+        self._bank.tolerance = value
+        self._response = None
+        self._grid = None
+
+    @property
+    def binned(self):
+        """If True, the model is evaluated using the edges of the
+        frequency bins instead of the centres, returning the average response
+        over each bin. The profiles are integrated over the bins, so
+        coarsely binned data can be fitted without oversampling."""
+        return self._binned
+
+    @binned.setter
+    def binned(self, value):
+        self._binned = value
+        self._response = None
+
+    @property
+    def roi(self):
+        """Region of interest, in which the peaks are evaluated. Outside of
+        it, the response is only the background. Either *None* to evaluate
+        the peaks everywhere, a list of (low, high) windows, or a number:
+        windows of that many times the FWHM are then placed around each
+        peak and sidepeak, at their current locations. The profiles are cut
+        off at the edges, so the windows should contain the relevant
+        part of the tails. The fitting routines fix the windows at the start
+        of the fit and only evaluate the peaks for the data inside of them.
+        Not used when :attr:`binned` is True."""
+        return self._roi
+
+    @roi.setter
+    def roi(self, value):
+        self._roi = value
+        self._response = None
+
+    def roi_windows(self):
+        """Windows of the region of interest, with overlapping
+        windows merged.
+
+        Returns
+        -------
+        list of tuples
+            Sorted (low, high) windows, or *None* if
+            no region of interest is set."""
+        if self._roi is None:
+            return None
+        if np.isscalar(self._roi):
+            offsets = np.arange(int(self._values['N']) + 1) * self._values.get('Offset', 0)
+            centres = (self.locations[np.newaxis, :] + offsets[:, np.newaxis]).ravel()
+            halfwidths = np.tile([self._roi * part.fwhm for part in self.parts], len(offsets))
+            windows = sorted(zip(centres - halfwidths, centres + halfwidths))
+        else:
+            windows = sorted([tuple(window) for window in self._roi])
+        merged = [list(windows[0])]
+        for low, high in windows[1:]:
+            if low <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+        return [(float(low), float(high)) for low, high in merged]
+
+    def roi_mask(self, x):
+        """Selects the values inside the region of interest.
+
+        Parameters
+        ----------
+        x: array_like
+            Frequencies in MHz.
+
+        Returns
+        -------
+        NumPy array
+            Boolean array, True for the values inside the region of interest,
+            or *None* if no region of interest is used."""
+        if self._roi is None or self.binned:
+            return None
+        # The values after an odd number of edges are inside a window
+        windows = self.roi_windows()
+        def mask():
+            edges = np.array(windows).ravel()
+            return np.searchsorted(edges, np.asarray(x, dtype='float'), side='right') % 2 == 1
+        workspace = self._workspace_for(x)
+        if workspace is None:
+            return mask()
+        return workspace.array(('roi', tuple(windows)), mask)
+
+    @property
+    def sidepeak_method(self):
+        """Method used to calculate the sidepeaks, which are shifted copies
+        of the main spectrum weighted by the Poisson factors:
+
+            * *'exact'*: the peaks are evaluated again for every sidepeak.
+            * *'broadcast'*: all shifts are evaluated in a single call to
+              the profiles. Gives the same result as *'exact'*.
+            * *'interpolate'*: the main spectrum is calculated once on a grid
+              with the spacing of the data, extended to cover the shifts, and the
+              sidepeaks are interpolated from it with a cubic spline. When binned,
+              the cumulative integral is interpolated instead. Only used for
+              a uniform grid which is not much smaller than the shifts, otherwise
+              *'broadcast'* is used. The interpolation error scales with the fourth
+              power of the spacing and is negligible for data sampling the
+              peaks with several points per FWHM.
+
+        The fitting routines always finish the fit with an exact calculation."""
+        return self._sidepeak_method
+
+    @sidepeak_method.setter
+    def sidepeak_method(self, value):
+        value = value.lower()
+        if value not in self.__sidepeak_methods__:
+            raise KeyError('Sidepeak method {} not supported, choose from {}.'.format(value, ', '.join(self.__sidepeak_methods__)))
+        self._sidepeak_method = value
+        self._response = None
+
+    @property
+    def frozen_shape(self):
+        """If True, the line pattern is only shifted and scaled when just the
+        *Centroid*, *Scale* and *Background* parameters are varied, as when
+        fitting isotope shifts with fixed hyperfine parameters. The pattern,
+        including the sidepeaks, is then calculated once on a grid relative to
+        the centroid, with a tenth of the smallest FWHM as spacing, and
+        interpolated with a quintic spline. When binned, the cumulative
+        integral is interpolated instead. The grid is only calculated again
+        when the shape changes or the frequencies move outside of it. For
+        data with a range much larger than the number of points times the
+        FWHM, the peaks are calculated directly.
+
+        As the interpolation is an approximation (with an error of the order
+        of :math:`10^{-7}` times the peak height), this has to be enabled
+        explicitly. The fitting routines always finish the fit with an
+        exact calculation."""
+        return self._frozen_shape
+
+    @frozen_shape.setter
+    def frozen_shape(self, value):
+        self._frozen_shape = value
+        self._grid = None
+        self._response = None
+
+    @property
+    def voigt_backend(self):
+        """Method used to calculate the Voigt profile. See
+        :attr:`.Voigt.backend` for the possible values."""
+        return self._voigt_backend
+
+    @voigt_backend.setter
+    def voigt_backend(self, value):
+        if self.shape == 'voigt':
+            for prof in self.parts:
+                prof.backend = value
+            self._bank.update()
+        self._voigt_backend = value
+        self._response = None
+
     @property
     def params(self):
         """Instance of lmfit.Parameters object characterizing the
@@ -229,43 +428,104 @@ class HFSModel(BaseModel):
         p = params.copy()
         p._prefix = self._prefix
         self._parameters = self._check_variation(p)
-        # self._parameters.pretty_print()
-        # print(self._prefix)
-        # When changing the parameters, the energies and
-        # the locations have to be recalculated
-        self._calculate_energies()
-        self._calculate_transition_locations()
-        if not self.use_racah and not self.use_saturation:
-            # When not using set amplitudes, they need
-            # to be changed after every iteration
-            self._set_amplitudes()
-        elif self.use_saturation:
-            self._set_transitional_amplitudes()
-        else:
-            pass
-        # Finally, the fwhm of each peak needs to be set
-        self._set_fwhm()
-        if self.shape.lower() == 'crystalball':
-            for part in self.parts:
-                part.alpha = self.params['Taillocation'].value
-                part.n = self.params['Tailamplitude'].value
-        if self.shape.lower() == 'pseudovoigt':
-            for label, part in zip(self.ftof, self.parts):
-                if self.shared_fwhm:
-                    part.n = self.params['Eta'].value
-                    part.a = self.params['Asym'].value
-                else:
-                    part.n = self.params['Eta'+label].value
-                    part.a = self.params['Asym'+label].value
-        elif self.shape.lower() == 'asymmlorentzian':
-            for label, part in zip(self.ftof, self.parts):
-                if self.shared_fwhm:
-                    part.asymm = self.params['Asym'].value
-                else:
-                    part.asymm = self.params['Asym'+label].value
+        self._update_peaks(dict([(key, par.value) for key, par in self._parameters.items()]))
+
+    def _set_values(self, values):
+        # Assigns the values without copying the parameters.
+        for key, value in values.items():
+            self._parameters[key].value = value
+        self._update_peaks(values)
+
+    def _values_changed(self, values):
+        self._update_peaks(values)
+
+    def _fresh(self):
+        self._check_values()
+        return self._response is not None
+
+    def _check_values(self):
+        # Values assigned directly to the Parameter objects, as in
+        # model.params['Scale'].value = 2, are only seen here. The
+        # expressions are only evaluated if a value or expression changed.
+        state = [par.value if par.expr is None else par.expr for par in self._parameters.values()]
+        if state != self._state:
+            self._update_peaks(dict([(key, par.value) for key, par in self._parameters.items()]))
+            self._state = state
+
+    def _update_peaks(self, values):
+        # Only the stages depending on a changed parameter are rerun. The values
+        # are stored without the prefix, the parameters of other models
+        # in a SumModel or LinkedModel are ignored.
+        n = len(self._prefix)
+        values = dict([(key[n:], value) for key, value in values.items() if key.startswith(self._prefix)])
+        changed = set([self._parameter_group(key) for key, value in values.items() if key not in self._values or self._values[key] != value])
+        self._values = values
+        if not changed:
+            return
+        self._response = None
+        if 'energies' in changed:
+            # When changing the hyperfine parameters or the centroid, the
+            # energies and the locations have to be recalculated
+            self._calculate_energies()
+            self._calculate_transition_locations()
+        if 'amplitudes' in changed:
+            if not self.use_racah and not self.use_saturation:
+                # When not using set amplitudes, they need
+                # to be changed after every change
+                self._set_amplitudes()
+            elif self.use_saturation:
+                self._set_transitional_amplitudes()
+            else:
+                pass
+        if 'fwhm' in changed:
+            self._set_fwhm()
+        if 'shape' in changed:
+            if self.shape.lower() == 'crystalball':
+                for part in self.parts:
+                    part.alpha = self._values['Taillocation']
+                    part.n = self._values['Tailamplitude']
+            if self.shape.lower() == 'pseudovoigt':
+                for label, part in zip(self.ftof, self.parts):
+                    if self.shared_fwhm:
+                        part.n = self._values['Eta']
+                        part.a = self._values['Asym']
+                    else:
+                        part.n = self._values['Eta'+label]
+                        part.a = self._values['Asym'+label]
+            elif self.shape.lower() == 'asymmlorentzian':
+                for label, part in zip(self.ftof, self.parts):
+                    if self.shared_fwhm:
+                        part.asymm = self._values['Asym']
+                    else:
+                        part.asymm = self._values['Asym'+label]
+        if changed - set([None]):
+            # Gather the new values of the profiles for the vectorized evaluation
+            self._bank.update()
+
+    @staticmethod
+    def _parameter_group(name):
+        # Group of the peaks depending on the parameter. Parameters that only
+        # enter in the response itself (scale, background, sidepeaks) return None.
+        if name in ('Al', 'Au', 'Bl', 'Bu', 'Cl', 'Cu', 'Centroid'):
+            return 'energies'
+        if name.startswith('Amp') or name == 'Saturation':
+            return 'amplitudes'
+        if name.startswith('FWHM'):
+            return 'fwhm'
+        if name.startswith(('Eta', 'Asym')) or name in ('Taillocation', 'Tailamplitude'):
+            return 'shape'
+        return None
+
+    def _reset(self):
+        # Forces the recalculation of all peaks on the next
+        # assignment of the parameters and clears the last response.
+        self._values = {}
+        self._response = None
+        self._grid = None
+        self._state = None
 
     def _set_transitional_amplitudes(self):
-        values = self._calculate_transitional_intensities(self.params['Saturation'].value)
+        values = self._calculate_transitional_intensities(self._values['Saturation'])
         for p, l, v in zip(self.parts, self.ftof, values):
             self.params['Amp' + l].value = v
             p.amp = v
@@ -316,14 +576,14 @@ class HFSModel(BaseModel):
         -------
         energy: float
             Energy in MHz."""
-        A = np.append(np.ones(self.num_lower) * self.params['Al'].value,
-                      np.ones(self.num_upper) * self.params['Au'].value)
-        B = np.append(np.ones(self.num_lower) * self.params['Bl'].value,
-                      np.ones(self.num_upper) * self.params['Bu'].value)
-        C = np.append(np.ones(self.num_lower) * self.params['Cl'].value,
-                      np.ones(self.num_upper) * self.params['Cu'].value)
+        A = np.append(np.ones(self.num_lower) * self._values['Al'],
+                      np.ones(self.num_upper) * self._values['Au'])
+        B = np.append(np.ones(self.num_lower) * self._values['Bl'],
+                      np.ones(self.num_upper) * self._values['Bu'])
+        C = np.append(np.ones(self.num_lower) * self._values['Cl'],
+                      np.ones(self.num_upper) * self._values['Cu'])
         centr = np.append(np.zeros(self.num_lower),
-                          np.ones(self.num_upper) * self.params['Centroid'].value)
+                          np.ones(self.num_upper) * self._values['Centroid'])
         self.energies = centr + self.C * A + self.D * B + self.E * C
 
     def _calculate_transition_locations(self):
@@ -331,13 +591,13 @@ class HFSModel(BaseModel):
 
     def _set_amplitudes(self):
         for p, label in zip(self.parts, self.ftof):
-            p.amp = self.params['Amp' + label].value
+            p.amp = self._values['Amp' + label]
 
     def _set_fwhm(self):
         if self.shape.lower() == 'voigt':
-            fwhm = [[self.params['FWHMG'].value, self.params['FWHML'].value] for _ in self.ftof] if self.shared_fwhm else [[self.params['FWHMG' + label].value, self.params['FWHML' + label].value] for label in self.ftof]
+            fwhm = [[self._values['FWHMG'], self._values['FWHML']] for _ in self.ftof] if self.shared_fwhm else [[self._values['FWHMG' + label], self._values['FWHML' + label]] for label in self.ftof]
         else:
-            fwhm = [self.params['FWHM'].value for _ in self.ftof] if self.shared_fwhm else [self.params['FWHM' + label].value for label in self.ftof]
+            fwhm = [self._values['FWHM'] for _ in self.ftof] if self.shared_fwhm else [self._values['FWHM' + label] for label in self.ftof]
         for p, f in zip(self.parts, fwhm):
             p.fwhm = f
 
@@ -548,7 +808,30 @@ class HFSModel(BaseModel):
         self.saturated_amplitudes = np.array(sat_amp)
         self.saturated_amplitudes = self.saturated_amplitudes / self.saturated_amplitudes.max()
 
-        self.parts = tuple(self.__shapes__[self.shape](amp=a) for a in self.racah_amplitudes)
+    def _set_structure(self):
+        # The levels, transitions and energy coefficients only depend on I and J.
+        # They are calculated once, the arrays are shared between the models
+        # and made read-only, the lists are copied.
+        key = (float(self.I), float(self.J[0]), float(self.J[1]))
+        try:
+            structure = self._structures[key]
+        except KeyError:
+            self._calculate_F_levels()
+            self._calculate_energy_coefficients()
+            self._calculate_transitions()
+            structure = dict([(name, getattr(self, name)) for name in self.__structure__])
+            for value in structure.values():
+                if isinstance(value, np.ndarray):
+                    value.setflags(write=False)
+            self._structures[key] = structure
+        for name, value in structure.items():
+            setattr(self, name, copy.deepcopy(value) if isinstance(value, list) else value)
+        self._create_parts()
+
+    def _create_parts(self):
+        kwargs = {'backend': self._voigt_backend} if self.shape == 'voigt' else {}
+        self.parts = tuple(self.__shapes__[self.shape](amp=a, **kwargs) for a in self.racah_amplitudes)
+        self._bank = p.ProfileBank(self.parts)
 
     def _calculate_transitional_intensities(self, s):
         if s <= 0:
@@ -560,8 +843,9 @@ class HFSModel(BaseModel):
             return transitional / transitional.max()
 
     def _calculate_racah_intensity(self, J1, J2, F1, F2, order=1.0):
-        return float((2 * F1 + 1) * (2 * F2 + 1) * \
-                     W6J(J2, F2, self.I, F1, J1, order) ** 2)  # DO NOT REMOVE CAST TO FLOAT!!!
+        # The intensities are calculated exactly and cached
+        # for each combination of spins, see satlas.wigner.
+        return racah_intensities(self.I, J1, J2, order)[(F1, F2)]
 
     def _calculate_energy_coefficients(self):
         # Since I, J and F do not change, these factors can be calculated once
@@ -603,33 +887,656 @@ class HFSModel(BaseModel):
             self.ratioC = (value, target)
         self.params = self._set_ratios(self.params)
 
+    def clone(self, values=None, prefix=None):
+        """Creates a copy of the model to be used as a template. The levels,
+        transitions and energy coefficients are shared with the copy, only
+        the parameters and the profiles are copied. The caches of the
+        response are not copied.
+
+        Parameters
+        ----------
+        values: dict, optional
+            New values of the parameters, with the names of the
+            parameters without the prefix.
+        prefix: str, optional
+            If given, replaces the prefix of the parameters of the copy.
+
+        Returns
+        -------
+        HFSModel"""
+        model = copy.deepcopy(self)
+        if prefix is not None:
+            model._set_prefix(prefix)
+        if values:
+            params = model._parameters
+            for key, value in values.items():
+                params[key].value = value
+            model._update_peaks(dict([(key, par.value) for key, par in params.items()]))
+        return model
+
+    def __deepcopy__(self, memo):
+        # The read-only arrays of the structure and the tables of the spins
+        # are shared, the caches depending on x are left out.
+        model = self.__class__.__new__(self.__class__)
+        memo[id(self)] = model
+        for name in self.__structure__ + ['I_value', 'J_lower_value', 'J_upper_value']:
+            value = getattr(self, name)
+            if not isinstance(value, list):
+                memo[id(value)] = value
+        for key, value in self.__dict__.items():
+            if key in ('_response', '_grid', '_workspace'):
+                value = None
+            model.__dict__[key] = copy.deepcopy(value, memo)
+        return model
+
+    def guess(self, x, y, max_candidates=100000):
+        """Sets starting values for a fit from the peaks in the data.
+        The data is smoothed, and the most prominent peaks are assigned
+        to transitions. The strongest peaks are tried first for the
+        transitions with the largest Racah intensities. For each assignment,
+        the varying *Centroid*, *Al*, *Au*, *Bl* and *Bu* follow from a linear
+        least squares fit to the peak positions, as the locations depend
+        linearly on them. The assignment is kept for which the peaks,
+        sidepeaks and Racah intensities best describe the smoothed data. The
+        FWHM is estimated from the width of the peaks, after which the
+        scale or a common factor for the amplitudes, starting from the Racah
+        intensities, and the background are solved for by linear least squares. Parameters which do not vary keep their value.
+
+        Parameters
+        ----------
+        x: array_like
+            Frequencies in MHz. If :attr:`binned` is True, these are
+            the edges of the frequency bins.
+        y: array_like
+            Counts or other response for each frequency or bin.
+
+        Other parameters
+        ----------------
+        max_candidates: int, optional
+            Maximum number of assignments of peaks to transitions that
+            are tried. Defaults to 100000."""
+        from scipy import ndimage, signal
+        x, y = np.asarray(x, dtype='float'), np.asarray(y, dtype='float')
+        centres = (x[:-1] + x[1:]) / 2 if self.binned else x
+        order = np.argsort(centres)
+        step = np.median(np.diff(centres[order]))
+        grid = np.arange(centres[order][0], centres[order][-1] + step / 2, step)
+        data = np.interp(grid, centres[order], y[order])
+
+        # Smoothing over a quarter of the current FWHM, but at least a point
+        fwhm = max([part.fwhm for part in self.parts])
+        sigma = max(fwhm / (4 * 2.3548 * step), 1.0)
+        smoothed = ndimage.gaussian_filter1d(data, sigma)
+        background = np.median(smoothed)
+        noise = 1.4826 * np.median(np.abs(smoothed - background))
+        signal_range = smoothed.max() - background
+        threshold = max(3 * noise, 0.02 * signal_range)
+        found = signal.find_peaks(smoothed - background, prominence=threshold)[0]
+        found = found[np.argsort(smoothed[found])[::-1]]
+        positions, heights = grid[found], smoothed[found] - background
+        if found.size > 0:
+            widths = signal.peak_widths(smoothed, found[:len(self.parts)], rel_height=0.5)[0] * step
+            # Remove the broadening by the smoothing
+            width = np.sqrt(max(np.median(widths) ** 2 - (2.3548 * sigma * step) ** 2, step ** 2))
+        else:
+            width = fwhm
+
+        params = self.params.copy()
+        n = self._prefix
+        low, high = np.array(self.transition_indices).T
+        columns = {'Centroid': np.ones(len(low)),
+                   'Al': -self.C[low], 'Au': self.C[high],
+                   'Bl': -self.D[low], 'Bu': self.D[high]}
+        # Parameters fixed by a ratio move together with the free one
+        for (ratio, target), (l, u) in zip((self.ratioA, self.ratioB), (('Al', 'Au'), ('Bl', 'Bu'))):
+            if ratio is not None:
+                fixed, free = (l, u) if target.lower() == 'lower' else (u, l)
+                columns[free] = columns[free] + ratio * columns.pop(fixed)
+        free = [name for name in ['Centroid', 'Al', 'Au', 'Bl', 'Bu'] if name in columns and params[n + name].vary and not params[n + name].expr and np.any(columns[name] != 0)]
+        free = free[:min(positions.size, len(self.locations) * (int(self._values['N']) + 1))]
+        if free:
+            # Locations of the peaks and sidepeaks, as the locations for the
+            # other values plus a linear combination of the free parameters
+            N = int(self._values['N'])
+            offsets = np.arange(N + 1) * self._values.get('Offset', 0)
+            weights = np.array([self._values.get('Poisson', 0) ** i / math.factorial(i) for i in range(N + 1)])
+            intensities = (weights[:, np.newaxis] * self.racah_amplitudes[np.newaxis, :]).ravel()
+            M = np.array([columns[name] for name in free]).T
+            locations = np.array(self.locations) - M.dot([self._values[name] for name in free])
+            locations = (locations[np.newaxis, :] + offsets[:, np.newaxis]).ravel()
+            M = np.tile(M, (N + 1, 1))
+
+            # The strongest peaks are assigned to the strongest lines first
+            m = len(free)
+            strongest = list(np.argsort(intensities)[::-1])
+            candidates = itertools.islice(itertools.permutations(strongest, m), max_candidates)
+            best, best_score = None, np.inf
+            while True:
+                chunk = np.array(list(itertools.islice(candidates, 5000)), dtype='int')
+                if chunk.size == 0:
+                    break
+                solutions = np.einsum('kpm,km->kp', np.linalg.pinv(M[chunk]), positions[:m] - locations[chunk])
+                predicted = locations[np.newaxis, :] + solutions.dot(M.T)
+                expected = np.interp(predicted, grid, smoothed - background, left=0, right=0)
+                factor = np.maximum(expected.dot(intensities) / intensities.dot(intensities), 0)
+                score = ((expected - factor[:, np.newaxis] * intensities) ** 2).sum(axis=1)
+                # Peaks in the data which are not predicted by the assignment
+                distance = np.abs(predicted[:, :, np.newaxis] - positions[np.newaxis, np.newaxis, :]).min(axis=1)
+                score += ((distance > width) * heights ** 2).sum(axis=1)
+                if score.min() < best_score:
+                    best, best_score = solutions[np.argmin(score)], score.min()
+            # Refine with all peaks close to a predicted line
+            for _ in range(2):
+                distance = np.abs(locations[:, np.newaxis] + M.dot(best)[:, np.newaxis] - positions[np.newaxis, :])
+                matched = distance.min(axis=0) < width / 2
+                if matched.sum() <= m:
+                    break
+                lines = distance.argmin(axis=0)[matched]
+                best = np.linalg.lstsq(M[lines], positions[matched] - locations[lines], rcond=None)[0]
+            for name, value in zip(free, best):
+                params[n + name].value = value
+
+        for name, par in params.items():
+            if not par.vary or par.expr or not name[len(n):].startswith('FWHM'):
+                continue
+            if self.shape.lower() == 'voigt':
+                # Equal Gaussian and Lorentzian contributions
+                par.value = width / 1.6376
+            else:
+                par.value = width
+        self.params = params
+
+        # Free amplitudes start from the Racah intensities, with a common factor
+        names = self.linear_parameters()
+        if names:
+            basis, rest = self.linear_basis(x, names)
+            racah = dict(zip(['Amp' + label for label in self.ftof], self.racah_amplitudes))
+            amplitudes = np.array([racah.get(name[len(n):], 0) for name in names])
+            others = [i for i, name in enumerate(names) if name[len(n):] not in racah]
+            if amplitudes.any():
+                basis = np.column_stack([basis.dot(amplitudes)] + [basis[:, i] for i in others])
+            solution = np.linalg.lstsq(basis, y - rest, rcond=None)[0]
+            if amplitudes.any():
+                values = amplitudes * solution[0]
+                values[others] = solution[1:]
+            else:
+                values = solution
+            for name, value in zip(names, values):
+                params[name].value = value
+            self.params = params
+
     ###########################
     #      MAGIC METHODS      #
     ###########################
 
-    def __call__(self, x):
+    def __call__(self, x, out=None):
         """Get the response for frequency *x* (in MHz) of the spectrum.
 
         Parameters
         ----------
         x : float or array_like
-            Frequency in MHz
+            Frequency in MHz. If :attr:`binned` is True, these are
+            the edges of the frequency bins.
+
+        Other parameters
+        ----------------
+        out: NumPy array, optional
+            Array with the shape of the response, in
+            which the response is written.
 
         Returns
         -------
         float or NumPy array
-            Response of the spectrum for each value of *x*."""
-        if self.params['N'].value > 0:
+            Response of the spectrum for each value of *x*, or
+            the average response in each bin. When *x* is the array
+            of the :attr:`workspace`, this is a read-only view of an
+            array of the workspace, which is overwritten by the next call."""
+        self._check_values()
+        # Nothing affecting the response changed since the last evaluation
+        cached = self._response
+        if cached is not None and isinstance(x, np.ndarray) and (cached[0] is x or np.array_equal(x, cached[0])):
+            response = cached[1]
+        else:
+            response = self._response_of(x)
+            if isinstance(x, np.ndarray):
+                # The array of a workspace is not changed, so it is not copied
+                self._response = (x if self._workspace_for(x) is not None else x.copy(), response)
+        if out is not None:
+            out[...] = response
+            return out
+        if self._workspace_for(x) is not None:
+            # The array of the workspace is overwritten by the next call
+            response = response.view()
+            response.flags.writeable = False
+            return response
+        return response.copy() if isinstance(response, np.ndarray) else response
+
+    def _response_of(self, x):
+        mask = self.roi_mask(x) if isinstance(x, np.ndarray) else None
+        if mask is None:
+            s = self._signal(x)
+        else:
             s = np.zeros(x.shape)
-            for i in range(self.params['N'].value + 1):
-                s += (self.params['Poisson'].value ** i) * (sum([prof(x - i * self.params['Offset'].value)
-                                                                for prof in self.parts])) / np.math.factorial(i)
-            s *= self.params['Scale'].value
+            if mask.any():
+                s[mask] = self._signal(x[mask])
+        workspace = self._workspace_for(x)
+        if workspace is None:
+            return s + self._background(x)
+        response = workspace.array(('response', id(self)), lambda: np.empty(np.shape(s)))
+        return np.add(s, self._background(x), out=response)
+
+    def _signal(self, x):
+        # Response of the peaks and sidepeaks, without the background.
+        if self._frozen() and isinstance(x, np.ndarray) and x.ndim == 1:
+            s = self._frozen_pattern(x)
+            if s is not None:
+                return self._values['Scale'] * s
+        return self._values['Scale'] * self._pattern(x)
+
+    def _pattern(self, x):
+        # Response of the peaks and sidepeaks for a unit scale.
+        if self._values['N'] > 0:
+            return self._sidepeaks(x)
+        return self._peaks(x)
+
+    def _frozen(self):
+        # True if only the position, scale and background of the pattern vary.
+        if not self._frozen_shape:
+            return False
+        n = len(self._prefix)
+        for name, par in self._parameters.items():
+            name = name[n:]
+            if par.vary and not par.expr and name not in ('Centroid', 'Scale') and not name.startswith('Background'):
+                return False
+        return True
+
+    def _frozen_pattern(self, x):
+        # Pattern shifted to the centroid, interpolated from the grid.
+        # Returns None if the grid would be too large.
+        centroid = self._values['Centroid']
+        u = x - centroid
+        key = sorted([(name, value) for name, value in self._values.items() if name not in ('Centroid', 'Scale') and not name.startswith('Background')])
+        key = (key, self.binned, self.sidepeak_method, self.voigt_backend, self.use_racah, self.use_saturation)
+        if self._grid is None or self._grid[0] != key or u.min() < self._grid[1] or u.max() > self._grid[2]:
+            fwhm = [part.fwhm for part in self.parts]
+            step = min(fwhm) / 10
+            width = u.max() - u.min()
+            # Margin to allow the centroid to move without a new grid
+            margin = 0.1 * width + 10 * max(fwhm)
+            size = int(np.ceil((width + 2 * margin) / step)) + 1
+            if size > max(4 * x.size, 4096):
+                return None
+            grid = np.linspace(u.min() - margin, u.max() + margin, size)
+            pattern = self._pattern(grid + centroid)
+            if self.binned:
+                pattern = np.concatenate([[0], np.cumsum(pattern * np.diff(grid))])
+            self._grid = (key, grid[0], grid[-1], interpolate.make_interp_spline(grid, pattern, k=5))
+        spline = self._grid[3]
+        if self.binned:
+            return np.diff(spline(u)) / np.diff(x)
+        return spline(u)
+
+    def background(self, x):
+        """Background of the response, the polynomial with the
+        *Background* parameters as coefficients.
+
+        Parameters
+        ----------
+        x: float or array_like
+            Frequency in MHz. If :attr:`binned` is True, these are
+            the edges of the frequency bins.
+
+        Returns
+        -------
+        float or NumPy array
+            Background for each value of *x*, or the average
+            background in each bin."""
+        self._check_values()
+        return self._background(x)
+
+    def _background(self, x):
+        workspace = self._workspace_for(x)
+        if workspace is not None and np.ndim(x) == 1:
+            powers = workspace.array(('background', self.background_degree, self.binned), lambda: self._background_powers(x))
+            return powers.dot([self._values['Background' + str(deg)] for deg in range(self.background_degree + 1)])
+        background_params = [self._values['Background' + str(int(deg))] for deg in reversed(list(range(self.background_degree + 1)))]
+        if self.binned:
+            x = np.asarray(x, dtype='float')
+            return np.diff(np.polyval(np.polyint(background_params), x)) / np.diff(x)
+        return np.polyval(background_params, x)
+
+    def _background_powers(self, x):
+        # Matrix with the powers of x as columns, or their
+        # average over each bin when binned.
+        x = np.asarray(x, dtype='float')
+        degree = self.background_degree
+        if self.binned:
+            integrals = np.vander(x, degree + 2, increasing=True)[:, 1:] / np.arange(1, degree + 2)
+            return np.diff(integrals, axis=0) / np.diff(x)[:, np.newaxis]
+        return np.vander(x, degree + 1, increasing=True)
+
+    def derivative(self, x, dx=1e-5):
+        """Derivative of the response with respect to *x*, calculated
+        analytically from the derivatives of the profiles.
+
+        Parameters
+        ----------
+        x: array_like
+            Frequencies in MHz.
+        dx: float, optional
+            Step size for the central difference, only used when
+            :attr:`binned` is True. Defaults to 1e-5.
+
+        Returns
+        -------
+        array_like
+            Derivative of the response for each value of *x*."""
+        if self.binned:
+            return super(HFSModel, self).derivative(x, dx=dx)
+        self._check_values()
+        x = np.asarray(x, dtype='float')
+        v = self._values
+        s = self._bank.derivatives(x)['x'].sum(axis=0)
+        if v['N'] > 0:
+            for i in range(1, int(v['N']) + 1):
+                d = self._bank.derivatives(x - i * v['Offset'])['x'].sum(axis=0)
+                s = s + (v['Poisson'] ** i) * d / math.factorial(i)
+        s = (v['Scale'] * s).reshape(x.shape)
+        mask = self.roi_mask(x)
+        if mask is not None:
+            s = s * mask
+        background_params = [v['Background' + str(int(deg))] for deg in reversed(list(range(self.background_degree + 1)))]
+        return s + np.polyval(np.polyder(background_params), x)
+
+    def jacobian(self, x):
+        """Jacobian of the response with respect to the varying parameters,
+        in the order of :attr:`params`. The derivatives of the profiles are
+        chained analytically through the peak locations, amplitudes,
+        widths, sidepeaks and background, and through the expressions
+        between the parameters. Parameters without an analytical
+        derivative (such as the tail parameters of the Crystalball shape)
+        use central differences.
+
+        Parameters
+        ----------
+        x: array_like
+            Frequencies in MHz.
+
+        Returns
+        -------
+        NumPy array
+            Array with a row for each value of *x* and a column
+            for each varying parameter."""
+        if self.binned:
+            return super(HFSModel, self).jacobian(x)
+        self._check_values()
+        x = np.asarray(x, dtype='float').ravel()
+        params = self.params
+        prefix = self._prefix
+        scale = params['Scale'].value
+        n = int(params['N'].value)
+        poisson = params['Poisson'].value if n > 0 else 0
+        offset = params['Offset'].value if n > 0 else 0
+
+        # Sum the derivatives of the profiles over the sidepeaks
+        derivatives = {}
+        sidepeaks = []
+        doffset = 0
+        for i in range(n + 1):
+            d = self._bank.derivatives(x - i * offset)
+            factor = poisson ** i / math.factorial(i)
+            for key, value in d.items():
+                derivatives[key] = derivatives.get(key, 0) + factor * value
+            sidepeaks.append(d['value'].sum(axis=0))
+            doffset = doffset - i * factor * d['x'].sum(axis=0)
+
+        direct = {prefix + 'Scale': derivatives['value'].sum(axis=0)}
+        if n > 0:
+            direct[prefix + 'Poisson'] = scale * sum([i * poisson ** (i - 1) * s / math.factorial(i) for i, s in enumerate(sidepeaks) if i > 0])
+            direct[prefix + 'Offset'] = scale * doffset
+
+        # Hyperfine parameters and centroid, through the transition locations
+        low, high = np.array(self.transition_indices).T
+        dmu = scale * derivatives['mu']
+        coefficients = {'Al': -self.C[low], 'Au': self.C[high],
+                        'Bl': -self.D[low], 'Bu': self.D[high],
+                        'Cl': -self.E[low], 'Cu': self.E[high],
+                        'Centroid': np.ones(len(low))}
+        for name, coefficient in coefficients.items():
+            direct[prefix + name] = coefficient.dot(dmu)
+
+        # Amplitudes, either free or through the saturation
+        damp = scale * derivatives['amp']
+        for label, row in zip(self.ftof, damp):
+            direct[prefix + 'Amp' + label] = 0 if self.use_racah or self.use_saturation else row
+        if self.use_saturation:
+            direct[prefix + 'Saturation'] = self._saturation_derivative(params['Saturation'].value).dot(damp)
+
+        # Widths
+        if self.shape == 'voigt':
+            keys = (('fwhmG', 'FWHMG'), ('fwhmL', 'FWHML'))
+            labels = [''] if self.shared_fwhm else self.ftof
+            for label in labels:
+                direct[prefix + 'TotalFWHM' + label] = 0
+        else:
+            keys = (('fwhm', 'FWHM'),)
+        for key, name in keys:
+            if self.shared_fwhm:
+                direct[prefix + name] = scale * derivatives[key].sum(axis=0)
+            else:
+                for label, row in zip(self.ftof, derivatives[key]):
+                    direct[prefix + name + label] = scale * row
+
+        # Outside of the region of interest, only the background contributes
+        mask = self.roi_mask(x)
+        if mask is not None:
+            direct = dict([(name, value * mask) for name, value in direct.items()])
+        for i in range(self.background_degree + 1):
+            direct[prefix + 'Background' + str(i)] = x ** i
+
+        # Chain through the expressions to the varying parameters
+        names, chain = self._parameter_derivatives()
+        jacobian = np.zeros((x.size, len(names)))
+        for name, row in chain.items():
+            if not np.any(row):
+                continue
+            if name not in direct:
+                direct[name] = self._numerical_derivative(name, x)
+            jacobian += np.outer(direct[name], row)
+        return jacobian
+
+    def _saturation_derivative(self, s):
+        # Derivative of the transitional intensities with respect to the saturation
+        if s <= 0:
+            return np.zeros(len(self.racah_amplitudes))
+        sat = self.saturated_amplitudes
+        rac = self.racah_amplitudes
+        transitional = -sat*np.expm1(-rac * s / sat)
+        derivative = rac * np.exp(-rac * s / sat)
+        m = transitional.argmax()
+        return (derivative * transitional[m] - transitional * derivative[m]) / transitional[m] ** 2
+
+    def linear_parameters(self):
+        """Names of the varying parameters which enter the response linearly:
+        the coefficients of the background, and either the free amplitudes
+        or the scale when the amplitudes are fixed by the Racah intensities
+        or the saturation.
+
+        Returns
+        -------
+        list of str"""
+        names = ['Background' + str(i) for i in range(self.background_degree + 1)]
+        amplitudes = ['Amp' + label for label in self.ftof]
+        if not (self.use_racah or self.use_saturation) and any([self.params[self._prefix + name].vary for name in amplitudes]):
+            names.extend(amplitudes)
         else:
-            s = self.params['Scale'].value * sum([prof(x) for prof in self.parts])
-        # background_params = [self.params[par_name].value for par_name in self.params if par_name.startswith('Background')]
-        background_params = [self.params['Background' + str(int(deg))].value for deg in reversed(list(range(self.background_degree + 1)))]
-        return s + np.polyval(background_params, x)
+            names.append('Scale')
+        return self._independent_parameters([self._prefix + name for name in names])
+
+    def linear_basis(self, x, names):
+        """Splits the response in the contributions of the given linear
+        parameters and the remainder, see :meth:`.BaseModel.linear_basis`.
+        The profiles are evaluated once with unit amplitude.
+
+        Parameters
+        ----------
+        x: array_like
+            Frequencies in MHz.
+        names: list of str
+            Names of the linear parameters, see :meth:`linear_parameters`.
+
+        Returns
+        -------
+        basis, rest: NumPy arrays"""
+        if self.binned:
+            return super(HFSModel, self).linear_basis(x, names)
+        x = np.asarray(x, dtype='float').ravel()
+        v = self._values
+        shapes = 0
+        for i in range(int(v['N']) + 1):
+            factor = v.get('Poisson', 0) ** i / math.factorial(i)
+            shapes = shapes + factor * self._bank.shapes(x - i * v.get('Offset', 0))
+        mask = self.roi_mask(x)
+        if mask is not None:
+            shapes = shapes * mask
+        amplitudes = np.array([part.amp for part in self.parts], dtype='float')
+        columns = {'Scale': amplitudes.dot(shapes)}
+        for label, row in zip(self.ftof, shapes):
+            columns['Amp' + label] = v['Scale'] * row
+        background = [v['Background' + str(deg)] for deg in reversed(list(range(self.background_degree + 1)))]
+        for deg in range(self.background_degree + 1):
+            columns['Background' + str(deg)] = x ** deg
+        n = len(self._prefix)
+        basis = np.zeros((x.size, len(names)))
+        for i, name in enumerate(names):
+            basis[:, i] = columns[name[n:]]
+        response = v['Scale'] * columns['Scale'] + np.polyval(background, x)
+        return basis, response - basis.dot([v[name[n:]] for name in names])
+
+    def _flat(self):
+        self._check_values()
+        if self._values['N'] > 0 or self.binned or self._roi is not None:
+            return None
+        if not self._bank._uniform or self.tolerance is not None:
+            return None
+        background = [self._values['Background' + str(deg)] for deg in range(self.background_degree + 1)]
+        return self._bank._template, self._values['Scale'], background
+
+    def _batch_size(self, x):
+        return len(self.parts) * (int(self._values['N']) + 1) * np.size(x)
+
+    def _batch_response(self, values, x):
+        # Binned data, crystalball profiles (which can not broadcast their
+        # tail parameters), mixed Voigt backends and a region of interest
+        # are evaluated set by set.
+        if self.binned or self.shape.lower() == 'crystalball' or not self._bank._uniform or self.roi is not None:
+            return super(HFSModel, self)._batch_response(values, x)
+        return self._vectorized_response(values, x)
+
+    def _vectorized_response(self, values, x):
+        # The energies, locations, amplitudes and widths are calculated as
+        # arrays with a row per set of parameters. The profiles of all sets
+        # are then evaluated by a single template with parameters of
+        # shape (sets, peaks, 1).
+        n = len(self._prefix)
+        v = dict([(key[n:], np.asarray(value, dtype='float')[:, np.newaxis]) for key, value in values.items() if key.startswith(self._prefix)])
+        lower, upper = np.ones(self.num_lower), np.ones(self.num_upper)
+        def levels(l, u):
+            return np.hstack([v[l] * lower, v[u] * upper])
+        energies = np.hstack([0 * v['Centroid'] * lower, v['Centroid'] * upper])
+        energies = energies + self.C * levels('Al', 'Au') + self.D * levels('Bl', 'Bu') + self.E * levels('Cl', 'Cu')
+        low, high = np.array(self.transition_indices).T
+        locations = energies[:, high] - energies[:, low]
+
+        if not self.use_racah and not self.use_saturation:
+            amplitudes = np.hstack([v['Amp' + label] for label in self.ftof])
+        elif self.use_saturation:
+            amplitudes = np.vstack([self._calculate_transitional_intensities(s) for s in v['Saturation'][:, 0]])
+        else:
+            amplitudes = np.array([part.amp for part in self.parts]) * np.ones(locations.shape)
+
+        labels = [''] * len(self.ftof) if self.shared_fwhm else self.ftof
+        def per_peak(name):
+            return np.hstack([v[name + label] for label in labels])[:, :, np.newaxis]
+
+        template = copy.deepcopy(self._bank._template)
+        if self.shape.lower() == 'pseudovoigt':
+            template.n = per_peak('Eta')
+            template.a = per_peak('Asym')
+        elif self.shape.lower() == 'asymmlorentzian':
+            template.asymm = per_peak('Asym')
+        if self.shape.lower() == 'voigt':
+            template.fwhm = np.array([per_peak('FWHMG'), per_peak('FWHML')])
+        else:
+            template.fwhm = per_peak('FWHM')
+        template.mu = locations[:, :, np.newaxis]
+        template.amp = amplitudes[:, :, np.newaxis]
+
+        x = np.asarray(x, dtype='float').ravel()
+        N = int(self._values['N'])
+        s = template(x[np.newaxis, np.newaxis, :]).sum(axis=1)
+        for i in range(1, N + 1):
+            offset = i * v['Offset'][:, :, np.newaxis]
+            s = s + (v['Poisson'] ** i) * template(x[np.newaxis, np.newaxis, :] - offset).sum(axis=1) / math.factorial(i)
+        background = sum([v['Background' + str(deg)] * x ** deg for deg in range(self.background_degree + 1)])
+        return v['Scale'] * s + background
+
+    def _sidepeaks(self, x):
+        # Summed response of the peaks and all sidepeaks.
+        n = int(self._values['N'])
+        weights = np.array([self._values['Poisson'] ** i / math.factorial(i) for i in range(n + 1)])
+        offsets = np.arange(n + 1) * self._values['Offset']
+        if self.sidepeak_method == 'interpolate':
+            s = self._interpolated_sidepeaks(x, weights, offsets)
+            if s is not None:
+                return s
+        elif self.sidepeak_method == 'exact':
+            return sum([w * self._peaks(x, offset) for w, offset in zip(weights, offsets)])
+        x = np.asarray(x, dtype='float')
+        shifted = x[np.newaxis] - offsets.reshape((-1,) + (1,) * x.ndim)
+        if self.binned:
+            response = self._bank.integrate(shifted[:, :-1], shifted[:, 1:]) / np.diff(x)
+        else:
+            response = self._bank(shifted)
+        return np.tensordot(weights, response, axes=1)
+
+    def _interpolated_sidepeaks(self, x, weights, offsets):
+        # Sidepeaks interpolated from the main spectrum on an extended
+        # grid. Returns None if the grid is not suited.
+        x = np.asarray(x, dtype='float')
+        if x.ndim != 1 or x.size < 4:
+            return None
+        step = x[1] - x[0]
+        if step <= 0 or not np.allclose(np.diff(x), step, rtol=1e-6, atol=0):
+            return None
+        # Grid points needed below and above the data, with some margin for the spline
+        below = int(np.ceil(max(offsets.max(), 0) / step)) + 2
+        above = int(np.ceil(max(-offsets.min(), 0) / step)) + 2
+        if below + above > x.size * (len(offsets) - 1):
+            return None
+        grid = x[0] + step * np.arange(-below, x.size + above)
+        grid[below:below + x.size] = x
+        if self.binned:
+            main = self._bank.integrate(grid[:-1], grid[1:])
+            spline = interpolate.CubicSpline(grid, np.concatenate([[0], np.cumsum(main)]))
+            s = weights[0] * main[below:below + x.size - 1] / np.diff(x)
+            for w, offset in zip(weights[1:], offsets[1:]):
+                s += w * np.diff(spline(x - offset)) / np.diff(x)
+        else:
+            main = self._bank(grid)
+            spline = interpolate.CubicSpline(grid, main)
+            s = weights[0] * main[below:below + x.size]
+            for w, offset in zip(weights[1:], offsets[1:]):
+                s += w * spline(x - offset)
+        return s
+
+    def _peaks(self, x, offset=0):
+        # Summed response of the peaks, either in the given points
+        # or averaged over the bins with the given edges.
+        if self.binned:
+            x = np.asarray(x, dtype='float') - offset
+            return self._bank.integrate(x[:-1], x[1:]) / np.diff(x)
+        return self._bank(x - offset)
 
     ###############################
     #      PLOTTING ROUTINES      #
@@ -683,6 +1590,19 @@ class HFSModel(BaseModel):
         fig, ax: matplotlib figure and axis
             Figure and axis used for the plotting."""
 
+        import matplotlib.pyplot as plt
+
+        if self.binned:
+            # Data is given with the bin edges, the spectrum
+            # is plotted as the response in single points.
+            if x is not None:
+                x = 0.5 * (x[1:] + x[:-1])
+            self.binned = False
+            try:
+                return self.plot(x=x, y=y, yerr=yerr, no_of_points=no_of_points, ax=ax, show=show, plot_kws=plot_kws)
+            finally:
+                self.binned = True
+
         kws = copy.deepcopy(plot_kws)
         legend = kws.pop('legend', None,)
         data_legend = kws.pop('data_legend', None)
@@ -827,6 +1747,7 @@ class HFSModel(BaseModel):
         -------
         tuple
             Tuple containing the figure and both axes, also in a tuple."""
+        import matplotlib.pyplot as plt
         from fractions import Fraction
         from matplotlib import lines
         length_plot = 0.4
@@ -7,9 +7,8 @@ Implementation of a class for the simultaneous fitting of hyperfine structure sp
 import copy
 
 import lmfit as lm
-from satlas.models.basemodel import BaseModel
+from satlas.models.basemodel import BaseModel, SATLASParameters
 from satlas.utilities import poisson_interval
-import matplotlib.pyplot as plt
 import numpy as np
 
 __all__ = ['LinkedModel']
@@ -28,6 +27,12 @@ class LinkedModel(BaseModel):
             A list defining the different models."""
         super(LinkedModel, self).__init__()
         self.models = models
+        # Values of the parameters of each submodel used in its last response,
+        # the input and the position of each response in the output.
+        self._last_values = [None for _ in models]
+        self._last_input = [None for _ in models]
+        self._buffer = None
+        self._slices = None
         for i, model in enumerate(self.models):
             model._add_prefix('s' + str(i) + '_')
         self._set_params()
@@ -44,6 +49,7 @@ class LinkedModel(BaseModel):
     def _add_prefix(self, value):
         for model in self.models:
             model._add_prefix(value)
+        self._prefix = value + self._prefix
         self._set_params()
 
     def get_chisquare_mapping(self):
@@ -79,10 +85,65 @@ class LinkedModel(BaseModel):
 
     @params.setter
     def params(self, params):
+        # The submodels hold the same Parameter objects instead of copies
         self._parameters = params.copy()
+        self._set_names()
         for spec in self.models:
-            spec.params = self._parameters.copy()
-            spec._parameters._prefix = spec._prefix
+            spec._share_parameters(self._parameters)
+        self._values_changed(dict([(name, par.value) for name, par in self._parameters.items()]))
+
+    def _share_parameters(self, params):
+        self._parameters = SATLASParameters.view(params, self._prefix)
+        self._set_names()
+        for model in self.models:
+            model._share_parameters(params)
+
+    def _set_names(self):
+        # Names of the parameters of each submodel.
+        self._names = [[name for name in self._parameters if name.startswith(spec._prefix)] for spec in self.models]
+
+    def _values_changed(self, values):
+        # Only the submodels of which a value changed are updated,
+        # and their last response is no longer used.
+        for i, model in enumerate(self.models):
+            own = dict([(name, values[name] if name in values else self._parameters[name].value) for name in self._names[i]])
+            if own != self._last_values[i]:
+                self._last_values[i] = own
+                self._last_input[i] = None
+                model._values_changed(own)
+
+    def _fresh(self):
+        return all([model._fresh() for model in self.models])
+
+    def _set_values(self, values):
+        # The values are assigned once to the shared parameters, the
+        # submodels only recalculate what depends on the changed values.
+        for name, value in values.items():
+            self._parameters[name].value = value
+        self._values_changed(values)
+
+    def __deepcopy__(self, memo):
+        # The copied submodels share the copied parameters again.
+        model = self.__class__.__new__(self.__class__)
+        memo[id(self)] = model
+        for key, value in self.__dict__.items():
+            model.__dict__[key] = copy.deepcopy(value, memo)
+        for submodel in model.models:
+            submodel._share_parameters(model._parameters)
+        return model
+
+    @property
+    def workspace(self):
+        """:class:`.Workspace` with the arrays used when the model is called
+        with the same list of arrays. Each submodel uses the workspace
+        of its own array, see :attr:`.Workspace.parts`."""
+        return self._workspace
+
+    @workspace.setter
+    def workspace(self, value):
+        self._workspace = value
+        for i, model in enumerate(self.models):
+            model.workspace = None if value is None else value.parts[i]
 
     def seperate_response(self, x):
         """Generates the response for each subspectrum.
@@ -102,6 +163,50 @@ class LinkedModel(BaseModel):
         return np.squeeze([s(X)
                            for s, X in zip(self.models, x)])
 
+    def linear_parameters(self):
+        """Names of the varying parameters which enter the response linearly,
+        gathered from the submodels.
+
+        Returns
+        -------
+        list of str"""
+        return self._independent_parameters([name for model in self.models for name in model.linear_parameters()])
+
+    def linear_basis(self, x, names):
+        """Splits the response in the contributions of the given linear
+        parameters and the remainder, see :meth:`.BaseModel.linear_basis`.
+        Each submodel supplies the rows of its own data and the
+        columns of its own parameters.
+
+        Parameters
+        ----------
+        x: list of arrays
+            A list equal in length to the number of submodels.
+        names: list of str
+            Names of the linear parameters, see :meth:`linear_parameters`.
+
+        Returns
+        -------
+        basis, rest: NumPy arrays"""
+        bases, rests = [], []
+        for model, X in zip(self.models, x):
+            own = [name for name in names if name.startswith(model._prefix)]
+            b, r = model.linear_basis(X, own)
+            columns = np.zeros((r.size, len(names)))
+            columns[:, [names.index(name) for name in own]] = b
+            bases.append(columns)
+            rests.append(r)
+        return np.vstack(bases), np.hstack(rests)
+
+    def _leaves(self, path):
+        return [leaf for i, model in enumerate(self.models) for leaf in model._leaves(path + (i,))]
+
+    def _batch_size(self, x):
+        return sum([model._batch_size(X) for model, X in zip(self.models, x)])
+
+    def _batch_response(self, values, x):
+        return np.hstack([model._batch_response(values, X) for model, X in zip(self.models, x)])
+
     ###############################
     #      PLOTTING ROUTINES      #
     ###############################
@@ -134,6 +239,8 @@ class LinkedModel(BaseModel):
         -------
         fig, ax: matplotlib figure and axis
             Figure and axis used for the plotting."""
+        import matplotlib.pyplot as plt
+
         if ax is None:
             fig, ax = plt.subplots(len(self.models), 1, sharex=linked)
             height = fig.get_figheight()
@@ -231,7 +338,7 @@ class LinkedModel(BaseModel):
             return_object = super(LinkedModel, self).__add__(other)
         return return_object
 
-    def __call__(self, x):
+    def __call__(self, x, out=None):
         """Pass the seperate frequency arrays to the submodels,
         and return their response values as a list of arrays.
 
@@ -240,8 +347,49 @@ class LinkedModel(BaseModel):
         x : list of floats or array_likes
             Frequency in MHz
 
+        Other parameters
+        ----------------
+        out: NumPy array, optional
+            Array with the shape of the combined response, in
+            which the response is written.
+
         Returns
         -------
         list of floats or NumPy arrays
             Response of each spectrum for each seperate value in *x*."""
-        return np.hstack([s(X) for s, X in zip(self.models, x)])
+        # The responses are kept in a buffer, in which only the submodels with
+        # changed values or input are evaluated again.
+        if self._buffer is None or len(x) != len(self.models):
+            self._buffer = None
+            self._last_input = [None for _ in self.models]
+        responses = []
+        for i, (model, X) in enumerate(zip(self.models, x)):
+            last = self._last_input[i]
+            if last is not None and model._fresh() and (last is X or (isinstance(X, np.ndarray) and np.array_equal(X, last))):
+                responses.append(self._buffer[self._slices[i]])
+            else:
+                responses.append(np.atleast_1d(model(X)))
+                self._last_input[i] = self._remember(i, X)
+        if self._buffer is None or any([r.shape != self._buffer[s].shape for r, s in zip(responses, self._slices)]):
+            # The size of a response changed, the buffer is created again.
+            stops = np.cumsum([r.size for r in responses])
+            self._slices = [slice(stop - r.size, stop) for r, stop in zip(responses, stops)]
+            self._buffer = np.concatenate(responses)
+        else:
+            for response, s in zip(responses, self._slices):
+                if response.base is not self._buffer:
+                    self._buffer[s] = response
+        if out is not None:
+            out[...] = self._buffer
+            return out
+        return self._buffer.copy()
+
+    def _remember(self, i, X):
+        # Input of the last response of a submodel. The array of a
+        # workspace is not changed, so it is not copied.
+        if not isinstance(X, np.ndarray):
+            return None
+        workspace = self._workspace
+        if workspace is not None and len(workspace.parts) > i and X is workspace.parts[i].x:
+            return X
+        return X.copy()
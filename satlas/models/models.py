@@ -57,8 +57,20 @@ class PolynomialModel(BaseModel):
     #      MAGIC METHODS      #
     ###########################
 
-    def __call__(self, x):
-        return np.polyval([self.params[p].value for p in self.names], x)
+    def __call__(self, x, out=None):
+        response = np.polyval([self.params[p].value for p in self.names], x)
+        if out is not None:
+            out[...] = response
+            return out
+        return response
+
+    def _batch_response(self, values, x):
+        x = np.asarray(x, dtype='float').ravel()
+        coefficients = [values[p] if p in values else values[self._prefix + p] for p in self.names]
+        response = np.zeros((len(coefficients[0]), x.size))
+        for coefficient in coefficients:
+            response = response * x + np.asarray(coefficient)[:, np.newaxis]
+        return response
 
 class MiscModel(BaseModel):
 
@@ -131,5 +143,9 @@ class MiscModel(BaseModel):
     #      MAGIC METHODS      #
     ###########################
 
-    def __call__(self, x):
-        return self.func(x, [self.params[p].value for p in self.names])
+    def __call__(self, x, out=None):
+        response = self.func(x, [self.params[p].value for p in self.names])
+        if out is not None:
+            out[...] = response
+            return out
+        return response
@@ -5,9 +5,8 @@ Implementation of a class for the analysis of hyperfine structure spectra with i
 .. moduleauthor:: Ruben de Groote <ruben.degroote@kuleuven.be>
 """
 import copy
-from satlas.models.basemodel import BaseModel
+from satlas.models.basemodel import BaseModel, SATLASParameters
 from satlas.utilities import poisson_interval
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -44,6 +43,7 @@ class SumModel(BaseModel):
     def _add_prefix(self, value):
         for model in self.models:
             model._add_prefix(value)
+        self._prefix = value + self._prefix
         self._set_params()
 
     def get_chisquare_mapping(self):
@@ -79,9 +79,52 @@ class SumModel(BaseModel):
 
     @params.setter
     def params(self, params):
+        # The submodels hold the same Parameter objects instead of copies
         self._parameters = params.copy()
         for spec in self.models:
-            spec.params = self._parameters.copy()
+            spec._share_parameters(self._parameters)
+        self._values_changed(dict([(name, par.value) for name, par in self._parameters.items()]))
+
+    def _share_parameters(self, params):
+        self._parameters = SATLASParameters.view(params, self._prefix)
+        for model in self.models:
+            model._share_parameters(params)
+
+    def _values_changed(self, values):
+        for model in self.models:
+            model._values_changed(values)
+
+    def _fresh(self):
+        return all([model._fresh() for model in self.models])
+
+    def _set_values(self, values):
+        # The values are assigned once to the shared parameters, the
+        # submodels only recalculate what depends on the changed values.
+        for name, value in values.items():
+            self._parameters[name].value = value
+        self._values_changed(values)
+
+    def __deepcopy__(self, memo):
+        # The copied submodels share the copied parameters again.
+        model = self.__class__.__new__(self.__class__)
+        memo[id(self)] = model
+        for key, value in self.__dict__.items():
+            model.__dict__[key] = copy.deepcopy(value, memo)
+        for submodel in model.models:
+            submodel._share_parameters(model._parameters)
+        return model
+
+    @property
+    def workspace(self):
+        """:class:`.Workspace` with the arrays used when the model is
+        called with the same *x*, shared with the submodels."""
+        return self._workspace
+
+    @workspace.setter
+    def workspace(self, value):
+        self._workspace = value
+        for model in self.models:
+            model.workspace = value
 
     def seperate_response(self, x, background=False):
         """Get the response for each seperate spectrum for the values *x*,
@@ -105,6 +148,48 @@ class SumModel(BaseModel):
         background_vals = [np.polyval([s.params[par_name].value for par_name in s.params if par_name.startswith('Background')], x) for s in self.models]
         return [s(x) - b * (1-background) for s, b in zip(self.models, background_vals)]
 
+    def linear_parameters(self):
+        """Names of the varying parameters which enter the response linearly,
+        gathered from the submodels.
+
+        Returns
+        -------
+        list of str"""
+        return self._independent_parameters([name for model in self.models for name in model.linear_parameters()])
+
+    def linear_basis(self, x, names):
+        """Splits the response in the contributions of the given linear
+        parameters and the remainder, see :meth:`.BaseModel.linear_basis`.
+        Each submodel supplies the columns of its own parameters.
+
+        Parameters
+        ----------
+        x: array_like
+            Frequencies in MHz.
+        names: list of str
+            Names of the linear parameters, see :meth:`linear_parameters`.
+
+        Returns
+        -------
+        basis, rest: NumPy arrays"""
+        basis, rest = 0, 0
+        for model in self.models:
+            own = [name for name in names if name.startswith(model._prefix)]
+            b, r = model.linear_basis(x, own)
+            columns = np.zeros((r.size, len(names)))
+            columns[:, [names.index(name) for name in own]] = b
+            basis, rest = basis + columns, rest + r
+        return basis, rest
+
+    def _leaves(self, path):
+        return [leaf for model in self.models for leaf in model._leaves(path)]
+
+    def _batch_size(self, x):
+        return sum([model._batch_size(x) for model in self.models])
+
+    def _batch_response(self, values, x):
+        return np.sum([model._batch_response(values, x) for model in self.models], axis=0)
+
     ###############################
     #      PLOTTING ROUTINES      #
     ###############################
@@ -159,6 +244,8 @@ class SumModel(BaseModel):
         Returns
         -------
         fig, ax: matplotlib figure and axes"""
+        import matplotlib.pyplot as plt
+
         if ax is None:
             fig, ax = plt.subplots(1, 1)
         else:
@@ -276,7 +363,7 @@ class SumModel(BaseModel):
             except:
                 raise TypeError('unsupported operand type(s)')
 
-    def __call__(self, x):
+    def __call__(self, x, out=None):
         """Get the response for frequency *x* (in MHz) of the spectrum.
 
         Parameters
@@ -284,8 +371,17 @@ class SumModel(BaseModel):
         x : float or array_like
             Frequency in MHz
 
+        Other parameters
+        ----------------
+        out: NumPy array, optional
+            Array with the shape of the response, in
+            which the response is written.
+
         Returns
         -------
         float or NumPy array
             Response of the spectrum for each value of *x*."""
-        return np.sum([s(x) for s in self.models], axis=0)
+        response = self.models[0](x, out=out)
+        for model in self.models[1:]:
+            response = np.add(response, model(x), out=out)
+        return response
@@ -4,6 +4,9 @@ to the higher class. Currently only supports HFSModel.
 
 .. moduleauthor:: Wouter Gins <wouter.gins@kuleuven.be>
 """
+from collections import OrderedDict
+
+import numpy as np
 from satlas.models.hfsmodel import HFSModel
 
 __all__ = ['TransformHFSModel']
@@ -11,6 +14,81 @@ __all__ = ['TransformHFSModel']
 def identity(*args):
     return args[0]
 
+class TransformCache(object):
+
+    """Wraps a transformation of the input and remembers the results
+    for the last arrays that were transformed. An array is recognized by
+    its content, so changing the values of an array in place is detected.
+    Read-only arrays, such as the results of the cache itself, are
+    recognized by their identity without comparing the content.
+    The other arguments are part of the key, as is the *version* attribute
+    of the transformation if it has one (see :class:`.ScanConversion`),
+    which should change whenever the parameters of the transformation
+    change. The results are read-only."""
+
+    def __init__(self, func, maxsize=8):
+        """Parameters
+        ----------
+        func: callable
+            Transformation, called with the input array and the
+            other arguments.
+        maxsize: int, optional
+            Number of results that are kept, the least recently used
+            result is removed first. Defaults to 8."""
+        super(TransformCache, self).__init__()
+        self.func = func
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._last = None
+
+    @property
+    def version(self):
+        """Version of the transformation, *None* if it has no *version*."""
+        return getattr(self.func, 'version', None)
+
+    def __call__(self, x, *args, **kwargs):
+        if not isinstance(x, np.ndarray):
+            return self.func(x, *args, **kwargs)
+        arguments = (self.version, args, tuple(sorted(kwargs.items())))
+        frozen = _read_only(x)
+        last = self._last
+        if frozen and last is not None and last[0] is x and last[1] == arguments:
+            return last[2]
+        key = (x.shape, x.dtype.str, hash(x.tobytes())) + arguments
+        try:
+            entry = self._entries.get(key)
+        except TypeError:
+            # Unhashable arguments are not cached
+            return self.func(x, *args, **kwargs)
+        if entry is not None and np.array_equal(entry[0], x):
+            self._entries.move_to_end(key)
+            result = entry[1]
+        else:
+            result = self.func(x, *args, **kwargs)
+            if not isinstance(result, np.ndarray):
+                return result
+            result = np.array(result)
+            result.setflags(write=False)
+            self._entries[key] = (x.copy(), result)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        if frozen:
+            self._last = (x, arguments, result)
+        return result
+
+    def clear(self):
+        """Removes all remembered results."""
+        self._entries.clear()
+        self._last = None
+
+def _read_only(x):
+    # True if neither the array nor the arrays it is a view of can be changed.
+    while isinstance(x, np.ndarray):
+        if x.flags.writeable:
+            return False
+        x = x.base
+    return True
+
 class TransformHFSModel(HFSModel):
     """Create an HFSModel that applies both a pre-processing
     transformation on the input data and a post-processing
@@ -31,19 +109,25 @@ class TransformHFSModel(HFSModel):
 
     @property
     def pre_transform(self):
-        """The transformation function to be applied to the input data. Wrapping
-        with the *functools.lru_cache* function is attempted, and non-callable
-        objects raise an error when assigned to :attr:`.pre_transform`."""
+        """The transformation function to be applied to the input data.
+        The function is wrapped in a :class:`.TransformCache`, so the same
+        input is only transformed once. Assigning a new function clears
+        the cache. Changes to a :class:`.ScanConversion`, or any function
+        with a *version* attribute, are detected by the cache; if the function
+        depends on other values that are changed elsewhere, call
+        :meth:`.TransformCache.clear` after changing them. During a fit,
+        the transformed data is kept in the :attr:`workspace`.
+        Non-callable objects raise an error when assigned to
+        :attr:`.pre_transform`."""
         return self._pre_transform
 
     @pre_transform.setter
     def pre_transform(self, func):
         if callable(func):
-            try:
-                from functool import lru_cache
-                self._pre_transform = lru_cache(maxsize=512, typed=True)(func)
-            except:
-                self._pre_transform = func
+            if isinstance(func, TransformCache):
+                func = func.func
+            self._pre_transform = TransformCache(func)
+            self._response = None
         else:
             raise TypeError('supplied value must be a callable!')
 
@@ -73,4 +157,26 @@ class TransformHFSModel(HFSModel):
         return to_return
 
     def __call__(self, *args, **kwargs):
-        return self._post_transform(super(TransformHFSModel, self).__call__(self._pre_transform(*args, **kwargs)), *args, **kwargs)
+        out = kwargs.pop('out', None)
+        response = self._post_transform(super(TransformHFSModel, self).__call__(self._transformed(*args, **kwargs)), *args, **kwargs)
+        if out is not None:
+            out[...] = response
+            return out
+        return response
+
+    def _transformed(self, *args, **kwargs):
+        # The transformation of the array of the workspace is kept in the
+        # workspace, as the array is not changed during the fit.
+        workspace = self._workspace_for(args[0]) if len(args) == 1 and not kwargs else None
+        if workspace is None:
+            return self._pre_transform(*args, **kwargs)
+        transform = self._pre_transform
+        key = ('pre_transform', id(self), transform, getattr(transform, 'version', None))
+        return workspace.array(key, lambda: transform(args[0]))
+
+    def _flat(self):
+        # The transformations are applied by calling the model
+        return None
+
+    def _vectorized_response(self, values, x):
+        return self._post_transform(super(TransformHFSModel, self)._vectorized_response(values, self._pre_transform(x)), x)
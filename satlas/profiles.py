@@ -5,19 +5,195 @@ Implementation of classes for different lineshapes, creating callables for easy
 .. moduleauthor:: Ruben de Groote <ruben.degroote@kuleuven.be>
 .. moduleauthor:: Kara Marie Lynch <kara.marie.lynch@cern.ch>
 """
+import collections
+import copy
+
 import numpy as np
-from scipy.special import wofz
+from scipy.special import erf, wofz
 
-__all__ = ['Gaussian', 'Lorentzian', 'Voigt', 'PseudoVoigt', 'Crystalball', 'AsymmLorentzian']
+__all__ = ['Gaussian', 'Lorentzian', 'Voigt', 'PseudoVoigt', 'Crystalball', 'AsymmLorentzian', 'ProfileBank']
 sqrt2 = 2 ** 0.5
 sqrt2pi = (2 * np.pi) ** 0.5
+sqrtpi = np.pi ** 0.5
 sqrt2log2t2 = 2 * np.sqrt(2 * np.log(2))
 base_e = np.exp(1)
+_gauss_legendre = np.polynomial.legendre.leggauss(4)
+
+
+#######################################
+# APPROXIMATIONS OF THE VOIGT PROFILE #
+#######################################
+
+# All functions take the real and imaginary part of the argument of the
+# Faddeeva function w(u + ia), with a >= 0, and return the real part.
+
+def _faddeeva_wofz(u, a):
+    return wofz(u + 1j * a).real
+
+def _faddeeva_asymptotic(u, a):
+    # Four-term asymptotic expansion, valid for large |u + ia|
+    t = 1 / (u + 1j * a)
+    s = t * t
+    return (1j * t * (1 + s * (0.5 + s * (0.75 + s * 1.875)))).real / sqrtpi
+
+def _faddeeva_humlicek(u, a):
+    # Humlicek, JQSRT 27 (1982) 437, algorithm W4. The outer region is
+    # written out in real arithmetic, the other regions only
+    # have to be evaluated close to the peak.
+    u, a = np.broadcast_arrays(np.asarray(u, dtype='float'), np.asarray(a, dtype='float'))
+    u2 = u * u
+    a2 = a * a
+    b = 0.5 + a2 - u2
+    w = np.asarray(0.5641896 * a * (0.5 + a2 + u2) / (b * b + 4 * u2 * a2))
+    s = np.abs(u) + a
+    inner = s < 15
+    if inner.any():
+        t = a[inner] - 1j * u[inner]
+        s = s[inner]
+        v = t * t
+        inner_w = np.zeros(t.shape, dtype='complex')
+        region = s >= 5.5
+        tt, vv = t[region], v[region]
+        inner_w[region] = tt * (1.410474 + vv * 0.5641896) / (0.75 + vv * (3 + vv))
+        region = (s < 5.5) & (t.real >= 0.195 * np.abs(t.imag) - 0.176)
+        tt = t[region]
+        inner_w[region] = (16.4955 + tt * (20.20933 + tt * (11.96482 + tt * (3.778987 + tt * 0.5642236)))) / \
+                          (16.4955 + tt * (38.82363 + tt * (39.27121 + tt * (21.69274 + tt * (6.699398 + tt)))))
+        region = (s < 5.5) & ~region
+        tt, vv = t[region], v[region]
+        inner_w[region] = np.exp(vv) - tt * (36183.31 - vv * (3321.9905 - vv * (1540.787 - vv * (219.0313 - vv * (35.76683 - vv * (1.320522 - vv * 0.56419)))))) / \
+                          (32066.6 - vv * (24322.84 - vv * (9022.228 - vv * (2186.181 - vv * (364.2191 - vv * (61.57037 - vv * (1.841439 - vv)))))))
+        w[inner] = inner_w.real
+    return w[()]
+
+def _weideman_coefficients(N):
+    # Weideman, SIAM J. Numer. Anal. 31 (1994) 1497
+    M = 2 * N
+    k = np.arange(-M + 1, M)
+    L = np.sqrt(N / np.sqrt(2))
+    t = L * np.tan(k * np.pi / (2 * M))
+    f = np.concatenate([[0], np.exp(-t ** 2) * (L ** 2 + t ** 2)])
+    c = np.real(np.fft.fft(np.fft.fftshift(f))) / (2 * M)
+    return L, c[1:N + 1][::-1]
+
+_weideman_L, _weideman_c = _weideman_coefficients(32)
+
+def _faddeeva_weideman(u, a):
+    # 32-term rational approximation close to the peak,
+    # asymptotic expansion further away.
+    u, a = np.broadcast_arrays(np.asarray(u, dtype='float'), np.asarray(a, dtype='float'))
+    w = np.empty(u.shape)
+    outer = u * u + a * a >= 64
+    w[outer] = _faddeeva_asymptotic(u[outer], a[outer])
+    z = u[~outer] + 1j * a[~outer]
+    d = _weideman_L - 1j * z
+    p = np.polyval(_weideman_c, (_weideman_L + 1j * z) / d)
+    w[~outer] = (2 * p / d ** 2 + (1 / sqrtpi) / d).real
+    return w[()]
+
+# Tables of the real part of w(u + ia), for u >= 0, are cached for the
+# most recently used values of a. Since a only depends on the ratio of the
+# Lorentzian and Gaussian FWHM, all peaks with the same widths use the same table.
+_table_step = 0.02
+_table_max_size = 2 ** 16
+_table_cache_size = 16
+_tables = collections.OrderedDict()
+
+def _faddeeva_table_coefficients(a, extent):
+    # Returns the extent of the table, the coefficients of the cubic
+    # Hermite interpolation in each interval and the integral
+    # of the interpolation from zero up to each grid point.
+    table = _tables.pop(a, None)
+    if table is None or (table[0] < extent and table[0] < _table_max_size * _table_step):
+        n = min(int(np.ceil(max(extent, 10.0) / _table_step)) + 1, _table_max_size)
+        u = np.arange(n + 1) * _table_step
+        w = wofz(u + 1j * a)
+        f = w.real
+        df = (-2 * (u + 1j * a) * w + 2j / sqrtpi).real * _table_step
+        f0, f1, d0, d1 = f[:-1], f[1:], df[:-1], df[1:]
+        c0, c1, c2, c3 = f0, d0, 3 * (f1 - f0) - 2 * d0 - d1, 2 * (f0 - f1) + d0 + d1
+        cumulative = np.concatenate([[0], np.cumsum(c0 + c1 / 2 + c2 / 3 + c3 / 4) * _table_step])
+        table = (n * _table_step, c0, c1, c2, c3, cumulative)
+    _tables[a] = table
+    while len(_tables) > _table_cache_size:
+        _tables.popitem(last=False)
+    return table
+
+def _faddeeva_table_lookup(u, a):
+    u = np.abs(u)
+    extent, c0, c1, c2, c3, _ = _faddeeva_table_coefficients(a, u.max() if u.size else 0.0)
+    s = np.minimum(u, extent) * (1 / _table_step)
+    i = np.minimum(s.astype(np.intp), c0.size - 1)
+    t = s - i
+    w = np.asarray(np.take(c0, i) + t * (np.take(c1, i) + t * (np.take(c2, i) + t * np.take(c3, i))))
+    outside = u >= extent
+    if outside.any():
+        w[outside] = _faddeeva_asymptotic(u[outside], a)
+    return w
+
+def _faddeeva_asymptotic_integral(u, a):
+    # Integral of the real part of w(s + ia) from u to infinity,
+    # using the integrated four-term asymptotic expansion.
+    z = u + 1j * a
+    t = 1 / (z * z)
+    return -(1j * (np.log(z) - t * (0.25 + t * (0.1875 + t * 0.3125)))).real / sqrtpi
+
+def _faddeeva_table_integral_lookup(u, a):
+    sign = np.sign(u)
+    u = np.abs(u)
+    extent, c0, c1, c2, c3, cumulative = _faddeeva_table_coefficients(a, u.max() if u.size else 0.0)
+    s = np.minimum(u, extent) * (1 / _table_step)
+    i = np.minimum(s.astype(np.intp), c0.size - 1)
+    t = s - i
+    integral = t * (np.take(c0, i) + t * (np.take(c1, i) / 2 + t * (np.take(c2, i) / 3 + t * np.take(c3, i) / 4)))
+    integral = np.asarray(np.take(cumulative, i) + integral * _table_step)
+    outside = u >= extent
+    if outside.any():
+        integral[outside] = cumulative[-1] + _faddeeva_asymptotic_integral(extent, a) - _faddeeva_asymptotic_integral(u[outside], a)
+    return sign * integral
+
+def _per_value_of_a(function, u, a):
+    # Applies the function for each unique value of a,
+    # as the tables are calculated for a single value.
+    u, a = np.broadcast_arrays(np.asarray(u, dtype='float'), np.asarray(a, dtype='float'))
+    values = np.unique(a)
+    if values.size == 1:
+        return function(u, float(values[0]))[()]
+    w = np.empty(u.shape)
+    for value in values:
+        selection = a == value
+        w[selection] = function(u[selection], float(value))
+    return w
+
+def _faddeeva_table(u, a):
+    return _per_value_of_a(_faddeeva_table_lookup, u, a)
+
+def _faddeeva_table_integral(u, a):
+    # Integral of the real part of w(s + ia) from 0 to u.
+    return _per_value_of_a(_faddeeva_table_integral_lookup, u, a)
+
+def _faddeeva_pseudovoigt(u, a):
+    # Pseudo-Voigt of Thompson, Cox and Hastings, J. Appl. Cryst. 20 (1987) 79,
+    # in units where the Gaussian FWHM equals 2*sqrt(log(2)).
+    fG = 2 * np.sqrt(np.log(2))
+    fL = 2 * np.asarray(a, dtype='float')
+    f = (fG ** 5 + 2.69269 * fG ** 4 * fL + 2.42843 * fG ** 3 * fL ** 2 +
+         4.47163 * fG ** 2 * fL ** 3 + 0.07842 * fG * fL ** 4 + fL ** 5) ** 0.2
+    r = fL / f
+    eta = r * (1.36603 - r * (0.47719 - r * 0.11116))
+    hw = 0.5 * f
+    u2 = u * u
+    return eta * (hw / sqrtpi) / (u2 + hw * hw) + (1 - eta) * (fG / f) * np.exp(-u2 * (fG / f) ** 2)
 
 
 class Profile(object):
     """Abstract baseclass for defining lineshapes."""
 
+    # Attributes that are gathered into arrays by a ProfileBank,
+    # and attributes that have to be shared by all profiles in a bank.
+    _bank_attributes = ('_mu', '_fwhm', '_amp', '_normFactor')
+    _bank_scalars = ()
+
     def __init__(self, fwhm=None, mu=None, amp=None, ampIsArea=False):
         super(Profile, self).__init__()
         self.ampIsArea = ampIsArea
@@ -85,10 +261,83 @@ class Profile(object):
         vals = vals / factor
         return self.amp * vals
 
+    def derivatives(self, x):
+        """Evaluates the lineshape and its derivatives in the given values,
+        in a single pass.
+
+        Parameters
+        ----------
+        x: array_like
+            Array of values to evaluate the lineshape in.
+
+        Returns
+        -------
+        dict
+            Dictionary with the response (*'value'*), and the derivatives with
+            respect to the evaluation point (*'x'*), the location (*'mu'*),
+            the FWHM (*'fwhm'*, or *'fwhmG'* and *'fwhmL'* for the Voigt profile)
+            and the amplitude (*'amp'*)."""
+        raise NotImplementedError("Method has to be implemented in subclass!")
+
+    def _unit(self, vals):
+        # Scales the values as in __call__, for a unit amplitude.
+        if self.ampIsArea:
+            return vals
+        return vals / self._normFactor
+
+    def integrate(self, low, high):
+        """Integrates the lineshape over the intervals between *low* and *high*.
+        Profiles with a closed form cumulative distribution use the difference
+        of the distribution in the edges, the others use a composite Gauss-Legendre
+        quadrature with intervals of at most a quarter of the FWHM.
+
+        Parameters
+        ----------
+        low: array_like
+            Lower edges of the intervals.
+        high: array_like
+            Upper edges of the intervals.
+
+        Returns
+        -------
+        array_like
+            Array of the integrated response of the lineshape in each interval."""
+        cdf_high = self._cdf(high)
+        if cdf_high is not None:
+            return Profile.__call__(self, cdf_high - self._cdf(low))
+        low = np.asarray(low, dtype='float')
+        high = np.asarray(high, dtype='float')
+        k = max(1, int(np.ceil(4 * np.max(np.abs(high - low)) / np.min(self.fwhm))))
+        step = (high - low) / k
+        integral = 0
+        for i in range(k):
+            for node, weight in zip(*_gauss_legendre):
+                integral = integral + weight * self(low + (i + 0.5 * (node + 1)) * step)
+        return 0.5 * step * integral
+
+    def _cdf(self, x):
+        """Cumulative distribution of the area-normalized profile, up to
+        a constant. Returns *None* if there is no closed form."""
+        return None
+
+    def _window(self, tolerance):
+        """Half-width of the region around *mu* outside of which the
+        profile can be approximated within the relative *tolerance*.
+        Returns *None* if the profile does not support windowed evaluation."""
+        return None
+
+    def _tail(self, x):
+        """Approximation of the profile outside of the window given by
+        :meth:`_window`. Returns *None* if the profile is taken to be zero
+        outside of the window."""
+        return None
+
 class Gaussian(Profile):
 
     r"""A callable normalized Gaussian profile."""
 
+    _bank_attributes = Profile._bank_attributes + ('sigma',)
+
     def __init__(self, fwhm=None, mu=None, amp=None, ampIsArea=False):
         """Creates a callable object storing the fwhm, amplitude and location
         of a Gaussian lineshape.
@@ -153,11 +402,31 @@ class Gaussian(Profile):
         normPart = self.sigma * sqrt2pi
         return super(Gaussian, self).__call__(expPart / normPart)
 
+    def _window(self, tolerance):
+        # Outside of this distance, the profile is smaller than
+        # tolerance times the peak height.
+        return self.sigma * np.sqrt(-2 * np.log(tolerance))
+
+    def _cdf(self, x):
+        return 0.5 * erf((x - self.mu) / (self.sigma * sqrt2))
+
+    def derivatives(self, x):
+        x = x - self.mu
+        unit = self._unit(np.exp(-0.5 * (x / self.sigma) ** 2) / (self.sigma * sqrt2pi))
+        value = self.amp * unit
+        dx = -value * x / self.sigma ** 2
+        dsigma = value * (x * x / self.sigma ** 3 - 1 / self.sigma)
+        if not self.ampIsArea:
+            dsigma = dsigma + value / self.sigma
+        return {'value': value, 'x': dx, 'mu': -dx, 'fwhm': dsigma / sqrt2log2t2, 'amp': unit}
+
 
 class Lorentzian(Profile):
 
     """A callable normalized Lorentzian profile."""
 
+    _bank_attributes = Profile._bank_attributes + ('gamma',)
+
     def __init__(self, fwhm=None, mu=None, amp=None, ampIsArea=False):
         """Creates a callable object storing the fwhm, amplitude and location
         of a Lorentzian lineshape.
@@ -222,10 +491,44 @@ class Lorentzian(Profile):
         bottomPart = (x ** 2 + self.gamma ** 2) * np.pi
         return super(Lorentzian, self).__call__(topPart / bottomPart)
 
+    def _window(self, tolerance):
+        # As the tail is exact, the window does not depend on the
+        # tolerance and only covers the half width at half maximum.
+        return self.gamma
+
+    def _tail(self, x):
+        r"""The tail is given by the same closed form,
+
+            .. math::
+                \mathcal{L}\left(x; \mu, \gamma\right) = \frac{\gamma}
+                {\pi\left(\left(x-\mu\right)^2+\gamma^2\right)}
+
+        evaluated over the full range outside of the window. The profile is
+        not truncated, so the windowed evaluation is exact and does not
+        save any evaluations."""
+        x = x - self.mu
+        return super(Lorentzian, self).__call__(self.gamma / ((x * x + self.gamma * self.gamma) * np.pi))
+
+    def _cdf(self, x):
+        return np.arctan((x - self.mu) / self.gamma) / np.pi
+
+    def derivatives(self, x):
+        x = x - self.mu
+        bottom = x ** 2 + self.gamma ** 2
+        unit = self._unit(self.gamma / (bottom * np.pi))
+        value = self.amp * unit
+        dx = -2 * value * x / bottom
+        dgamma = value * (1 / self.gamma - 2 * self.gamma / bottom)
+        if not self.ampIsArea:
+            dgamma = dgamma + value / self.gamma
+        return {'value': value, 'x': dx, 'mu': -dx, 'fwhm': 0.5 * dgamma, 'amp': unit}
+
 class AsymmLorentzian(Profile):
 
     """A callable normalized Lorentzian profile with builtin asymmetry."""
 
+    _bank_attributes = Profile._bank_attributes + ('gamma', '_asymm')
+
     def __init__(self, fwhm=None, mu=None, amp=None, ampIsArea=False, asymm=0):
         """Creates a callable object storing the fwhm, amplitude, location and asymmetry
         of a asymmetric Lorentzian lineshape.
@@ -307,6 +610,22 @@ class AsymmLorentzian(Profile):
         bottomPart = (x ** 2 + gamma ** 2) * np.pi
         return super(AsymmLorentzian, self).__call__(topPart / bottomPart)
 
+    def derivatives(self, x):
+        x = x - self.mu
+        gamma = self.linewidth_function(x)
+        bottom = x ** 2 + gamma ** 2
+        unit = self._unit(gamma / (bottom * np.pi))
+        value = self.amp * unit
+        # Derivative with respect to the local linewidth, and of the
+        # linewidth with respect to x.
+        dlocal = value * (1 / gamma - 2 * gamma / bottom)
+        dwidth = -gamma * self.asymm * (1 - 0.5 * gamma / self.gamma)
+        dx = -2 * value * x / bottom + dlocal * dwidth
+        dgamma = dlocal * gamma / self.gamma
+        if not self.ampIsArea:
+            dgamma = dgamma + value / self.gamma
+        return {'value': value, 'x': dx, 'mu': -dx, 'fwhm': 0.5 * dgamma, 'amp': unit}
+
 class PseudoVoigt(Profile):
 
     r"""A callable normalized PseudoVoigt profile.
@@ -340,6 +659,8 @@ class PseudoVoigt(Profile):
     The formula is also adapted to incorporate an asymmetry in the lineshape. This
     is done by varying the used fwhm with a sigmoid function over the frequency range."""
 
+    _bank_attributes = Profile._bank_attributes + ('_n', '_a')
+
     def __init__(self, eta=None, fwhm=None, mu=None,
                  amp=None, **kwargs):
         self.L = Lorentzian(**kwargs)
@@ -373,8 +694,7 @@ class PseudoVoigt(Profile):
     @n.setter
     def n(self, value):
         value = np.abs(value)
-        if value > 1:
-            value = value - int(value)
+        value = value - np.floor(value) * (value > 1)
         self._n = value
         if not self.ampIsArea:
             self._normFactor = self.n * self.L(0)
@@ -399,11 +719,37 @@ class PseudoVoigt(Profile):
 
         return super(PseudoVoigt, self).__call__(val)
 
+    def derivatives(self, x):
+        x = x - self.mu
+        fwhm_scale = 2 / (1 + np.exp(self.a * x / self.fwhm))
+        self.L.fwhm = self.fwhm*fwhm_scale
+        self.G.fwhm = self.fwhm*fwhm_scale
+        L = self.L.derivatives(x)
+        G = self.G.derivatives(x)
+        val = self.n * L['value'] + (1.0 - self.n) * G['value']
+        dval = self.n * L['fwhm'] + (1.0 - self.n) * G['fwhm']
+        # Derivatives of the local FWHM with respect to x and the FWHM
+        dscale = fwhm_scale * (1 - 0.5 * fwhm_scale)
+        dx = self.n * L['x'] + (1.0 - self.n) * G['x'] - dval * self.a * dscale
+        dfwhm = dval * (fwhm_scale + self.a * x / self.fwhm * dscale)
+        unit = self._unit(val)
+        dx, dfwhm = self.amp * self._unit(dx), self.amp * self._unit(dfwhm)
+        return {'value': self.amp * unit, 'x': dx, 'mu': -dx, 'fwhm': dfwhm, 'amp': unit}
+
 class Voigt(Profile):
 
     r"""A callable normalized Voigt profile."""
 
-    def __init__(self, fwhm=None, mu=None, amp=None, ampIsArea=False):
+    _bank_attributes = Profile._bank_attributes + ('sigma', 'gamma', 'fwhmG', 'fwhmL')
+    _bank_scalars = ('_backend',)
+
+    __backends__ = {'wofz': _faddeeva_wofz,
+                    'humlicek': _faddeeva_humlicek,
+                    'weideman': _faddeeva_weideman,
+                    'pseudovoigt': _faddeeva_pseudovoigt,
+                    'table': _faddeeva_table}
+
+    def __init__(self, fwhm=None, mu=None, amp=None, ampIsArea=False, backend='wofz'):
         """Creates a callable object storing the fwhm, amplitude and location
         of a Voigt lineshape.
 
@@ -418,12 +764,16 @@ class Voigt(Profile):
         ampIsArea: boolean
             Sets if the amplitude is the integral or the peakheight. Defaults
             to False.
+        backend: string
+            Sets the calculation of the Faddeeva function, see :attr:`backend`.
+            Defaults to 'wofz'.
 
         Returns
         -------
         Voigt
             Callable instance, evaluates the Voigt profile in the arguments supplied."""
         self._fwhmNorm = np.array([sqrt2log2t2, 2])
+        self.backend = backend
         super(Voigt, self).__init__(fwhm=fwhm, mu=mu,
                                     amp=amp, ampIsArea=ampIsArea)
 
@@ -440,15 +790,60 @@ class Voigt(Profile):
             G, L = seperate
             self._fwhm = 0.5346 * self.fwhmL + \
                          (0.2166 * self.fwhmL ** 2 + self.fwhmG ** 2) ** 0.5
-            self.sigma, self.gamma = seperate / self._fwhmNorm
+            self.sigma, self.gamma = self.fwhmG / self._fwhmNorm[0], self.fwhmL / self._fwhmNorm[1]
         else:
             self.fwhmG, self.fwhmL = value, value
             self._fwhm = 0.6144031129489123 * value
             self.sigma, self.gamma = self._fwhm / self._fwhmNorm
+        self._set_norm()
 
+    @property
+    def backend(self):
+        r"""Method used to calculate the real part of the Faddeeva function.
+        The maximum relative errors, determined over the full profile for
+        :math:`10^{-6} \leq \gamma/\sigma\sqrt{2} \leq 10^3`, are:
+
+            * *'wofz'*: the exact calculation by :func:`scipy.special.wofz`.
+            * *'humlicek'*: the rational approximation of Humlicek (1982),
+              relative error below :math:`10^{-4}`.
+            * *'weideman'*: the 32-term rational approximation of Weideman (1994),
+              relative error below :math:`5\cdot10^{-6}`.
+            * *'pseudovoigt'*: the pseudo-Voigt approximation of Thompson, Cox and Hastings (1987),
+              error below 1.3% of the peak height, but a relative error up
+              to 37% in the far tails.
+            * *'table'*: cubic Hermite interpolation in a cached table of the
+              Faddeeva function, relative error below :math:`1.1\cdot10^{-6}`. The table only
+              depends on the ratio of the Lorentzian and Gaussian FWHM, so all
+              peaks with the same widths share a single table, which is only
+              recalculated when the widths change.
+
+        The approximations are faster to calculate and can be used
+        during the minimization. The fitting routines always finish
+        the fit with the exact calculation.
+
+        The backend is only used for the values of the profile. The
+        derivatives given by :meth:`derivatives` are always calculated
+        exactly with :func:`scipy.special.wofz`, so for the other backends
+        they are the exact derivatives of the exact profile and differ
+        from the derivatives of the approximated values by the error of
+        the approximation."""
+        return self._backend
+
+    @backend.setter
+    def backend(self, value):
+        value = value.lower()
+        if value not in self.__backends__:
+            raise KeyError('Voigt backend {} not supported, choose from {}.'.format(value, ', '.join(sorted(self.__backends__))))
+        self._backend = value
+        if hasattr(self, 'sigma'):
+            self._set_norm()
+
+    def _faddeeva(self, u, a):
+        return self.__backends__[self._backend](u, a)
+
+    def _set_norm(self):
         if not self.ampIsArea:
-            z = (0 + 1j * self.gamma) / (self.sigma * sqrt2)
-            top = wofz(z).real / (self.sigma * sqrt2pi)
+            top = self._faddeeva(0.0, self.gamma / (self.sigma * sqrt2)) / (self.sigma * sqrt2pi)
             self._normFactor = top
 
     def __call__(self, x):
@@ -477,14 +872,69 @@ class Voigt(Profile):
 
                 z&=\frac{x+i\gamma}{\sigma\sqrt{2\pi}}"""
         x = x - self.mu
-        z = (x + 1j * self.gamma) / (self.sigma * sqrt2)
-        top = wofz(z).real / (self.sigma * sqrt2pi)
+        top = self._faddeeva(x / (self.sigma * sqrt2), self.gamma / (self.sigma * sqrt2)) / (self.sigma * sqrt2pi)
         return super(Voigt, self).__call__(top)
 
+    def _window(self, tolerance):
+        # Distance (in units of sigma*sqrt(2)) beyond which the four-term
+        # asymptotic expansion of the Faddeeva function has a relative error
+        # smaller than the tolerance, both from the truncation of the series
+        # and from the neglected exp(-z**2) term.
+        a = np.maximum(self.gamma / (self.sigma * sqrt2), 1e-300)
+        R = (120.0 / tolerance) ** 0.125
+        R = np.maximum(R, np.sqrt(a * a + np.log(sqrtpi * R * R / (tolerance * a))))
+        return R * self.sigma * sqrt2
+
+    def _tail(self, x):
+        r"""Asymptotic expansion of the Voigt profile, used outside of the window:
+
+            .. math::
+                w\left(z\right) \approx \frac{i}{\sqrt{\pi}z}\left(1 + \frac{1}{2z^2}
+                + \frac{3}{4z^4} + \frac{15}{8z^6}\right)"""
+        x = x - self.mu
+        top = _faddeeva_asymptotic(x / (self.sigma * sqrt2), self.gamma / (self.sigma * sqrt2)) / (self.sigma * sqrt2pi)
+        return super(Voigt, self).__call__(top)
+
+    def derivatives(self, x):
+        # The derivatives are calculated from the exact Faddeeva function,
+        # using w'(z) = -2zw(z) + 2i/sqrt(pi), whatever the backend. The
+        # approximations only give the real part of w, which is not enough
+        # for the derivatives. The value uses the backend, as in __call__.
+        x = x - self.mu
+        c = self.sigma * sqrt2
+        z = (x + 1j * self.gamma) / c
+        w = wofz(z)
+        dw = -2 * z * w + 2j / sqrtpi
+        top = w.real / (c * sqrtpi)
+        dx = dw.real / (c * c * sqrtpi)
+        dgamma = -dw.imag / (c * c * sqrtpi)
+        dsigma = -((z * dw).real + w.real) / (self.sigma * c * sqrtpi)
+        if self.backend != 'wofz':
+            top = self._faddeeva(x / c, self.gamma / c) / (c * sqrtpi)
+        unit = self._unit(top)
+        value = self.amp * unit
+        dx, dgamma, dsigma = self.amp * self._unit(dx), self.amp * self._unit(dgamma), self.amp * self._unit(dsigma)
+        if not self.ampIsArea:
+            z = 1j * self.gamma / c
+            w = wofz(z)
+            dw = -2 * z * w + 2j / sqrtpi
+            dgamma = dgamma + value * dw.imag / (c * c * sqrtpi) / self._normFactor
+            dsigma = dsigma + value * ((z * dw).real + w.real) / (self.sigma * c * sqrtpi) / self._normFactor
+        return {'value': value, 'x': dx, 'mu': -dx, 'fwhmG': dsigma / sqrt2log2t2, 'fwhmL': 0.5 * dgamma, 'amp': unit}
+
+    def _cdf(self, x):
+        # Uses the integral of the tabulated Faddeeva function,
+        # independent of the backend.
+        x = x - self.mu
+        return _faddeeva_table_integral(x / (self.sigma * sqrt2), self.gamma / (self.sigma * sqrt2)) / sqrtpi
+
 class Crystalball(Profile):
 
     r"""A callable Crystalball profile."""
 
+    _bank_attributes = Profile._bank_attributes + ('sigma',)
+    _bank_scalars = ('_alpha', '_n')
+
     def __init__(self, fwhm=None, mu=None, amp=None, alpha=None, n=None, ampIsArea=False):
         """Creates a callable object storing the fwhm, amplitude and location
         of a Crystalball lineshape. For more information, see :cite:`Gaiser`
@@ -575,6 +1025,261 @@ class Crystalball(Profile):
         -------
         array_like
             Array of seperate response values of the lineshape."""
-        x = (x - self.mu) * np.sign(self.alpha) / self.sigma
-        y = np.piecewise(x, x >= -np.abs(self.alpha), [self._bigger, self._smaller])
+        x = np.asarray((x - self.mu) * np.sign(self.alpha) / self.sigma)
+        core = x >= -np.abs(self.alpha)
+        y = np.empty(x.shape)
+        y[core] = self._bigger(x[core])
+        y[~core] = self._smaller(x[~core])
         return super(Crystalball, self).__call__(y)
+
+    def derivatives(self, x):
+        s = np.sign(self.alpha)
+        x = np.asarray((x - self.mu) * s / self.sigma)
+        core = x >= -np.abs(self.alpha)
+        y = np.empty(x.shape)
+        dy = np.empty(x.shape)
+        y[core] = self._bigger(x[core])
+        dy[core] = -x[core] * y[core]
+        y[~core] = self._smaller(x[~core])
+        dy[~core] = self.n * y[~core] / (self.n / np.abs(self.alpha) - np.abs(self.alpha) - x[~core])
+        unit = self._unit(y)
+        dx = self.amp * self._unit(dy) * s / self.sigma
+        dsigma = -self.amp * self._unit(dy) * x / self.sigma
+        return {'value': self.amp * unit, 'x': dx, 'mu': -dx, 'fwhm': dsigma / sqrt2log2t2, 'amp': unit}
+
+    def _cdf(self, x):
+        # The Gaussian core and the power law tail are integrated
+        # separately, starting from the transition point.
+        s = np.sign(self.alpha)
+        x = np.asarray((x - self.mu) * s / self.sigma)
+        a = np.abs(self.alpha)
+        n = self.n
+        b = n / a - a
+        core = x >= -a
+        y = np.empty(x.shape)
+        y[core] = (0.5 * np.pi) ** 0.5 * (erf(x[core] / sqrt2) - erf(-a / sqrt2))
+        y[~core] = ((n / a)**n) * np.exp(-0.5*a*a) * ((b - x[~core]) ** (1 - n) - (b + a) ** (1 - n)) / (n - 1)
+        return s * self.sigma * y
+
+
+class ProfileBank(object):
+
+    r"""A collection of profiles of the same shape, stored as arrays
+    of the parameters (struct-of-arrays) and evaluated as a single
+    broadcasted calculation instead of one call per profile."""
+
+    def __init__(self, profiles, block_size=2**18, tolerance=None):
+        """Gathers the parameters of the given profiles. The profiles
+        remain the reference for the parameter values; after changing them,
+        :meth:`update` has to be called.
+
+        Parameters
+        ----------
+        profiles: list of :class:`.Profile`
+            Profiles of the same class to be evaluated together.
+        block_size: int, optional
+            Maximum number of (profile, x) combinations that are evaluated
+            at once. Larger inputs are evaluated in blocks along *x* to
+            limit the memory usage. Defaults to 2**18.
+        tolerance: float, optional
+            If given, the profiles are only evaluated within a window around
+            their location, see :attr:`tolerance`. Defaults to *None*.
+
+        Returns
+        -------
+        ProfileBank
+            Callable instance, evaluates the sum of all profiles in the
+            arguments supplied."""
+        super(ProfileBank, self).__init__()
+        self.profiles = tuple(profiles)
+        self.block_size = block_size
+        self.tolerance = tolerance
+        self._template = copy.deepcopy(self.profiles[0])
+        self.update()
+
+    def __len__(self):
+        return len(self.profiles)
+
+    @property
+    def tolerance(self):
+        r"""Relative tolerance for the windowed evaluation. If not *None*,
+        each profile is only evaluated within :math:`\pm k\cdot FWHM` of
+        its location, with *k* derived from the tolerance.
+        Outside of this window, Gaussian profiles are neglected (the error is
+        smaller than the tolerance times the peak height), while for Voigt
+        profiles the asymptotic expansion of the tail is used (the relative
+        error is smaller than the tolerance). The tails are only evaluated outside
+        of the windows. Lorentzian profiles are not truncated: their tail is the
+        same closed form, evaluated exactly over the full range, and the tolerance
+        has no effect on them. Profiles which do not support a window are evaluated
+        over the full range."""
+        return self._tolerance
+
+    @tolerance.setter
+    def tolerance(self, value):
+        self._tolerance = value
+
+    def _select(self, indices):
+        # Creates a template where the parameters are taken from the
+        # given indices, as flat arrays.
+        selection = copy.copy(self._template)
+        for attr in selection._bank_attributes:
+            if attr in selection.__dict__:
+                selection.__dict__[attr] = selection.__dict__[attr][indices, 0]
+        return selection
+
+    def update(self):
+        """Gathers the current parameters of the profiles into column arrays
+        of the evaluation template."""
+        template = self._template
+        for attr in template._bank_attributes:
+            values = [prof.__dict__.get(attr, None) for prof in self.profiles]
+            if values[0] is None:
+                continue
+            template.__dict__[attr] = np.array(values, dtype='float')[:, np.newaxis]
+        # Parameters that can not be broadcast have to be the same for all profiles,
+        # otherwise the profiles are evaluated one by one.
+        self._uniform = True
+        for attr in template._bank_scalars:
+            values = [prof.__dict__.get(attr, None) for prof in self.profiles]
+            self._uniform = self._uniform and all([v == values[0] for v in values])
+            template.__dict__[attr] = values[0]
+
+    def __call__(self, x):
+        """Evaluates the sum of the profiles in the given values.
+
+        Parameters
+        ----------
+        x: array_like
+            Array of values to evaluate the profiles in.
+
+        Returns
+        -------
+        array_like
+            Array of the summed response values of the profiles, with the
+            same shape as *x*."""
+        x = np.asarray(x, dtype='float')
+        if not self._uniform:
+            return sum([prof(x) for prof in self.profiles])
+        flat = x.ravel()
+        if self.tolerance is not None:
+            halfwidth = self._template._window(self.tolerance)
+            if halfwidth is not None:
+                return self._windowed(flat, halfwidth[:, 0]).reshape(x.shape)
+        response = np.empty(flat.shape)
+        step = max(1, self.block_size // len(self.profiles))
+        for start in range(0, flat.size, step):
+            block = flat[np.newaxis, start:start + step]
+            response[start:start + step] = self._template(block).sum(axis=0)
+        return response.reshape(x.shape)
+
+    def shapes(self, x):
+        """Evaluates each profile separately with unit amplitude. Since the
+        response is proportional to the amplitude, this gives the
+        contribution of each profile per unit of amplitude.
+
+        Parameters
+        ----------
+        x: array_like
+            Array of values to evaluate the profiles in.
+
+        Returns
+        -------
+        array_like
+            Array of shape (number of profiles, size of *x*)."""
+        x = np.asarray(x, dtype='float').ravel()
+        if not self._uniform:
+            rows = []
+            for prof in self.profiles:
+                prof = copy.copy(prof)
+                prof.amp = 1.0
+                rows.append(prof(x))
+            return np.vstack(rows)
+        template = copy.copy(self._template)
+        template.amp = np.ones((len(self), 1))
+        response = np.empty((len(self), x.size))
+        step = max(1, self.block_size // len(self.profiles))
+        for start in range(0, x.size, step):
+            response[:, start:start + step] = template(x[np.newaxis, start:start + step])
+        return response
+
+    def derivatives(self, x):
+        """Evaluates the profiles and their derivatives in the given values,
+        see :meth:`.Profile.derivatives`.
+
+        Parameters
+        ----------
+        x: array_like
+            Array of values to evaluate the profiles in.
+
+        Returns
+        -------
+        dict
+            Dictionary with arrays of shape (number of profiles, size of *x*)
+            for the response and each derivative, with a row for every profile."""
+        x = np.asarray(x, dtype='float').ravel()
+        if not self._uniform:
+            derivatives = [prof.derivatives(x) for prof in self.profiles]
+            return {key: np.vstack([d[key] for d in derivatives]) for key in derivatives[0]}
+        derivatives = self._template.derivatives(x[np.newaxis, :])
+        return {key: np.broadcast_to(value, (len(self), x.size)) for key, value in derivatives.items()}
+
+    def integrate(self, low, high):
+        """Integrates the sum of the profiles over the intervals
+        between *low* and *high*, see :meth:`.Profile.integrate`.
+
+        Parameters
+        ----------
+        low: array_like
+            Lower edges of the intervals.
+        high: array_like
+            Upper edges of the intervals.
+
+        Returns
+        -------
+        array_like
+            Array of the summed integrated response of the profiles, with the
+            same shape as *low* and *high*."""
+        low, high = np.broadcast_arrays(np.asarray(low, dtype='float'), np.asarray(high, dtype='float'))
+        if not self._uniform:
+            return sum([prof.integrate(low, high) for prof in self.profiles])
+        shape = low.shape
+        low, high = low.ravel(), high.ravel()
+        response = np.empty(low.shape)
+        step = max(1, self.block_size // len(self.profiles))
+        for start in range(0, low.size, step):
+            block = slice(start, start + step)
+            response[block] = self._template.integrate(low[np.newaxis, block], high[np.newaxis, block]).sum(axis=0)
+        return response.reshape(shape)
+
+    def _windowed(self, x, halfwidth):
+        # Sort the values, if needed, so the windows can be found by a binary search.
+        if np.all(x[1:] >= x[:-1]):
+            sorter = None
+        else:
+            sorter = np.argsort(x, kind='mergesort')
+            x = x[sorter]
+        template = self._template
+        mu = template._mu[:, 0]
+        low = np.searchsorted(x, mu - halfwidth, side='left')
+        high = np.searchsorted(x, mu + halfwidth, side='right')
+
+        # Flatten all windows into one array of (profile, position) combinations
+        counts = high - low
+        profiles = np.repeat(np.arange(len(mu)), counts)
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(low, counts)
+        core = self._select(profiles)(x[positions])
+        response = np.bincount(positions, weights=core, minlength=x.size)
+
+        # Add the approximated tails, only outside of the windows. As the values
+        # are sorted, these are the values before and after each window.
+        if type(template)._tail is not Profile._tail:
+            for prof, l, h in zip(self.profiles, low, high):
+                response[:l] += prof._tail(x[:l])
+                response[h:] += prof._tail(x[h:])
+
+        if sorter is not None:
+            unsorted = np.empty(response.shape)
+            unsorted[sorter] = response
+            response = unsorted
+        return response
@@ -4,33 +4,204 @@ Implementation of fitting routines specialised for BaseModel objects. Note that
 .. moduleauthor:: Wouter Gins <wouter.gins@kuleuven.be>
 .. moduleauthor:: Ruben de Groote <ruben.degroote@kuleuven.be>
 """
+import contextlib
 import copy
 import os
-import numdifftools as nd
-
-from satlas.stats import emcee as mcmc
+import time
 
 import lmfit as lm
 from satlas import loglikelihood as llh
 from satlas import tqdm
-import h5py
-import matplotlib.pyplot as plt
+from satlas import wigner
+from satlas.models.basemodel import ParameterMap, Workspace
 import numpy as np
-import pandas as pd
 from scipy import optimize
 from scipy.misc import derivative
 from scipy.stats import chi2
 
 
 __all__ = ['chisquare_spectroscopic_fit', 'chisquare_fit', 'calculate_analytical_uncertainty',
-           'likelihood_fit', 'likelihood_walk', 'create_band', 'process_walk']
+           'likelihood_fit', 'likelihood_walk', 'create_band', 'process_walk', 'spin_scan']
 chisquare_warning_message = "The supplied dictionary for {} did not contain the necessary keys 'value' and 'uncertainty'."
 
 ###############################
 # CHI SQUARE FITTING ROUTINES #
 ###############################
 
-def chisquare_model(params, f, x, y, yerr, xerr=None, func=None):
+def _approximated_models(f):
+    # Yields all (sub)models using an approximated Voigt profile,
+    # interpolated sidepeaks or an interpolated frozen line pattern.
+    if hasattr(f, 'models'):
+        for model in f.models:
+            for m in _approximated_models(model):
+                yield m
+    elif getattr(f, 'voigt_backend', 'wofz') != 'wofz' or getattr(f, 'sidepeak_method', 'exact') == 'interpolate' or getattr(f, 'frozen_shape', False):
+        yield f
+
+@contextlib.contextmanager
+def exact_profiles(f):
+    """Context manager that temporarily switches all models using an
+    approximation of the Voigt profile, interpolated sidepeaks or
+    a frozen line pattern to the exact calculation.
+
+    Parameters
+    ----------
+    f: :class:`.BaseModel`
+        Model to be evaluated exactly."""
+    models = list(_approximated_models(f))
+    backends = [(m.voigt_backend, m.sidepeak_method, m.frozen_shape) for m in models]
+    for m in models:
+        m.voigt_backend = 'wofz'
+        m.frozen_shape = False
+        if m.sidepeak_method == 'interpolate':
+            m.sidepeak_method = 'broadcast'
+    try:
+        yield f
+    finally:
+        for m, (backend, method, frozen) in zip(models, backends):
+            m.voigt_backend = backend
+            m.sidepeak_method = method
+            m.frozen_shape = frozen
+
+def _flatten(values):
+    # The data of a LinkedModel is a list of arrays, which is concatenated.
+    # Arrays are only raveled, as np.hstack splits them in their elements.
+    if isinstance(values, np.ndarray):
+        return values.ravel()
+    return np.hstack(values)
+
+def _response(f, x):
+    # Response of the model. During a fit, the response is written in
+    # the output array of the workspace instead of a new array.
+    workspace = getattr(f, 'workspace', None)
+    if workspace is None:
+        return f(x)
+    return workspace.response(f, x)
+
+@contextlib.contextmanager
+def _workspace(f, x):
+    # Assigns a workspace for x to the model during the fit.
+    previous = f.workspace
+    f.workspace = Workspace(x)
+    try:
+        yield f.workspace
+    finally:
+        f.workspace = previous
+
+class _Region(object):
+
+    # Region of interest of a model, determined once for the data.
+    # The peaks are only evaluated for the data inside the region,
+    # outside of it only the background is calculated.
+
+    def __init__(self, x, y, mask):
+        super(_Region, self).__init__()
+        self.mask = mask
+        self.inside, self.outside = x[mask], x[~mask]
+        self.y_inside, self.y_outside = y[mask], y[~mask]
+        self.total = self.y_outside.sum()
+        self.count = self.outside.size
+        self._response = np.empty(mask.shape)
+
+    def response(self, f):
+        # The array is reused by the next call.
+        self._response[self.mask] = _response(f, self.inside)
+        self._response[~self.mask] = f.background(self.outside)
+        return self._response
+
+    def loglikelihood(self, f, func):
+        inside = np.sum(func(self.y_inside, f, self.inside))
+        if func is llh.poisson_llh and f.background_degree == 0:
+            # Closed form for a constant background
+            b = f.background(0.0)
+            if b <= 0:
+                return -np.inf
+            return inside + self.total * np.log(b) - self.count * b
+        return inside + np.sum(func(self.y_outside, f.background, self.outside))
+
+@contextlib.contextmanager
+def _region_of_interest(f, x, y):
+    # Fixes the region of interest of the model to the windows at the start
+    # of the fit, and yields the region for the data, or None if the model
+    # has no region of interest.
+    try:
+        mask = f.roi_mask(x)
+    except AttributeError:
+        mask = None
+    if mask is None or mask.all():
+        yield None
+        return
+    roi = f.roi
+    f.roi = f.roi_windows()
+    try:
+        yield _Region(np.asarray(x, dtype='float'), np.asarray(y), mask)
+    finally:
+        f.roi = roi
+
+def _linear_setup(f, params):
+    # Fixes the linear parameters of the model for the variable projection.
+    # Returns the reduced parameters, their map, and the names and
+    # boundaries of the linear parameters.
+    names = f.linear_parameters()
+    reduced = copy.deepcopy(params)
+    for name in names:
+        reduced[name].vary = False
+    low = np.array([-np.inf if params[name].min is None else params[name].min for name in names], dtype='float')
+    high = np.array([np.inf if params[name].max is None else params[name].max for name in names], dtype='float')
+    return reduced, ParameterMap(reduced), (names, low, high)
+
+def _linear_release(params, f, names, margin=1e-6):
+    # Parameters with the solved values of the linear parameters, varying again.
+    # A solution on a boundary is moved inside by a relative margin, so
+    # the minimization does not start on the boundary.
+    params = copy.deepcopy(params)
+    for name in names:
+        value = f.params[name].value
+        low, high = params[name].min, params[name].max
+        if low is not None and np.isfinite(low):
+            value = max(value, low + margin * max(abs(low), 1))
+        if high is not None and np.isfinite(high):
+            value = min(value, high - margin * max(abs(high), 1))
+        params[name].value = value
+        params[name].vary = True
+    return params
+
+def _project_linear(f, x, y, linear, yerr=None, func=None, poisson=False, iterations=5):
+    # Variable projection: solves for the linear parameters of the model,
+    # given the current values of the other parameters, and assigns them.
+    # When the uncertainties follow from the model, either through *func*
+    # or the Poisson variance, the solution is reweighted iteratively.
+    names, low, high = linear
+    basis, rest = f.linear_basis(x, names)
+    values = np.array([f.params[name].value for name in names], dtype='float')
+    y = _flatten(y)
+    reweight = poisson or func is not None
+    bounded = np.isfinite(low).any() or np.isfinite(high).any()
+    for _ in range(iterations if reweight else 1):
+        if reweight:
+            model = rest + basis.dot(values)
+            sigma = np.sqrt(model) if poisson else func(model)
+            sigma = np.where(sigma > 0, sigma, 1.0)
+        else:
+            sigma = yerr
+        A = basis / sigma[:, np.newaxis]
+        b = (y - rest) / sigma
+        if bounded:
+            solution = optimize.lsq_linear(A, b, bounds=(low, high), method='bvls').x
+        else:
+            solution = np.linalg.lstsq(A, b, rcond=None)[0]
+        if poisson:
+            # Damp the step to keep the expected counts positive
+            step = 1.0
+            while step > 1e-3 and np.any(rest + basis.dot(values + step * (solution - values)) <= 0):
+                step *= 0.5
+            solution = values + step * (solution - values) if step > 1e-3 else values
+        values = solution
+    new = dict([(name, par.value) for name, par in f.params.items()])
+    new.update(zip(names, values))
+    f._set_values(new)
+
+def chisquare_model(params, f, x, y, yerr, xerr=None, func=None, parameter_map=None, linear=None, region=None):
     r"""Model function for chisquare fitting routines as established
     in this module.
 
@@ -55,6 +226,17 @@ def chisquare_model(params, f, x, y, yerr, xerr=None, func=None):
     func: function, optional
         Given a function, the errorbars on the y-axis is calculated from
         the fitvalue using this function. Defaults to *None*.
+    parameter_map: :class:`.ParameterMap`, optional
+        If given, the values are passed to the model with
+        :meth:`.BaseModel.evaluate` instead of assigning *params*.
+    linear: tuple, optional
+        Names and boundaries of the linear parameters, which are solved
+        for by a weighted linear least squares fit before calculating the
+        residuals. Only used together with *parameter_map*, see :func:`chisquare_fit`.
+    region: object, optional
+        Region of interest of the model for the data, in which the peaks are
+        evaluated. Only used together with *parameter_map*. Set by the fitting
+        routines, see :attr:`.HFSModel.roi`.
 
     Returns
     -------
@@ -72,8 +254,14 @@ def chisquare_model(params, f, x, y, yerr, xerr=None, func=None):
         .. math::
 
             \sqrt{\chi^2} = \frac{y-f(x)}{\sqrt{\sigma_x^2+f'(x)^2\sigma_x^2}}"""
-    f.params = params
-    model = np.hstack(f(x))
+    if parameter_map is None:
+        f.params = params
+        model = np.ravel(_response(f, x))
+    else:
+        f._set_values(parameter_map.resolve(parameter_map.vector(params)))
+        if linear is not None:
+            _project_linear(f, x, y, linear, yerr=yerr, func=func)
+        model = np.ravel(_response(f, x)) if region is None else region.response(f)
     if func is not None:
         yerr = func(model)
     if xerr is not None:
@@ -81,7 +269,7 @@ def chisquare_model(params, f, x, y, yerr, xerr=None, func=None):
         if len(x.shape) > 1:
             xerr = derivative(lambda x: np.hstack(f.seperate_response(x)), x, dx=1E-5) * xerr
         else:
-            xerr = derivative(f, x, dx=1E-5) * xerr
+            xerr = f.derivative(x) * xerr
         bottom = np.sqrt(yerr * yerr + xerr * xerr)
     else:
         bottom = yerr
@@ -91,7 +279,90 @@ def chisquare_model(params, f, x, y, yerr, xerr=None, func=None):
         return_value = np.append(return_value, appended_values)
     return return_value
 
-def chisquare_spectroscopic_fit(f, x, y, xerr=None, func=np.sqrt, verbose=True, hessian=False, method='leastsq'):
+def chisquare_jacobian(params, f, x, y, yerr, xerr=None, func=None, parameter_map=None, region=None):
+    """Jacobian of the residuals of :func:`chisquare_model` with respect to
+    the varying parameters, calculated from :meth:`.BaseModel.jacobian`.
+    Can be supplied to the minimizer as *Dfun*. The uncertainty on *x* is
+    not taken into account.
+
+    Parameters
+    ----------
+    params: lmfit.Parameters
+        Instance of lmfit.Parameters object, to be assigned to the model object.
+    f: :class:`.BaseModel`
+        Callable instance with the correct methods for the fitmethods.
+    x: array_like
+        Experimental data for the x-axis.
+    y: array_like
+        Experimental data for the y-axis.
+    yerr: array_like
+        Experimental errorbars on the y-axis.
+
+    Other parameters
+    ----------------
+    xerr: array_like, optional
+        Ignored, present for compatibility with :func:`chisquare_model`.
+    func: function, optional
+        Given a function, the errorbars on the y-axis is calculated from
+        the fitvalue using this function. Defaults to *None*.
+    parameter_map: :class:`.ParameterMap`, optional
+        If given, the values are passed to the model through the map
+        instead of assigning *params*.
+    region: :class:`_Region`, optional
+        Ignored, the region of interest is applied by the model itself.
+
+    Returns
+    -------
+    NumPy array
+        Array with a row for each residual and a column for each varying parameter."""
+    if parameter_map is None:
+        f.params = params
+    else:
+        f._set_values(parameter_map.resolve(parameter_map.vector(params)))
+    model_names = [name for name, par in f.params.items() if par.vary]
+    jacobian = f.jacobian(x)
+    if func is None:
+        factor = -1 / yerr
+    else:
+        model = np.ravel(_response(f, x))
+        yerr = func(model)
+        step = 1e-6 * np.maximum(np.abs(model), 1)
+        dyerr = (func(model + step) - func(model - step)) / (2 * step)
+        factor = -(1 + (y - model) * dyerr / yerr) / yerr
+    jacobian = jacobian * factor[:, np.newaxis]
+
+    # Columns in the order of the minimizer, zero for parameters
+    # which are fixed by the model.
+    names = [name for name, par in params.items() if par.vary]
+    columns = {name: i for i, name in enumerate(model_names)}
+    result = np.zeros((jacobian.shape[0], len(names)))
+    for i, name in enumerate(names):
+        if name in columns:
+            result[:, i] = jacobian[:, columns[name]]
+
+    # Rows for the literature values, by central differences
+    mapping = f.get_chisquare_mapping()
+    if mapping is not None and len(mapping) > 0:
+        rows = np.zeros((len(mapping), len(names)))
+        for i, name in enumerate(names):
+            p = copy.deepcopy(params)
+            value = p[name].value
+            step = 1e-6 * max(abs(value), 1)
+            p[name].value = value + step
+            up = p[name].value
+            p.update_constraints()
+            f.params = p
+            high = f.get_chisquare_mapping()
+            p[name].value = value - step
+            down = p[name].value
+            p.update_constraints()
+            f.params = p
+            rows[:, i] = (high - f.get_chisquare_mapping()) / (up - down)
+        f.params = params
+        result = np.vstack([result, rows])
+    return result
+
+def chisquare_spectroscopic_fit(f, x, y, xerr=None, func=np.sqrt, verbose=True, hessian=False, method='leastsq', jacobian=False, varpro=False):
     """Use the :func:`chisquare_fit` function, automatically estimating the errors
     on the counts by the square root.
 
@@ -119,18 +390,24 @@ def chisquare_spectroscopic_fit(f, x, y, xerr=None, func=np.sqrt, verbose=True,
         is calculated, otherwise the LMFIT version is used. Defaults to *False*.
     method: string, optional
         Sets the method to be used by lmfit for the fitting. See lmfit for all options.
+    jacobian: boolean, optional
+        When set to *True*, the analytical Jacobian is used, see :func:`chisquare_fit`.
+        Defaults to *False*.
+    varpro: boolean, optional
+        When set to *True*, the linear parameters are solved for
+        directly, see :func:`chisquare_fit`. Defaults to *False*.
 
     Return
     ------
     success, message: tuple
         Boolean indicating the success of the convergence, and the message
         from the optimizer."""
-    y = np.hstack(y)
+    y = _flatten(y)
     yerr = np.sqrt(y)
     yerr[np.isclose(yerr, 0.0)] = 1.0
-    return chisquare_fit(f, x, y, yerr=yerr, xerr=xerr, func=func, verbose=verbose, hessian=hessian, method=method)
+    return chisquare_fit(f, x, y, yerr=yerr, xerr=xerr, func=func, verbose=verbose, hessian=hessian, method=method, jacobian=jacobian, varpro=varpro)
 
-def chisquare_fit(f, x, y, yerr=None, xerr=None, func=None, verbose=True, hessian=False, method='leastsq'):
+def chisquare_fit(f, x, y, yerr=None, xerr=None, func=None, verbose=True, hessian=False, method='leastsq', jacobian=False, varpro=False):
     """Use a non-linear least squares minimization (Levenberg-Marquardt)
     algorithm to minimize the chi-square of the fit to data *x* and
     *y* with errorbars *yerr*.
@@ -162,6 +439,19 @@ def chisquare_fit(f, x, y, yerr=None, xerr=None, func=None, verbose=True, hessia
         is calculated, otherwise the LMFIT version is used. Defaults to *False*.
     method: string, optional
         Sets the method to be used by lmfit for the fitting. See lmfit for all options.
+    jacobian: boolean, optional
+        When set to *True*, the Jacobian given by :func:`chisquare_jacobian`
+        is supplied to the minimizer instead of a finite difference estimate.
+        Only used for the 'leastsq' and 'least_squares' methods, and
+        when *xerr* is not given. Defaults to *False*.
+    varpro: boolean, optional
+        When set to *True*, the fit starts with a variable projection:
+        the parameters given by :meth:`.BaseModel.linear_parameters`
+        (amplitudes, scale and background) are solved for by a weighted linear
+        least squares fit, respecting their boundaries, for every step of the
+        minimizer, which only searches over the other parameters. The
+        fit is then finished with all parameters varying, to obtain the
+        uncertainties. Defaults to *False*.
 
     Return
     ------
@@ -169,7 +459,13 @@ def chisquare_fit(f, x, y, yerr=None, xerr=None, func=None, verbose=True, hessia
         Boolean indicating the success of the convergence, and the message
         from the optimizer."""
 
+    # The data is concatenated once for all evaluations
+    y, yerr = _flatten(y), _flatten(yerr)
     params = f.params
+    # The objective function passes the values through a precompiled map
+    fit_kws = {'kws': {'parameter_map': f.compile_parameters()}}
+    if jacobian and xerr is None and method in ('leastsq', 'least_squares'):
+        fit_kws['Dfun'] = chisquare_jacobian
 
     if verbose:
         def iter_cb(params, iter, resid, *args, **kwargs):
@@ -180,39 +476,52 @@ def chisquare_fit(f, x, y, yerr=None, xerr=None, func=None, verbose=True, hessia
          def iter_cb(params, iter, resid, *args, **kwargs):
             pass
 
-    result = lm.minimize(chisquare_model, params, args=(f, x, np.hstack(y), np.hstack(yerr), xerr, func), iter_cb=iter_cb, method=method)
-    f.params = copy.deepcopy(result.params)
-    f.chisqr_chi = copy.deepcopy(result.chisqr)
-
-    success = False
-    counter = 0
-    while not success:
-        result = lm.minimize(chisquare_model, result.params, args=(f, x, np.hstack(y), np.hstack(yerr), xerr, func), iter_cb=iter_cb, method=method)
+    with _region_of_interest(f, x, y) as region, _workspace(f, x if region is None else region.inside):
+        fit_kws['kws']['region'] = region
+        if varpro:
+            reduced, reduced_map, linear = _linear_setup(f, params)
+            if linear[0]:
+                kws = {'parameter_map': reduced_map, 'linear': linear, 'region': region}
+                result = lm.minimize(chisquare_model, reduced, args=(f, x, y, yerr, xerr, func), kws=kws, iter_cb=iter_cb, method=method)
+                # Solve the linear parameters in the optimum before releasing them
+                chisquare_model(result.params, f, x, y, yerr, xerr, func, **kws)
+                params = _linear_release(result.params, f, linear[0])
+
+        result = lm.minimize(chisquare_model, params, args=(f, x, y, yerr, xerr, func), iter_cb=iter_cb, method=method, **fit_kws)
         f.params = copy.deepcopy(result.params)
-        success = np.isclose(result.chisqr, f.chisqr_chi)
         f.chisqr_chi = copy.deepcopy(result.chisqr)
-        if counter > 10 and not success:
-            break
-    if verbose:
-        progress.set_description('Chisquare fitting done')
-        progress.close()
 
-    f.ndof_chi = copy.deepcopy(result.nfree)
-    f.redchi_chi = copy.deepcopy(result.redchi)
-    f.chisq_res_par = copy.deepcopy(f.params)
-    f.aic_chi = copy.deepcopy(result.aic)
-    f.bic_chi = copy.deepcopy(result.bic)
-    if hessian:
-        if verbose:
-            progress = tqdm.tqdm(desc='Starting Hessian calculation', leave=True, miniters=1)
-        else:
-            progress = None
-        assign_hessian_estimate(lambda *args: (chisquare_model(*args)**2).sum(), f, f.chisq_res_par, x, np.hstack(y), np.hstack(yerr), xerr, func, progress=progress)
-    else:
-        for key in f.params.keys():
-            if f.params[key].stderr is not None:
-                f.params[key].stderr /= f.redchi_chi**0.5
-                f.chisq_res_par[key].stderr /= f.redchi_chi**0.5
+        # The restarts polish the fit with the exact lineshapes.
+        with exact_profiles(f):
+            success = False
+            counter = 0
+            while not success:
+                result = lm.minimize(chisquare_model, result.params, args=(f, x, y, yerr, xerr, func), iter_cb=iter_cb, method=method, **fit_kws)
+                f.params = copy.deepcopy(result.params)
+                success = np.isclose(result.chisqr, f.chisqr_chi)
+                f.chisqr_chi = copy.deepcopy(result.chisqr)
+                if counter > 10 and not success:
+                    break
+            if verbose:
+                progress.set_description('Chisquare fitting done')
+                progress.close()
+
+            f.ndof_chi = copy.deepcopy(result.nfree)
+            f.redchi_chi = copy.deepcopy(result.redchi)
+            f.chisq_res_par = copy.deepcopy(f.params)
+            f.aic_chi = copy.deepcopy(result.aic)
+            f.bic_chi = copy.deepcopy(result.bic)
+            if hessian:
+                if verbose:
+                    progress = tqdm.tqdm(desc='Starting Hessian calculation', leave=True, miniters=1)
+                else:
+                    progress = None
+                assign_hessian_estimate(lambda *args: (chisquare_model(*args)**2).sum(), f, f.chisq_res_par, x, y, yerr, xerr, func, progress=progress)
+            else:
+                for key in f.params.keys():
+                    if f.params[key].stderr is not None:
+                        f.params[key].stderr /= f.redchi_chi**0.5
+                        f.chisq_res_par[key].stderr /= f.redchi_chi**0.5
 
     return success, result.message
 
@@ -275,7 +584,7 @@ def likelihood_x_err(f, x, y, xerr, func):
             -np.inf, np.inf)[0] for i, (X, Y, XERR) in enumerate(zip(x, y, xerr))
         ]).sum())
 
-def likelihood_lnprob(params, f, x, y, xerr, func):
+def likelihood_lnprob(params, f, x, y, xerr, func, parameter_map=None, linear=None, region=None):
     """Calculates the logarithm of the probability that the data fits
     the model given the current parameters.
 
@@ -296,11 +605,28 @@ def likelihood_lnprob(params, f, x, y, xerr, func):
         Function calculating the loglikelihood of y_data being drawn from
         a distribution characterized by y_model.
 
+    Other parameters
+    ----------------
+    parameter_map: :class:`.ParameterMap`, optional
+        If given, the values are passed to the model through the map
+        instead of assigning *params*.
+    linear: tuple, optional
+        Names and boundaries of the linear parameters, which are solved
+        for by an iteratively reweighted least squares fit, converging to
+        the Poisson maximum likelihood. Only used together with
+        *parameter_map*, see :func:`likelihood_fit`.
+    region: object, optional
+        Region of interest of the model for the data, in which the peaks are
+        evaluated. Only used together with *parameter_map*, and when *xerr*
+        is not given. Set by the fitting routines, see :attr:`.HFSModel.roi`.
+
     Note
     ----
     The prior is first evaluated for the parameters. If this is
     not finite, the values are rejected from consideration by
     immediately returning -np.inf."""
+    if parameter_map is not None:
+        return _vector_lnprob(parameter_map.vector(params), parameter_map, f, x, y, xerr, func, linear=linear, region=region)
     # Handle old-style BaseModel children by using .lnprior().
     try:
         lp = f.get_lnprior_mapping(params)
@@ -312,6 +638,24 @@ def likelihood_lnprob(params, f, x, y, xerr, func):
     res = lp + np.sum(likelihood_loglikelihood(f, x, y, xerr, func))
     return res
 
+def _vector_lnprob(theta, parameter_map, f, x, y, xerr, func, linear=None, region=None):
+    # Same as likelihood_lnprob, for the vector of the varying parameters.
+    # Values outside of the boundaries are rejected before updating the model.
+    if np.any(theta < parameter_map.min) or np.any(theta > parameter_map.max):
+        return -np.inf
+    f._set_values(parameter_map.resolve(theta))
+    if linear is not None:
+        _project_linear(f, x, y, linear, poisson=True)
+    try:
+        lp = f.get_lnprior_mapping(f.params)
+    except AttributeError:
+        lp = f.lnprior()
+    if not np.isfinite(lp):
+        return -np.inf
+    if region is not None and (xerr is None or np.allclose(0, xerr)):
+        return lp + region.loglikelihood(f, func)
+    return lp + np.sum(likelihood_loglikelihood(f, x, y, xerr, func))
+
 def likelihood_loglikelihood(f, x, y, xerr, func):
     """Given a parameters object, a Model object, experimental data
     and a loglikelihood function, calculates the loglikelihood for
@@ -338,14 +682,14 @@ def likelihood_loglikelihood(f, x, y, xerr, func):
         Array containing the loglikelihood for each seperate datapoint."""
     # If a value is given to the uncertainty on the x-values, use the adapted
     # function.
-    y = np.hstack(y)
+    y = _flatten(y)
     if xerr is None or np.allclose(0, xerr):
         return_value = func(y, f, x)
     else:
         return_value = likelihood_x_err(f, x, y, xerr, func)
     return return_value
 
-def likelihood_fit(f, x, y, xerr=None, func=llh.poisson_llh, method='nelder-mead', method_kws={}, walking=False, walk_kws={}, verbose=True, hessian=True):
+def likelihood_fit(f, x, y, xerr=None, func=llh.poisson_llh, method='nelder-mead', method_kws={}, walking=False, walk_kws={}, verbose=True, hessian=True, varpro=False):
     """Fits the given model to the given data using the Maximum Likelihood Estimation technique.
     The given function is used to calculate the loglikelihood. After the fit, the message
     from the optimizer is printed and returned.
@@ -388,6 +732,14 @@ def likelihood_fit(f, x, y, xerr=None, func=llh.poisson_llh, method='nelder-mead
     hessian: boolean, optional
         When set to *True*, the Hessian estimate of the uncertainty will be
         calculated.
+    varpro: boolean, optional
+        When set to *True*, the fit starts with a variable projection:
+        the parameters given by :meth:`.BaseModel.linear_parameters` are
+        solved for by a few iteratively reweighted least squares steps, which
+        converge to the Poisson maximum likelihood, while the minimizer
+        only searches over the other parameters. The fit is then finished
+        with all parameters varying. Only possible with the Poisson
+        loglikelihood. Defaults to *False*.
 
     Returns
     -------
@@ -406,7 +758,7 @@ def likelihood_fit(f, x, y, xerr=None, func=llh.poisson_llh, method='nelder-mead
         else:
             pass
 
-    y = np.hstack(y)
+    y = _flatten(y)
     params = copy.deepcopy(f.params)
     # Eliminate the estimated uncertainties
     for p in params:
@@ -414,53 +766,194 @@ def likelihood_fit(f, x, y, xerr=None, func=llh.poisson_llh, method='nelder-mead
     if verbose:
         progress = tqdm.tqdm(leave=True, desc='Likelihood fitting in progress')
 
-    result = lm.Minimizer(negativeloglikelihood, params, fcn_args=(f, x, y, xerr, func), iter_cb=iter_cb)
-    result = result.minimize(method=method, params=params, **method_kws)
-    f.params = copy.deepcopy(result.params)
-    val = negativeloglikelihood(f.params, f, x, y, xerr, func)
-    success = False
-    counter = 0
-    while not success:
-        result = lm.Minimizer(negativeloglikelihood, result.params, fcn_args=(f, x, y, xerr, func), iter_cb=iter_cb)
-        result.scalar_minimize(method=method, **method_kws)
-        counter += 1
+    with _region_of_interest(f, x, y) as region, _workspace(f, x if region is None else region.inside):
+        if varpro:
+            if func is not llh.poisson_llh:
+                raise ValueError('Variable projection is only possible with the Poisson loglikelihood.')
+            reduced, reduced_map, linear = _linear_setup(f, params)
+            if linear[0]:
+                kws = {'parameter_map': reduced_map, 'linear': linear, 'region': region}
+                result = lm.Minimizer(negativeloglikelihood, reduced, fcn_args=(f, x, y, xerr, func), fcn_kws=kws, iter_cb=iter_cb)
+                result = result.minimize(method=method, params=reduced, **method_kws)
+                # Solve the linear parameters in the optimum before releasing them
+                negativeloglikelihood(result.params, f, x, y, xerr, func, **kws)
+                params = _linear_release(result.params, f, linear[0])
+
+        parameter_map = f.compile_parameters()
+        result = lm.Minimizer(negativeloglikelihood, params, fcn_args=(f, x, y, xerr, func), fcn_kws={'parameter_map': parameter_map, 'region': region}, iter_cb=iter_cb)
+        result = result.minimize(method=method, params=params, **method_kws)
         f.params = copy.deepcopy(result.params)
-        new_val = negativeloglikelihood(f.params, f, x, y, xerr, func)
-        success = np.isclose(val, new_val)
-        val = new_val
-        if not success and counter > 10:
-            break
-    if verbose:
-        progress.set_description('Likelihood fitting done')
-        progress.close()
-    f.ndof_mle = copy.deepcopy(result.nfree)
-    f.fit_mle = copy.deepcopy(result.params)
-    f.result_mle = result.message
-    f.likelihood_mle = negativeloglikelihood(f.params, f, x, y, xerr, func)
-    try:
-        f.chisqr_mle = np.sum(-2 * likelihood_loglikelihood(f, x, y, xerr, func) + 2 * likelihood_loglikelihood(lambda i: y, x, y, xerr, func))
-    except AttributeError:
-        f.chisqr_mle = np.nan
-    # if np.isnan(f.chisqr_mle):
-    #     print('Used loglikelihood does not allow calculation of reduced chisquare for these data points! Does it contain 0 or negative numbers?')
-    try:
-        f.redchi_mle = f.chisqr_mle / f.ndof_mle
-    except:
-        f.redchi_mle = f.chisqr_mle / (len(y) - len([p for p in f.params if f.params[p].vary]))
+        # The restarts polish the fit with the exact lineshapes.
+        with exact_profiles(f):
+            val = negativeloglikelihood(f.params, f, x, y, xerr, func)
+            success = False
+            counter = 0
+            while not success:
+                result = lm.Minimizer(negativeloglikelihood, result.params, fcn_args=(f, x, y, xerr, func), fcn_kws={'parameter_map': parameter_map, 'region': region}, iter_cb=iter_cb)
+                result.scalar_minimize(method=method, **method_kws)
+                counter += 1
+                f.params = copy.deepcopy(result.params)
+                new_val = negativeloglikelihood(f.params, f, x, y, xerr, func)
+                success = np.isclose(val, new_val)
+                val = new_val
+                if not success and counter > 10:
+                    break
+            if verbose:
+                progress.set_description('Likelihood fitting done')
+                progress.close()
+            f.ndof_mle = copy.deepcopy(result.nfree)
+            f.fit_mle = copy.deepcopy(result.params)
+            f.result_mle = result.message
+            f.likelihood_mle = negativeloglikelihood(f.params, f, x, y, xerr, func)
+            try:
+                f.chisqr_mle = np.sum(-2 * likelihood_loglikelihood(f, x, y, xerr, func) + 2 * likelihood_loglikelihood(lambda i: y, x, y, xerr, func))
+            except AttributeError:
+                f.chisqr_mle = np.nan
+            # if np.isnan(f.chisqr_mle):
+            #     print('Used loglikelihood does not allow calculation of reduced chisquare for these data points! Does it contain 0 or negative numbers?')
+            try:
+                f.redchi_mle = f.chisqr_mle / f.ndof_mle
+            except:
+                f.redchi_mle = f.chisqr_mle / (len(y) - len([p for p in f.params if f.params[p].vary]))
 
-    if hessian:
-        if verbose:
-            progress = tqdm.tqdm(leave=True, desc='Starting Hessian calculation')
-        else:
-            progress = None
+            if hessian:
+                if verbose:
+                    progress = tqdm.tqdm(leave=True, desc='Starting Hessian calculation')
+                else:
+                    progress = None
 
-        assign_hessian_estimate(likelihood_lnprob, f, f.fit_mle, x, y, xerr, func, likelihood=True, progress=progress)
-        f.params = copy.deepcopy(f.fit_mle)
+                assign_hessian_estimate(likelihood_lnprob, f, f.fit_mle, x, y, xerr, func, likelihood=True, progress=progress)
+                f.params = copy.deepcopy(f.fit_mle)
 
     if walking:
         likelihood_walk(f, x, y, xerr=xerr, func=func, **walk_kws)
     return success, result.message
 
+###################
+# SPIN ASSIGNMENT #
+###################
+
+def _scan_initializer(intensities):
+    # The Racah intensities calculated by the main process
+    # are shared with the worker processes.
+    wigner._intensities.update(intensities)
+
+def _scan_hypothesis(task):
+    # Builds and fits the model for a single spin hypothesis.
+    from satlas.models.hfsmodel import HFSModel
+    I, J, x, y, method, ABC, centroid, guess, model_kws, fit_kws = task
+    start = time.time()
+    row = {'I': I, 'J lower': J[0], 'J upper': J[1]}
+    try:
+        model = HFSModel(I, J, ABC, centroid, **model_kws)
+        if guess:
+            model.guess(x, y)
+        if method == 'chisquare':
+            success, message = chisquare_spectroscopic_fit(model, x, y, **fit_kws)
+            row.update({'Chisquare': model.chisqr_chi, 'Reduced chisquare': model.redchi_chi,
+                        'AIC': model.aic_chi, 'BIC': model.bic_chi})
+        else:
+            success, message = likelihood_fit(model, x, y, **fit_kws)
+            row.update({'Chisquare': model.chisqr_mle, 'Reduced chisquare': model.redchi_mle})
+        loglikelihood = np.sum(likelihood_loglikelihood(model, x, y, None, llh.poisson_llh))
+        if method != 'chisquare':
+            k = len(model.compile_parameters().varying)
+            row.update({'AIC': 2 * k - 2 * loglikelihood, 'BIC': k * np.log(np.size(y)) - 2 * loglikelihood})
+        row.update({'Loglikelihood': loglikelihood, 'Success': bool(success), 'Message': message})
+    except Exception as e:
+        model = None
+        row.update({'Chisquare': np.nan, 'Reduced chisquare': np.nan, 'AIC': np.nan, 'BIC': np.nan,
+                    'Loglikelihood': np.nan, 'Success': False, 'Message': str(e)})
+    row['Time (s)'] = time.time() - start
+    row['Model'] = model
+    return row
+
+def spin_scan(x, y, hypotheses, J=None, ABC=[0, 0, 0, 0, 0, 0], centroid=0, method='chisquare', guess=True, processes=None, model_kws={}, fit_kws={}, sort_by='AIC'):
+    """Fits a :class:`.HFSModel` for each spin hypothesis to the same counting data,
+    and ranks the hypotheses. The Racah intensities are calculated once,
+    after which the models are fitted concurrently in a pool of processes.
+
+    Parameters
+    ----------
+    x: array_like
+        Experimental data for the x-axis.
+    y: array_like
+        Counts for each value of *x*.
+    hypotheses: list
+        Nuclear spins to try, or tuples (*I*, *J*) with *J* a list
+        of the spins of the lower and upper fine structure levels.
+
+    Other parameters
+    ----------------
+    J: list of 2 floats, optional
+        Spins of the fine structure levels, for the hypotheses only
+        giving the nuclear spin.
+    ABC: list of 6 floats, optional
+        Starting values of the hyperfine parameters, see :class:`.HFSModel`.
+        Defaults to zero, relying on *guess* for the starting values.
+    centroid: float, optional
+        Starting value of the centroid. Defaults to 0.
+    method: {'chisquare', 'mle'}
+        Fit with :func:`chisquare_spectroscopic_fit` or :func:`likelihood_fit`.
+        Defaults to 'chisquare'.
+    guess: boolean, optional
+        If True, the starting values are set by :meth:`.HFSModel.guess`
+        before the fit. Defaults to True.
+    processes: int, optional
+        Number of processes, defaults to the number of processors. With
+        1 process, the hypotheses are fitted one by one in this process.
+    model_kws: dict, optional
+        Keywords passed on to :class:`.HFSModel`, such as the shape,
+        FWHM and background parameters.
+    fit_kws: dict, optional
+        Keywords passed on to the fitting routine. By default, no
+        progress is shown and the Hessian is not estimated.
+    sort_by: str, optional
+        Column by which the hypotheses are ranked: 'AIC', 'BIC', 'Chisquare'
+        or 'Loglikelihood' (highest first). Defaults to 'AIC'.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Row for each hypothesis in order of rank, with the spins, the
+        chisquare, loglikelihood, AIC and BIC of the fit and their differences
+        with the best hypothesis, the success of the fit, the message of
+        the optimizer, the time taken and the fitted model.
+
+    Note
+    ----
+    For the chisquare fits, the AIC and BIC are those reported by lmfit. For
+    the likelihood fits, they are calculated from the loglikelihood. The
+    loglikelihood is the Poisson loglikelihood of the data for the fitted model."""
+    import pandas as pd
+    if method not in ('chisquare', 'mle'):
+        raise KeyError("Method must be 'chisquare' or 'mle'.")
+    x, y = np.asarray(x, dtype='float'), np.asarray(y)
+    kws = {'verbose': False} if method == 'chisquare' else {'verbose': False, 'hessian': False}
+    kws.update(fit_kws)
+    tasks = []
+    for hypothesis in hypotheses:
+        I, spins = hypothesis if isinstance(hypothesis, (list, tuple)) else (hypothesis, J)
+        if spins is None:
+            raise ValueError('No spins of the fine structure levels given for I={}.'.format(I))
+        wigner.racah_intensities(I, spins[0], spins[1])
+        tasks.append((I, list(spins), x, y, method, ABC, centroid, guess, model_kws, kws))
+
+    if processes == 1 or len(tasks) == 1:
+        rows = [_scan_hypothesis(task) for task in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes, initializer=_scan_initializer, initargs=(dict(wigner._intensities),)) as pool:
+            rows = list(pool.map(_scan_hypothesis, tasks))
+
+    columns = ['I', 'J lower', 'J upper', 'Chisquare', 'Reduced chisquare', 'Loglikelihood', 'AIC', 'BIC',
+               'Delta AIC', 'Delta BIC', 'Success', 'Message', 'Time (s)', 'Model']
+    frame = pd.DataFrame(rows)
+    frame['Delta AIC'] = frame['AIC'] - frame['AIC'].min()
+    frame['Delta BIC'] = frame['BIC'] - frame['BIC'].min()
+    frame = frame.sort_values(sort_by, ascending=sort_by != 'Loglikelihood', na_position='last')
+    return frame[columns].reset_index(drop=True)
+
 ############################
 # UNCERTAINTY CALCULATIONS #
 ############################
@@ -519,6 +1012,8 @@ def assign_hessian_estimate(func, f, params, *args, **kwargs):
     Returns
     -------
     None"""
+    import numdifftools as nd
+
     likelihood = kwargs.pop('likelihood', False)
     progress = kwargs.pop('progress', False)
     if progress is not None:
@@ -618,10 +1113,12 @@ def create_band(f, x, x_data, y_data, yerr, xerr=None, method='chisquare', func_
     bound: array_like
         Array describing the deviation from the model value as can be expected
         for the selected parameters at the 1:math:`\sigma` level."""
+    import numdifftools as nd
+
     method_mapping = {'mle': likelihood_lnprob,
                       'chisquare': lambda *args: (chisquare_model(*args)**2).sum()}
     if method == 'chisquare':
-        args = x_data, np.hstack(y_data), np.hstack(yerr), xerr, func_chi
+        args = x_data, _flatten(y_data), _flatten(yerr), xerr, func_chi
     else:
         args = x_data, y_data, xerr, func_llh, False
     func = method_mapping.pop(method)
@@ -880,6 +1377,36 @@ def calculate_analytical_uncertainty(f, x, y, method='chisquare_spectroscopic',
     state = tuple(state)
     _set_state(f, state, method=method.lower())
 
+def _uses_priors(f):
+    # Checks if the model, or one of its submodels, has literature values
+    # or other priors attached to the parameters.
+    if len(getattr(f, '_lnprior_mapping', {})) > 0:
+        return True
+    return any([_uses_priors(model) for model in getattr(f, 'models', [])])
+
+class _BatchPool(object):
+    # Stands in for the pool of the sampler: instead of calling the
+    # probability function for each walker, the positions of all walkers
+    # are evaluated at once with evaluate_batch. Only used if the prior
+    # is the same for all positions within the boundaries.
+    def __init__(self, parameter_map, f, x, y, func):
+        super(_BatchPool, self).__init__()
+        self.parameter_map = parameter_map
+        self.f = f
+        self.x = x
+        self.y = _flatten(y)
+        self.func = func
+        self.lnprior = f.get_lnprior_mapping(f.params)
+
+    def map(self, function, positions):
+        theta = np.array(positions, dtype='float')
+        inside = np.all((theta >= self.parameter_map.min) & (theta <= self.parameter_map.max), axis=1)
+        lnprob = np.full(theta.shape[0], -np.inf)
+        if inside.any():
+            response = self.f.evaluate_batch(theta[inside], self.x, self.parameter_map)
+            lnprob[inside] = [self.lnprior + np.sum(self.func(self.y, lambda x, row=row: row, self.x)) for row in response]
+        return lnprob
+
 def likelihood_walk(f, x, y, xerr=None, func=llh.poisson_llh, nsteps=2000, walkers=20, filename=None):
     """Calculates the uncertainty on MLE-optimized parameter values
     by performing a random walk through parameter space and comparing
@@ -920,7 +1447,10 @@ def likelihood_walk(f, x, y, xerr=None, func=llh.poisson_llh, nsteps=2000, walke
     The parameters associated with the MLE fit are not updated
     with the uncertainty as estimated by this method."""
 
-    params = f.params
+    import h5py
+    from satlas.stats import emcee as mcmc
+
+    params = copy.deepcopy(f.params)
     var_names = []
     vars = []
     for key in params.keys():
@@ -933,22 +1463,17 @@ def likelihood_walk(f, x, y, xerr=None, func=llh.poisson_llh, nsteps=2000, walke
         pos[:, i] = np.where(pos[:, i] < params[var_names[i]].min, params[var_names[i]].min+(1E-5), pos[:, i])
         pos[:, i] = np.where(pos[:, i] > params[var_names[i]].max, params[var_names[i]].max-(1E-5), pos[:, i])
 
-    def lnprobList(fvars, groupParams, f, x, y, xerr, func):
-        for val, n in zip(fvars, var_names):
-            groupParams[n].value = val
-        return likelihood_lnprob(groupParams, f, x, y, xerr, func)
+    parameter_map = f.compile_parameters()
+    def lnprobList(fvars, f, x, y, xerr, func):
+        return _vector_lnprob(fvars, parameter_map, f, x, y, xerr, func)
 
-    p = f.params.copy()
-    groupParams = f.params.copy()
-    for key in params.keys():
-        groupParams[key] = PriorParameter(key,
-                                          value=params[key].value,
-                                          vary=params[key].vary,
-                                          expr=params[key].expr,
-                                          priormin=params[key].min,
-                                          priormax=params[key].max)
+    # Without an uncertainty on x and priors, all walkers are evaluated at once
+    if (xerr is None or np.allclose(0, xerr)) and hasattr(f, 'get_lnprior_mapping') and not _uses_priors(f):
+        pool = _BatchPool(parameter_map, f, x, y, func)
+    else:
+        pool = None
     sampler = mcmc.EnsembleSampler(walkers, ndim, lnprobList,
-                                   args=(groupParams, f, x, y, xerr, func))
+                                   args=(f, x, y, xerr, func), pool=pool)
 
     if filename is None:
         import time
@@ -998,6 +1523,8 @@ def process_walk(model, filename, selection=(0, 100)):
         Sets the lower and upper boundary of the percentage of the random walk
         to take into account. Can be used to eliminate burn-in.
         Defaults to (0, 100)."""
+    import h5py
+
     p = model.params.copy()
     with h5py.File(filename, 'r') as store:
         columns = store['data'].attrs['format']
@@ -1,2 +1,11 @@
 from satlas.utilities.utilities import *
-from satlas.utilities.plotting import *
+
+# The plotting routines need matplotlib and h5py, so that module is
+# only imported when one of its functions is first requested.
+_plotting = ['generate_correlation_map', 'generate_correlation_plot', 'generate_walk_plot']
+
+def __getattr__(name):
+    if name in _plotting:
+        from satlas.utilities import plotting
+        return getattr(plotting, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -3,13 +3,16 @@ Implementation of various functions that ease the work, but do not belong in one
 
 .. moduleauthor:: Wouter Gins <wouter.gins@kuleuven.be>
 """
+import itertools
+
 import numpy as np
 
 __all__ = ['weighted_average',
            'generate_spectrum',
            'poisson_interval',
            'beta',
-           'dopplerfactor']
+           'dopplerfactor',
+           'ScanConversion']
 
 def weighted_average(x, sigma, axis=None):
     r"""Takes the weighted average of an array of values and the associated
@@ -185,6 +188,125 @@ def dopplerfactor(mass, V):
     dopplerFactor = np.sqrt((1.0 - betaFactor) / (1.0 + betaFactor))
     return dopplerFactor
 
+class ScanConversion(object):
+
+    r"""Converts the scan voltage of a collinear laser spectroscopy
+    measurement to the frequency seen by the ions, relative to a
+    reference frequency. The total voltage is the acceleration voltage
+    plus the scan voltage, and the frequency in the rest frame is
+
+    .. math::
+
+        \nu = \nu_{laser}\sqrt{\frac{1\mp\beta}{1\pm\beta}}
+
+    with the upper signs for collinear and the lower signs for
+    anticollinear geometry, see :func:`dopplerfactor`.
+
+    The frequencies are calculated once for the scan voltages of a
+    dataset, after which the model is fitted to the frequencies. The
+    uncertainty on the scan voltage is converted with the analytical
+    derivative, and can be given as *xerr* to the fitting routines.
+    An instance can also be used as the :attr:`.TransformHFSModel.pre_transform`.
+    Every assignment to an attribute changes :attr:`version`, so the
+    frequencies kept by the model are calculated again."""
+
+    _versions = itertools.count()
+
+    def __init__(self, mass, laser_frequency, charge=1, acceleration_voltage=0.0, reference=0.0, anticollinear=False):
+        """Parameters
+        ----------
+        mass: float
+            Mass of the ions in amu.
+        laser_frequency: float
+            Frequency of the laser in MHz.
+
+        Other parameters
+        ----------------
+        charge: int, optional
+            Charge state of the ions, defaults to 1.
+        acceleration_voltage: float, optional
+            Voltage in volt added to the scan voltage, defaults to 0.
+        reference: float, optional
+            Frequency in MHz subtracted from the result, defaults to 0.
+        anticollinear: boolean, optional
+            If True, the laser and the ions travel in opposite
+            directions. Defaults to False."""
+        super(ScanConversion, self).__init__()
+        self.mass = mass
+        self.laser_frequency = laser_frequency
+        self.charge = charge
+        self.acceleration_voltage = acceleration_voltage
+        self.reference = reference
+        self.anticollinear = anticollinear
+
+    def __setattr__(self, name, value):
+        super(ScanConversion, self).__setattr__(name, value)
+        if name != 'version':
+            # Unique over all instances, so a new instance is never
+            # mistaken for an older one
+            super(ScanConversion, self).__setattr__('version', next(ScanConversion._versions))
+
+    def _frequency(self, V):
+        # Frequency in the rest frame, without the reference
+        V = np.asarray(V, dtype='float') + self.acceleration_voltage
+        factor = dopplerfactor(self.mass, self.charge * V)
+        if self.anticollinear:
+            factor = 1.0 / factor
+        return self.laser_frequency * factor
+
+    def __call__(self, V):
+        """Frequency for the scan voltages *V*.
+
+        Parameters
+        ----------
+        V: float or array_like
+            Scan voltage in volt.
+
+        Returns
+        -------
+        float or NumPy array
+            Frequency in MHz, relative to the reference."""
+        return self._frequency(V) - self.reference
+
+    def derivative(self, V):
+        r"""Derivative of the frequency to the scan voltage,
+
+        .. math::
+
+            \frac{d\nu}{dV} = \mp\nu\frac{\gamma-1}{\gamma\beta V_{total}}
+
+        Parameters
+        ----------
+        V: float or array_like
+            Scan voltage in volt.
+
+        Returns
+        -------
+        float or NumPy array
+            Derivative in MHz/V."""
+        total = np.asarray(V, dtype='float') + self.acceleration_voltage
+        b = beta(self.mass, self.charge * total)
+        gamma = 1.0 / np.sqrt(1.0 - b * b)
+        derivative = self._frequency(V) * (gamma - 1.0) / (gamma * b * total)
+        return derivative if self.anticollinear else -derivative
+
+    def uncertainty(self, V, Verr):
+        """Uncertainty on the frequency from the uncertainty on
+        the scan voltage.
+
+        Parameters
+        ----------
+        V: float or array_like
+            Scan voltage in volt.
+        Verr: float or array_like
+            Uncertainty on the scan voltage in volt.
+
+        Returns
+        -------
+        float or NumPy array
+            Uncertainty in MHz."""
+        return np.abs(self.derivative(V)) * Verr
+
 def extract_result(filename, filter=None, bins=None, selection=(0, 100)):
     with h5py.File(filename, 'r') as store:
         columns = store['data'].attrs['format']
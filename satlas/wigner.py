@@ -0,0 +1,203 @@
+"""
+Exact calculation of the Wigner 3j and 6j symbols and the Racah intensities
+of hyperfine transitions, using integer arithmetic. Calculated values are
+kept in memory, and the Racah intensities can also be stored in a file
+so they are shared between processes.
+
+.. moduleauthor:: Wouter Gins <wouter.gins@kuleuven.be>
+"""
+import json
+import os
+from fractions import Fraction
+from math import factorial, sqrt
+
+__all__ = ['wigner_3j', 'wigner_6j', 'racah_intensities', 'set_cache_file']
+
+_symbols = {}
+_intensities = {}
+_cache_file = None
+
+def _twice(j):
+    # Converts an integer or half-integer to twice its value.
+    value = int(round(2 * float(j)))
+    if abs(value - 2 * float(j)) > 1e-8:
+        raise ValueError('{} is not an integer or half-integer!'.format(j))
+    return value
+
+def _triangle(a, b, c):
+    # Squared triangle coefficient for twice the angular momenta,
+    # None if the triangle condition is not fulfilled.
+    if (a + b + c) % 2 or c > a + b or c < abs(a - b):
+        return None
+    return Fraction(factorial((a + b - c) // 2) * factorial((a - b + c) // 2) * factorial((-a + b + c) // 2),
+                    factorial((a + b + c) // 2 + 1))
+
+def _signed_sqrt(value):
+    # Signed square root of an exact square with sign, as a float.
+    if value == 0:
+        return 0.0
+    sign = 1 if value > 0 else -1
+    return sign * sqrt(abs(value))
+
+def _wigner_3j(j1, j2, j3, m1, m2, m3):
+    # Squared value with the sign, from the Racah formula, for twice the arguments.
+    if m1 + m2 + m3 != 0 or abs(m1) > j1 or abs(m2) > j2 or abs(m3) > j3:
+        return 0
+    if (j1 + m1) % 2 or (j2 + m2) % 2 or (j3 + m3) % 2:
+        return 0
+    delta = _triangle(j1, j2, j3)
+    if delta is None:
+        return 0
+    j1, j2, j3, m1, m2, m3 = [v // 2 if v % 2 == 0 else Fraction(v, 2) for v in (j1, j2, j3, m1, m2, m3)]
+    ints = lambda *values: [int(v) for v in values]
+    prefactor = delta
+    for v in ints(j1 + m1, j1 - m1, j2 + m2, j2 - m2, j3 + m3, j3 - m3):
+        prefactor *= factorial(v)
+    low = max(0, int(j2 - j3 - m1), int(j1 - j3 + m2))
+    high = min(int(j1 + j2 - j3), int(j1 - m1), int(j2 + m2))
+    total = 0
+    for k in range(low, high + 1):
+        denominator = 1
+        for v in ints(k, j1 + j2 - j3 - k, j1 - m1 - k, j2 + m2 - k, j3 - j2 + m1 + k, j3 - j1 - m2 + k):
+            denominator *= factorial(v)
+        total += Fraction((-1) ** k, denominator)
+    sign = (-1) ** int(j1 - j2 - m3)
+    value = total * total * prefactor
+    return sign * value if total >= 0 else -sign * value
+
+def _wigner_6j(j1, j2, j3, j4, j5, j6):
+    # Squared value with the sign, from the Racah formula, for twice the arguments.
+    deltas = [_triangle(j1, j2, j3), _triangle(j1, j5, j6), _triangle(j4, j2, j6), _triangle(j4, j5, j3)]
+    if any([d is None for d in deltas]):
+        return 0
+    prefactor = deltas[0] * deltas[1] * deltas[2] * deltas[3]
+    a = [(j1 + j2 + j3) // 2, (j1 + j5 + j6) // 2, (j4 + j2 + j6) // 2, (j4 + j5 + j3) // 2]
+    b = [(j1 + j2 + j4 + j5) // 2, (j2 + j3 + j5 + j6) // 2, (j3 + j1 + j6 + j4) // 2]
+    total = 0
+    for t in range(max(a), min(b) + 1):
+        denominator = 1
+        for v in [t - v for v in a] + [v - t for v in b]:
+            denominator *= factorial(v)
+        total += Fraction((-1) ** t * factorial(t + 1), denominator)
+    value = total * total * prefactor
+    return value if total >= 0 else -value
+
+def wigner_3j(j1, j2, j3, m1, m2, m3):
+    r"""Wigner 3j symbol
+
+    .. math::
+        \begin{pmatrix}j_1 & j_2 & j_3\\m_1 & m_2 & m_3\end{pmatrix}
+
+    calculated exactly and converted to a float.
+
+    Parameters
+    ----------
+    j1, j2, j3, m1, m2, m3: integer or half-integer
+        Arguments of the symbol.
+
+    Returns
+    -------
+    float"""
+    key = ('3j',) + tuple([_twice(j) for j in (j1, j2, j3, m1, m2, m3)])
+    try:
+        return _symbols[key]
+    except KeyError:
+        value = _signed_sqrt(_wigner_3j(*key[1:]))
+        _symbols[key] = value
+        return value
+
+def wigner_6j(j1, j2, j3, j4, j5, j6):
+    r"""Wigner 6j symbol
+
+    .. math::
+        \begin{Bmatrix}j_1 & j_2 & j_3\\j_4 & j_5 & j_6\end{Bmatrix}
+
+    calculated exactly and converted to a float.
+
+    Parameters
+    ----------
+    j1, j2, j3, j4, j5, j6: integer or half-integer
+        Arguments of the symbol.
+
+    Returns
+    -------
+    float"""
+    key = ('6j',) + tuple([_twice(j) for j in (j1, j2, j3, j4, j5, j6)])
+    try:
+        return _symbols[key]
+    except KeyError:
+        value = _signed_sqrt(_wigner_6j(*key[1:]))
+        _symbols[key] = value
+        return value
+
+def racah_intensities(I, J_lower, J_upper, order=1):
+    r"""Racah intensities of all transitions between the hyperfine levels
+    of two fine structure levels,
+
+    .. math::
+        (2F+1)(2F'+1)\begin{Bmatrix}J' & F' & I\\F & J & k\end{Bmatrix}^2
+
+    Parameters
+    ----------
+    I: integer or half-integer
+        Nuclear spin.
+    J_lower, J_upper: integer or half-integer
+        Spins of the lower and upper fine structure levels.
+    order: integer, optional
+        Multipolarity *k* of the transition, defaults to 1.
+
+    Returns
+    -------
+    dict
+        Intensity for each combination (*F*, *F'*), including
+        the forbidden combinations with intensity 0."""
+    key = tuple([_twice(j) for j in (I, J_lower, J_upper, order)])
+    try:
+        return _intensities[key]
+    except KeyError:
+        pass
+    i, jl, ju, k = key
+    intensities = {}
+    for fl in range(abs(i - jl), i + jl + 1, 2):
+        for fu in range(abs(i - ju), i + ju + 1, 2):
+            value = (fl + 1) * (fu + 1) * _wigner_6j(ju, fu, i, fl, jl, k)
+            intensities[(fl / 2.0, fu / 2.0)] = float(abs(value))
+    _intensities[key] = intensities
+    if _cache_file is not None:
+        _store(key, intensities)
+    return intensities
+
+def set_cache_file(filename):
+    """Sets the file in which the Racah intensities are stored. The
+    intensities already present in the file are loaded, and newly
+    calculated intensities are added to it. Set to *None* to only
+    keep the values in memory.
+
+    Parameters
+    ----------
+    filename: str or None
+        Name of the JSON file used as cache."""
+    global _cache_file
+    _cache_file = filename
+    if filename is not None and os.path.isfile(filename):
+        for key, value in _load(filename).items():
+            _intensities.setdefault(key, value)
+
+def _load(filename):
+    with open(filename, 'r') as f:
+        stored = json.load(f)
+    loaded = {}
+    for key, entries in stored.items():
+        loaded[tuple([int(v) for v in key.split(',')])] = {(fl, fu): value for fl, fu, value in entries}
+    return loaded
+
+def _store(key, intensities):
+    # Merges the new intensities with the content of the file; the
+    # file is replaced at once so other processes never read half a file.
+    stored = _load(_cache_file) if os.path.isfile(_cache_file) else {}
+    stored[key] = intensities
+    content = {','.join([str(v) for v in k]): [[fl, fu, value] for (fl, fu), value in sorted(entries.items())] for k, entries in stored.items()}
+    temporary = '{}.{}.tmp'.format(_cache_file, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(content, f)
+    os.replace(temporary, _cache_file)
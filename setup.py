@@ -15,7 +15,6 @@ setup(
   install_requires=['numpy>=1.5',
                     'scipy>=0.13',
                     'lmfit',
-                    'sympy',
                     'matplotlib',
                     'pandas',
                     'h5py',
@@ -0,0 +1,382 @@
+import copy
+import satlas
+from satlas.models.basemodel import BaseModel, Workspace
+import numpy as np
+
+x = np.linspace(-3000, 3000, 301)
+
+def create_model():
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, scale=100, background_params=[0.01, 5],
+                            sidepeak_params={'N': 1, 'Poisson': 0.3, 'Offset': 40})
+    model.fix_ratio(2.5, target='upper', parameter='A')
+    return model
+
+def test_parameter_map():
+    model = create_model()
+    parameter_map = model.compile_parameters()
+    theta = parameter_map.vector(model.params)
+    values = parameter_map.resolve(theta + 1)
+    params = model.params.copy()
+    for name in parameter_map.varying:
+        params[name].value += 1
+    params.update_constraints()
+    assert set(values.keys()) == set(params.keys())
+    assert all([np.isclose(values[name], params[name].value) for name in params.keys()])
+
+def test_evaluate():
+    model = create_model()
+    parameter_map = model.compile_parameters()
+    theta = parameter_map.vector(model.params)
+    np.random.seed(0)
+    for step in np.random.normal(scale=0.01, size=(3, theta.size)):
+        response = model.evaluate(theta * (1 + step), x, parameter_map)
+        reference = create_model()
+        params = reference.params.copy()
+        for name, value in zip(parameter_map.varying, theta * (1 + step)):
+            params[name].value = value
+        reference.params = params
+        assert np.allclose(response, reference(x), rtol=1e-12)
+        assert np.isclose(model.params['Au'].value, 2.5 * model.params['Al'].value)
+
+def test_evaluate_summodel():
+    first = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, scale=100)
+    second = satlas.HFSModel(2.5, [0.5, 1.5], [-500, 50, 0, 0, 0, 0], 400, scale=50)
+    model = satlas.SumModel([first, second])
+    parameter_map = model.compile_parameters()
+    theta = parameter_map.vector(model.params)
+    response = model.evaluate(theta, x, parameter_map)
+    assert np.allclose(response, first(x) + second(x), rtol=1e-12)
+    index = parameter_map.varying.index('s1_Centroid')
+    theta[index] += 100
+    response = model.evaluate(theta, x, parameter_map)
+    assert np.isclose(second.params['s1_Centroid'].value, 500)
+    assert np.isclose(first.params['s0_Centroid'].value, 0)
+    assert np.allclose(response, first(x) + second(x), rtol=1e-12)
+
+def reference_batch(model, theta, parameter_map):
+    params = model.params.copy()
+    response = []
+    for row in theta:
+        response.append(np.hstack(model.evaluate(row, x if not isinstance(model, satlas.LinkedModel) else [x, x], parameter_map)))
+    model.params = params
+    return np.vstack(response)
+
+def test_evaluate_batch():
+    models = [create_model(),
+              satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, shape='pseudovoigt', fwhm=40, shared_fwhm=False),
+              satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, use_saturation=True, saturation=2.0),
+              satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, shape='crystalball', fwhm=40),
+              satlas.SumModel([satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0),
+                               satlas.HFSModel(2.5, [0.5, 1.5], [-500, 50, 0, 0, 0, 0], 400, shape='lorentzian', fwhm=40)]),
+              satlas.LinkedModel([satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0),
+                                  satlas.PolynomialModel([5, 0.01])]),
+              satlas.TransformHFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0)]
+    models[-1].post_transform = lambda y, x: y * (1 + x ** 2 * 1e-7)
+    np.random.seed(0)
+    for model in models:
+        parameter_map = model.compile_parameters()
+        theta = parameter_map.vector(model.params)
+        theta = theta * (1 + np.random.normal(scale=0.01, size=(7, theta.size)))
+        original = model.params.copy()
+        X = [x, x] if isinstance(model, satlas.LinkedModel) else x
+        batch = model.evaluate_batch(theta, X, parameter_map, block_size=5000)
+        assert all([original[name].value == par.value for name, par in model.params.items()])
+        assert batch.shape == (7, np.hstack(X).size)
+        assert np.allclose(batch, reference_batch(model, theta, parameter_map), rtol=1e-10)
+
+def test_walk_batch():
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, scale=100, background_params=[2], fwhm=[40, 30])
+    np.random.seed(1)
+    y = np.random.poisson(model(x))
+    parameter_map = model.compile_parameters()
+    theta = parameter_map.vector(model.params) * (1 + np.random.normal(scale=0.01, size=(10, len(parameter_map.varying))))
+    theta[3, 0] = -1
+    pool = satlas.stats.fitting._BatchPool(parameter_map, model, x, y, satlas.poisson_llh)
+    reference = [satlas.stats.fitting._vector_lnprob(row, parameter_map, model, x, y, None, satlas.poisson_llh) for row in theta]
+    assert np.allclose(pool.map(None, list(theta)), reference, rtol=1e-12)
+
+def test_linear_basis():
+    for model in [create_model(), satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, scale=100, use_racah=True),
+                  satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0) + satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 500)]:
+        names = model.linear_parameters()
+        assert len(names) > 0
+        basis, rest = model.linear_basis(x, names)
+        reference = BaseModel.linear_basis(model, x, names)
+        assert np.allclose(basis, reference[0], rtol=1e-8, atol=1e-10)
+        assert np.allclose(rest + basis.dot([model.params[name].value for name in names]), model(x))
+
+def test_varpro():
+    x = np.linspace(-3000, 3000, 601)
+    true = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, background_params=[2], fwhm=[40, 30])
+    params = true.params
+    for label in true.ftof:
+        params['Amp' + label].value *= 100
+    true.params = params
+    np.random.seed(1)
+    y = np.random.poisson(true(x))
+    results = []
+    for varpro in [False, True]:
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1010, 98, 30, 10, 0, 0], 5, background_params=[1], fwhm=[50, 20])
+        satlas.chisquare_spectroscopic_fit(model, x, y, verbose=False, varpro=varpro)
+        results.append(model.chisqr_chi)
+    assert np.isclose(results[0], results[1], rtol=1e-6)
+    # The Poisson projection converges to the maximum likelihood of the linear parameters
+    fitting = satlas.stats.fitting
+    reduced, parameter_map, linear = fitting._linear_setup(model, model.params)
+    fitting.likelihood_lnprob(reduced, model, x, y, None, satlas.loglikelihood.poisson_llh, parameter_map=parameter_map, linear=linear)
+    basis, rest = model.linear_basis(x, linear[0])
+    score = basis.T.dot(y / model(x) - 1)
+    assert np.allclose(score, 0, atol=1e-3 * np.abs(basis).sum(axis=0))
+
+def test_varpro_bound():
+    # A line without intensity puts its projected amplitude on the boundary
+    x = np.linspace(-3000, 3000, 601)
+    true = satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, background_params=[2], fwhm=[40, 30], scale=100)
+    params = true.params
+    params['Amp' + true.ftof[1]].value = 0
+    true.params = params
+    np.random.seed(1)
+    y = np.random.poisson(true(x))
+    results = []
+    for varpro in [False, True]:
+        model = satlas.HFSModel(1.5, [0.5, 1.5], [1010, 98, 30, 10, 0, 0], 5, background_params=[1], fwhm=[50, 20], scale=100)
+        success, message = satlas.likelihood_fit(model, x, y, verbose=False, hessian=False, varpro=varpro)
+        assert success
+        assert model.params['Amp' + true.ftof[1]].value >= 0
+        results.append(model.likelihood_mle)
+    assert np.isclose(results[0], results[1], rtol=1e-4)
+
+def test_guess():
+    np.random.seed(3)
+    x = np.linspace(-6000, 6000, 3001)
+    true = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], -200, fwhm=[40, 30], scale=50, background_params=[3], sidepeak_params={'N': 1, 'Poisson': 0.3, 'Offset': -150})
+    y = np.random.poisson(true(x))
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [0, 0, 0, 0, 0, 0], 0, fwhm=[60, 60], scale=1, background_params=[1], sidepeak_params={'N': 1, 'Poisson': 0.3, 'Offset': -150})
+    model.guess(x, y)
+    assert abs(model.params['Centroid'].value + 200) < 10
+    assert abs(model.params['Al'].value - 1000) < 10
+    assert abs(model.params['Au'].value - 100) < 5
+    assert abs(model.params['Background0'].value - 3) < 0.5
+    assert abs(model.params['FWHMG'].value - 35) < 10
+    # Fixed parameters keep their value
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[60, 60], background_params=[1], sidepeak_params={'N': 1, 'Poisson': 0.3, 'Offset': -150}, use_racah=True)
+    model.set_variation({'Al': False, 'FWHMG': False})
+    model.guess(x, y)
+    assert model.params['Al'].value == 1000
+    assert model.params['FWHMG'].value == 60
+    assert abs(model.params['Centroid'].value + 200) < 10
+    assert abs(model.params['Scale'].value - 50) < 10
+
+def test_workspace():
+    for binned in [False, True]:
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[2, 1e-3, 1e-6], binned=binned)
+        expected = model(x.copy())
+        model.workspace = Workspace(x)
+        for _ in range(2):
+            assert np.allclose(model(x), expected, rtol=1e-12)
+        out = np.zeros(expected.shape)
+        assert model(x, out=out) is out
+        assert np.allclose(out, expected, rtol=1e-12)
+        model.workspace = None
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[2])
+    other = satlas.HFSModel(1.5, [0.5, 1.5], [500, 50, 0, 0, 0, 0], 300, fwhm=[40, 30], scale=50, background_params=[1])
+    for combined, X in [(model + other, x), (satlas.LinkedModel([model, other]), [x, x[:100]])]:
+        expected = combined(X)
+        combined.workspace = Workspace(X)
+        out = np.zeros(expected.shape)
+        assert combined(X, out=out) is out
+        assert np.allclose(out, expected, rtol=1e-12)
+        combined.workspace = None
+        assert all([m.workspace is None for m in combined.models])
+    # The fits only use the workspace during the fit
+    y = np.random.poisson(model(x))
+    satlas.chisquare_spectroscopic_fit(model, x, y, verbose=False)
+    assert model.workspace is None
+
+def test_workspace_output():
+    # The response in the array of the workspace is not copied
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[2])
+    model.workspace = Workspace(x)
+    response = model(x)
+    assert not response.flags.writeable
+    assert np.shares_memory(response, model(x))
+    model.workspace = None
+    # During the fits, the response is written in the same output array
+    y = np.random.poisson(model(x))
+    outputs = []
+    original = satlas.HFSModel.__call__
+    def recorded(self, X, out=None):
+        if self.workspace is not None and X is self.workspace.x:
+            outputs.append(out)
+        return original(self, X, out=out)
+    satlas.HFSModel.__call__ = recorded
+    try:
+        for fit in [satlas.chisquare_spectroscopic_fit, satlas.likelihood_fit]:
+            del outputs[:]
+            fit(model, x, y, verbose=False, hessian=False)
+            # Only the first evaluation allocates the output array
+            assert len(outputs) > 10
+            assert outputs[0] is None
+            assert isinstance(outputs[1], np.ndarray)
+            assert all([out is outputs[1] for out in outputs[1:]])
+    finally:
+        satlas.HFSModel.__call__ = original
+
+def test_clone():
+    model = satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[5], use_racah=True)
+    model.fix_ratio(0.1, target='upper', parameter='A')
+    expected = model(x)
+    copied = copy.deepcopy(model)
+    assert copied.C is model.C and copied.parts[0] is not model.parts[0]
+    assert np.allclose(copied(x), expected, rtol=1e-12)
+    clone = model.clone({'Al': 1200, 'Centroid': 150}, prefix='iso_')
+    assert clone.params['iso_Au'].expr == '0.1*iso_Al' and np.isclose(clone.params['iso_Au'].value, 120)
+    reference = satlas.HFSModel(1.5, [0.5, 1.5], [1200, 120, 0, 10, 0, 0], 150, fwhm=[40, 30], scale=100, background_params=[5], use_racah=True)
+    assert np.allclose(clone(x), reference(x), rtol=1e-12)
+    # The template is not changed
+    assert np.allclose(model(x), expected, rtol=1e-12)
+    assert model.params['Al'].value == 1000
+
+def test_transform_cache():
+    calls = []
+    def voltage_to_frequency(v):
+        calls.append(v)
+        return 4.0 * v
+    model = satlas.TransformHFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[5])
+    model.pre_transform = voltage_to_frequency
+    v = x / 4
+    reference = satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[5])
+    for centroid in [0, 10, 20]:
+        model.set_value({'Centroid': centroid})
+        reference.set_value({'Centroid': centroid})
+        assert np.allclose(model(v), reference(x), rtol=1e-12)
+    assert len(calls) == 1
+    # Changing the input in place or assigning a new transform is detected
+    v[0] = 0
+    model(v)
+    assert len(calls) == 2
+    model.pre_transform = lambda v: 2.0 * v
+    assert np.allclose(model(v[1:]), reference(x[1:] / 2), rtol=1e-12)
+    # A read-only array is recognized by its identity
+    model.pre_transform = voltage_to_frequency
+    v.setflags(write=False)
+    for _ in range(3):
+        assert np.allclose(model(v), reference(4.0 * v), rtol=1e-12)
+    assert len(calls) == 3
+
+def test_scan_conversion():
+    for anticollinear in [False, True]:
+        conversion = satlas.ScanConversion(40, 7.5e8, acceleration_voltage=30000, reference=7.5e8, anticollinear=anticollinear)
+        V = np.linspace(-500, 500, 101)
+        numerical = (conversion(V + 10) - conversion(V - 10)) / 20
+        assert np.allclose(conversion.derivative(V), numerical, rtol=1e-5)
+        assert np.allclose(conversion.uncertainty(V, 0.5), 0.5 * np.abs(numerical), rtol=1e-5)
+        doppler = satlas.dopplerfactor(40, V + 30000)
+        assert np.allclose(conversion(V) + 7.5e8, 7.5e8 * (1 / doppler if anticollinear else doppler))
+    # Used as the transformation of the input
+    model = satlas.TransformHFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[5])
+    model.pre_transform = conversion
+    reference = satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[5])
+    assert np.allclose(model(V), reference(conversion(V)))
+    # Changing the conversion changes the frequencies
+    model.set_value({'Centroid': conversion(0)})
+    reference.set_value({'Centroid': conversion(0)})
+    before = model(V)
+    conversion.acceleration_voltage = 20000
+    assert np.allclose(model(V), reference(conversion(V)))
+    assert not np.allclose(model(V), before)
+    conversion.mass = 80
+    assert np.allclose(model(V), reference(conversion(V)))
+
+def test_compile():
+    a = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[2, 1e-3])
+    b = satlas.HFSModel(1.5, [0.5, 1.5], [500, 50, 0, 0, 0, 0], 300, fwhm=[40, 30], scale=50, background_params=[1])
+    c = satlas.HFSModel(2.5, [0.5, 1.5], [-500, 50, 0, 0, 0, 0], 400, shape='lorentzian', fwhm=40)
+    d = satlas.HFSModel(1.5, [0.5, 1.5], [500, 50, 0, 0, 0, 0], 20, fwhm=[40, 30], sidepeak_params={'N': 1, 'Poisson': 0.5, 'Offset': -200})
+    e = satlas.HFSModel(1.5, [0.5, 1.5], [500, 50, 0, 0, 0, 0], 310, shape='gaussian', fwhm=40)
+    model = satlas.LinkedModel([satlas.SumModel([a, b, c]), d, satlas.SumModel([e, satlas.PolynomialModel([5, 0.01])])])
+    X = [x, x[:500], x[100:]]
+    plan = model.compile(block_size=5000)
+    assert plan.segments == [(0,), (1,), (2,)]
+    assert np.allclose(plan(X), model(X), rtol=1e-12)
+    # The plan follows the parameters of the models
+    params = model.params
+    params['s0_s1_Centroid'].value = 100
+    params['s2_s0_Background0'].value = 3
+    model.params = params
+    out = np.zeros(sum([X_.size for X_ in X]))
+    assert plan(X, out=out) is out
+    assert np.allclose(out, model(X), rtol=1e-12)
+    assert np.allclose(a.compile()(x), a(x), rtol=1e-12)
+
+def test_shared_parameters():
+    models = [satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 100 * i, fwhm=[40, 30], scale=100, background_params=[5]) for i in range(3)]
+    model = satlas.LinkedModel([satlas.SumModel(models[:2]), models[2]])
+    X = [x, x]
+    assert models[1].params['Centroid'] is model.params['s0_s1_Centroid']
+    parameter_map = model.compile_parameters()
+    theta = parameter_map.vector(model.params)
+    theta[parameter_map.varying.index('s1_Centroid')] = 250
+    response = model.evaluate(theta, X, parameter_map)
+    assert model.params['s1_Centroid'].value == 250
+    reference = satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 250, fwhm=[40, 30], scale=100, background_params=[5])
+    assert np.allclose(response[x.size:], reference(x), rtol=1e-12)
+    # A copy shares its own parameters
+    copied = copy.deepcopy(model)
+    copied.set_value({'s1_Centroid': 0})
+    assert copied.models[1].params['Centroid'] is copied.params['s1_Centroid']
+    assert np.allclose(copied(X)[x.size:], models[0](x), rtol=1e-12)
+    assert np.allclose(model(X), response, rtol=1e-12)
+
+def test_linked_cache():
+    models = [satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 100 * i, fwhm=[40, 30], scale=100, background_params=[5]) for i in range(3)]
+    model = satlas.LinkedModel([models[0], satlas.SumModel(models[1:])])
+    model.shared = ['Bu']
+    X = [x, x[:150]]
+    response = model(X)
+    calls = []
+    original = satlas.HFSModel.__call__
+    def counted(self, x, **kwargs):
+        calls.append(self)
+        return original(self, x, **kwargs)
+    satlas.HFSModel.__call__ = counted
+    try:
+        # Only the submodel with a changed value is evaluated again
+        model.set_value({'s0_Centroid': 50})
+        changed = model(X)
+        assert calls == [models[0]]
+        assert np.allclose(changed[x.size:], response[x.size:], rtol=1e-12)
+        del calls[:]
+        assert np.allclose(model(X), changed, rtol=1e-12)
+        assert calls == []
+        # A shared parameter changes all submodels
+        model.set_value({'s0_Bu': 50})
+        model(X)
+        assert set(calls) == set(models)
+        del calls[:]
+        model(X[::-1])
+        assert len(calls) == 3
+    finally:
+        satlas.HFSModel.__call__ = original
+    params = model.params
+    fresh = satlas.LinkedModel([satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[5]),
+                                satlas.SumModel([satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 100 * i, fwhm=[40, 30], scale=100, background_params=[5]) for i in (1, 2)])])
+    fresh.shared = ['Bu']
+    fresh.params = params
+    assert np.allclose(model(X), fresh(X), rtol=1e-12)
+    assert np.allclose(model.jacobian(X), fresh.jacobian(X), rtol=1e-6)
+
+def test_spin_scan():
+    np.random.seed(4)
+    x = np.linspace(-4000, 4000, 2001)
+    true = satlas.HFSModel(1.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 150, fwhm=[40, 30], scale=100, background_params=[5], use_racah=True)
+    y = np.random.poisson(true(x))
+    hypotheses = [0.5, 1.5, 2.5, (3.5, [0.5, 1.5])]
+    frame = satlas.spin_scan(x, y, hypotheses, J=[0.5, 1.5], processes=2, model_kws={'use_racah': True})
+    assert list(frame['I']) == [1.5, 2.5, 3.5, 0.5]
+    assert frame['Success'].all()
+    assert frame['Delta AIC'][0] == 0
+    assert np.all(np.diff(frame['AIC']) > 0)
+    assert abs(frame['Model'][0].params['Al'].value - 1000) < 5
+    serial = satlas.spin_scan(x, y, hypotheses, J=[0.5, 1.5], processes=1, model_kws={'use_racah': True})
+    assert np.allclose(serial['AIC'], frame['AIC'])
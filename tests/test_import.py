@@ -0,0 +1,35 @@
+import subprocess
+import sys
+import os
+import satlas
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(satlas.__file__)))
+lazy = ['matplotlib.pyplot', 'h5py', 'sympy', 'satlas.utilities.plotting', 'satlas.stats.emcee']
+# Budget in microseconds for the import time spent in the satlas modules
+# themselves, excluding the time spent importing numpy, scipy, lmfit, ...
+budget = 250000
+
+def import_times(statement, own=False):
+    # Cumulative import time in microseconds of every module imported by the
+    # statement, or the time spent in the module itself if own is True
+    env = dict(os.environ, PYTHONPATH=root)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            env=env, cwd=root, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_time if own else cumulative)
+    return times
+
+def test_import_time():
+    timings = [import_times('import satlas', own=True) for _ in range(3)]
+    owned = [sum([t for name, t in times.items() if name.split('.')[0] == 'satlas']) for times in timings]
+    assert min(owned) < budget
+    for module in lazy:
+        assert module not in timings[0]
+    # The lazily imported modules are loaded on first use
+    times = import_times('import satlas; satlas.generate_correlation_plot')
+    assert 'satlas.utilities.plotting' in times
+    assert 'matplotlib.pyplot' in times
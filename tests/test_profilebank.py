@@ -0,0 +1,281 @@
+import satlas.profiles
+import satlas
+from satlas.models.basemodel import BaseModel
+import numpy as np
+
+x = np.linspace(-500, 500, 2001)
+
+def reference_response(model, x):
+    # Evaluation of the model using the seperate profiles
+    s = model.params['Scale'].value * sum([prof(x) for prof in model.parts])
+    background = [model.params['Background' + str(int(deg))].value for deg in reversed(list(range(model.background_degree + 1)))]
+    return s + np.polyval(background, x)
+
+def test_bank_shapes():
+    mu = [-100, 0, 30, 250]
+    amp = [1, 0.3, 2.5, 0.7]
+    fwhm = [20, 35, 10, 50]
+    for shape in [satlas.profiles.Gaussian, satlas.profiles.Lorentzian, satlas.profiles.Voigt,
+                  satlas.profiles.AsymmLorentzian, satlas.profiles.PseudoVoigt]:
+        parts = [shape(fwhm=f, mu=m, amp=a) for f, m, a in zip(fwhm, mu, amp)]
+        bank = satlas.profiles.ProfileBank(parts, block_size=1000)
+        assert np.allclose(bank(x), sum([prof(x) for prof in parts]), rtol=1e-12, atol=0)
+
+def test_bank_update():
+    parts = [satlas.profiles.Voigt(fwhm=[10, 20], mu=m) for m in [-50, 50]]
+    bank = satlas.profiles.ProfileBank(parts)
+    parts[0].mu = 10
+    parts[1].fwhm = [30, 5]
+    bank.update()
+    assert np.allclose(bank(x), parts[0](x) + parts[1](x), rtol=1e-12, atol=0)
+
+def test_hfsmodel_bank():
+    for shape in ['voigt', 'gaussian', 'lorentzian', 'crystalball', 'pseudovoigt', 'asymmlorentzian']:
+        fwhm = [30, 20] if shape == 'voigt' else 40
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=fwhm, shape=shape)
+        assert np.allclose(model(x), reference_response(model, x), rtol=1e-12, atol=0)
+
+def test_windowed_evaluation():
+    x = np.linspace(-20000, 20000, 40001)
+    np.random.seed(0)
+    mus = np.random.uniform(-15000, 15000, 10)
+    for fwhm in [[30, 20], [30, 0.5]]:
+        parts = [satlas.profiles.Voigt(fwhm=fwhm, mu=m) for m in mus]
+        full = satlas.profiles.ProfileBank(parts)(x)
+        windowed = satlas.profiles.ProfileBank(parts, tolerance=1e-6)
+        assert np.allclose(windowed(x), full, rtol=1e-6, atol=0)
+        shuffled = np.random.permutation(x.size)
+        assert np.allclose(windowed(x[shuffled]), full[shuffled], rtol=1e-6, atol=0)
+    parts = [satlas.profiles.Gaussian(fwhm=40, mu=m) for m in mus]
+    full = satlas.profiles.ProfileBank(parts)(x)
+    windowed = satlas.profiles.ProfileBank(parts, tolerance=1e-6)(x)
+    assert np.allclose(windowed, full, rtol=0, atol=1e-6)
+    # The tail of the Lorentzian profile is exact
+    parts = [satlas.profiles.Lorentzian(fwhm=40, mu=m) for m in mus]
+    full = satlas.profiles.ProfileBank(parts)(x)
+    windowed = satlas.profiles.ProfileBank(parts, tolerance=1e-6)
+    assert np.allclose(windowed(x), full, rtol=1e-12, atol=0)
+    assert np.allclose(windowed(x[shuffled]), full[shuffled], rtol=1e-12, atol=0)
+
+def test_voigt_backends():
+    errors = {'humlicek': 1e-4, 'weideman': 5e-6}
+    for fwhm in [[30, 1e-4], [30, 20], [1, 200]]:
+        exact = satlas.profiles.Voigt(fwhm=fwhm, mu=20, ampIsArea=True)
+        for backend, error in errors.items():
+            prof = satlas.profiles.Voigt(fwhm=fwhm, mu=20, ampIsArea=True, backend=backend)
+            assert np.allclose(prof(x), exact(x), rtol=error, atol=0)
+        prof = satlas.profiles.Voigt(fwhm=fwhm, mu=20, ampIsArea=True, backend='pseudovoigt')
+        assert np.allclose(prof(x), exact(x), rtol=0, atol=0.013 * exact(20))
+
+def test_hfsmodel_voigt_backend():
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[30, 20], voigt_backend='humlicek')
+    assert all([prof.backend == 'humlicek' for prof in model.parts])
+    approximated = model(x)
+    with satlas.stats.fitting.exact_profiles(model):
+        assert model.voigt_backend == 'wofz'
+        exact = model(x)
+    assert model.voigt_backend == 'humlicek'
+    assert np.allclose(approximated, exact, rtol=1e-4, atol=0)
+
+def test_voigt_table():
+    x = np.linspace(-5000, 5000, 20001)
+    for fwhm in [[30, 1e-4], [30, 20], [1, 200]]:
+        exact = satlas.profiles.Voigt(fwhm=fwhm, mu=20)
+        prof = satlas.profiles.Voigt(fwhm=fwhm, mu=20, backend='table')
+        assert np.allclose(prof(x), exact(x), rtol=1.1e-6, atol=0)
+    parts = [satlas.profiles.Voigt(fwhm=fwhm, mu=m, backend='table') for fwhm, m in zip([[30, 20], [20, 30], [30, 20]], [-50, 0, 50])]
+    exact = sum([satlas.profiles.Voigt(fwhm=fwhm, mu=m)(x) for fwhm, m in zip([[30, 20], [20, 30], [30, 20]], [-50, 0, 50])])
+    assert np.allclose(satlas.profiles.ProfileBank(parts)(x), exact, rtol=1.1e-6, atol=0)
+
+def test_integrate():
+    edges = np.array([-500, -60, -20, -5, 0, 3, 17, 40, 200, 900])
+    fine = np.linspace(-500, 900, 1400001)
+    for prof in [satlas.profiles.Gaussian(fwhm=20, mu=2, amp=3), satlas.profiles.Lorentzian(fwhm=20, mu=2),
+                 satlas.profiles.Voigt(fwhm=[20, 7], mu=2), satlas.profiles.AsymmLorentzian(fwhm=20, mu=2, asymm=0.1),
+                 satlas.profiles.PseudoVoigt(fwhm=20, mu=2, eta=0.3), satlas.profiles.Crystalball(fwhm=20, mu=2, alpha=1.2, n=3)]:
+        # Reference by the trapezoidal rule on a fine grid
+        cumulative = np.concatenate([[0], np.cumsum(0.5 * (prof(fine[1:]) + prof(fine[:-1])) * np.diff(fine))])
+        reference = np.diff(np.interp(edges, fine, cumulative))
+        assert np.allclose(prof.integrate(edges[:-1], edges[1:]), reference, rtol=1e-6, atol=1e-9)
+
+def test_hfsmodel_binned():
+    edges = np.linspace(-6000, 6000, 201)
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[30, 20], scale=100, background_params=[0.01, 5],
+                            sidepeak_params={'N': 1, 'Poisson': 0.3, 'Offset': 40}, binned=True)
+    binned = model(edges)
+    model.binned = False
+    fine = np.linspace(-6000, 6000, 200001)
+    reference = model(0.5 * (fine[1:] + fine[:-1])).reshape(200, -1).mean(axis=1)
+    assert binned.shape == (200,)
+    assert np.allclose(binned, reference, rtol=1e-6)
+
+def test_derivatives():
+    h = 1e-6
+    def central(prof, attr, value):
+        setattr(prof, attr, value + h)
+        up = prof(x)
+        setattr(prof, attr, value - h)
+        down = prof(x)
+        setattr(prof, attr, value)
+        return (up - down) / (2 * h)
+    for shape in [satlas.profiles.Gaussian, satlas.profiles.Lorentzian, satlas.profiles.Voigt,
+                  satlas.profiles.AsymmLorentzian, satlas.profiles.PseudoVoigt]:
+        for area in [False, True]:
+            fwhm = np.array([20.0, 10.0]) if shape is satlas.profiles.Voigt else 20.0
+            prof = shape(fwhm=fwhm, mu=2, amp=3, ampIsArea=area)
+            d = prof.derivatives(x)
+            assert np.allclose(d['value'], prof(x))
+            assert np.allclose(d['x'], (prof(x + h) - prof(x - h)) / (2 * h), rtol=1e-5, atol=1e-8)
+            assert np.allclose(d['mu'], central(prof, 'mu', 2.0), rtol=1e-5, atol=1e-8)
+            assert np.allclose(d['amp'], central(prof, 'amp', 3.0), rtol=1e-5, atol=1e-8)
+            if shape is satlas.profiles.Voigt:
+                for i, key in enumerate(['fwhmG', 'fwhmL']):
+                    step = np.zeros(2)
+                    step[i] = h
+                    prof.fwhm = fwhm + step
+                    up = prof(x)
+                    prof.fwhm = fwhm - step
+                    down = prof(x)
+                    prof.fwhm = fwhm
+                    assert np.allclose(d[key], (up - down) / (2 * h), rtol=1e-5, atol=1e-8)
+            else:
+                assert np.allclose(d['fwhm'], central(prof, 'fwhm', 20.0), rtol=1e-5, atol=1e-8)
+
+def test_hfsmodel_derivative():
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[30, 20], scale=100, background_params=[0.01, 5],
+                            sidepeak_params={'N': 1, 'Poisson': 0.3, 'Offset': 40})
+    x = np.linspace(-3000, 3000, 601)
+    h = 1e-5
+    assert np.allclose(model.derivative(x), (model(x + h) - model(x - h)) / (2 * h), rtol=1e-5, atol=1e-6)
+
+def test_xerr_fit():
+    # Without sidepeaks, the Offset and Poisson parameters do not exist
+    x = np.linspace(-3000, 3000, 601)
+    true = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, scale=100, background_params=[2], fwhm=[40, 30])
+    np.random.seed(1)
+    y = np.random.poisson(true(x))
+    h = 1e-5
+    assert np.allclose(true.derivative(x), (true(x + h) - true(x - h)) / (2 * h), rtol=1e-5, atol=1e-6)
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1010, 98, 30, 10, 0, 0], 5, scale=90, background_params=[2], fwhm=[50, 20])
+    success, message = satlas.chisquare_spectroscopic_fit(model, x, y, xerr=np.full(x.shape, 0.5), verbose=False)
+    assert success
+    assert abs(model.params['Al'].value - 1000) < 10
+
+def test_hfsmodel_jacobian():
+    x = np.linspace(-3000, 3000, 301)
+    for kwargs in [{}, {'shape': 'lorentzian', 'fwhm': 40, 'shared_fwhm': False}, {'use_saturation': True, 'saturation': 2.0},
+                   {'shape': 'crystalball', 'fwhm': 40}, {'sidepeak_params': {'N': 2, 'Poisson': 0.3, 'Offset': 40}}]:
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, scale=100, background_params=[0.01, 5], **kwargs)
+        model.fix_ratio(2.5, target='upper', parameter='A')
+        analytical = model.jacobian(x)
+        numerical = BaseModel.jacobian(model, x)
+        assert np.allclose(analytical, numerical, rtol=1e-4, atol=1e-5)
+
+def test_chisquare_jacobian():
+    x = np.linspace(-3000, 3000, 601)
+    true = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, scale=100, background_params=[2], fwhm=[40, 30])
+    np.random.seed(1)
+    y = np.random.poisson(true(x))
+    results = []
+    for jacobian in [False, True]:
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1010, 98, 30, 10, 0, 0], 5, scale=90, background_params=[2], fwhm=[50, 20])
+        satlas.chisquare_spectroscopic_fit(model, x, y, verbose=False, jacobian=jacobian)
+        results.append(model.chisqr_chi)
+    assert np.isclose(results[0], results[1], rtol=1e-6)
+
+def test_hfsmodel_partial_update():
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[30, 20], background_params=[0.01, 5])
+    response = model(x)
+    assert np.array_equal(model(x), response)
+    locations = model.locations
+    fwhm = [prof.fwhm for prof in model.parts]
+    params = model.params.copy()
+    params['Background0'].value = 10
+    model.params = params
+    assert model.locations is locations
+    assert all([f is prof.fwhm for f, prof in zip(fwhm, model.parts)])
+    assert np.allclose(model(x), response + 9.99, rtol=1e-12)
+    params['Centroid'].value = 50
+    params['FWHMG'].value = 40
+    model.params = params
+    assert np.allclose(model(x), reference_response(model, x), rtol=1e-12, atol=0)
+    reference = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 50, fwhm=[40, 20], background_params=[10, 5])
+    assert np.allclose(model(x), reference(x), rtol=1e-12, atol=0)
+
+def test_parameter_assignment():
+    # Values assigned to the Parameter objects are used in the next evaluation
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 0, fwhm=[30, 20], scale=100, background_params=[5])
+    model(x)
+    model.params['Scale'].value = 50
+    model.params['Centroid'].value = 20
+    model.params['Background0'].value = 2
+    reference = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 0, 10, 0, 0], 20, fwhm=[30, 20], scale=50, background_params=[2])
+    assert np.allclose(model(x), reference(x), rtol=1e-12)
+    assert np.allclose(model.background(x), 2)
+    assert np.allclose(model.derivative(x), reference.derivative(x), rtol=1e-12)
+    # Also for the last response kept by a LinkedModel
+    linked = satlas.LinkedModel([model, satlas.HFSModel(1.5, [0.5, 1.5], [500, 50, 0, 0, 0, 0], 0, fwhm=[30, 20])])
+    linked([x, x])
+    linked.params['s0_Scale'].value = 100
+    reference.params['Scale'].value = 100
+    assert np.allclose(linked([x, x])[:x.size], reference(x), rtol=1e-12)
+
+def test_sidepeak_methods():
+    x = np.linspace(-3000, 3000, 6001)
+    for binned in [False, True]:
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, fwhm=[30, 20], scale=100, background_params=[2],
+                                sidepeak_params={'N': 3, 'Poisson': 0.5, 'Offset': -45.3}, binned=binned)
+        exact = model(x)
+        model.sidepeak_method = 'broadcast'
+        assert np.allclose(model(x), exact, rtol=1e-12, atol=0)
+        model.sidepeak_method = 'interpolate'
+        assert np.allclose(model(x), exact, rtol=1e-7, atol=0)
+        # Non-uniform grids fall back to the broadcast evaluation
+        assert np.allclose(model(x[::-1]), exact[::-1], rtol=1e-12, atol=0)
+
+def test_roi():
+    x = np.linspace(-20000, 20000, 4001)
+    full = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[2])
+    model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, fwhm=[40, 30], scale=100, background_params=[2], roi=30)
+    mask = model.roi_mask(x)
+    assert len(model.roi_windows()) == 1
+    assert np.allclose(model(x)[mask], full(x)[mask], rtol=1e-12)
+    assert np.allclose(model(x)[~mask], 2, rtol=1e-12)
+    assert np.allclose(model.jacobian(x), BaseModel.jacobian(model, x), rtol=1e-4, atol=1e-5)
+    model.roi = [(-5000, -3000), (-4000, 0), (1000, 2000)]
+    assert model.roi_windows() == [(-5000, 0), (1000, 2000)]
+    np.random.seed(1)
+    y = np.random.poisson(full(x))
+    results = []
+    for roi in [None, 30]:
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1010, 98, 30, 10, 0, 0], 5, fwhm=[50, 20], scale=90, background_params=[1], roi=roi)
+        satlas.chisquare_spectroscopic_fit(model, x, y, verbose=False)
+        results.append(model.chisqr_chi)
+        assert model.roi == roi
+    assert np.isclose(results[0], results[1], rtol=1e-3)
+
+def test_frozen_shape():
+    x = np.linspace(-3000, 3000, 3001)
+    for binned in [False, True]:
+        kws = dict(fwhm=[40, 30], scale=100, background_params=[2], binned=binned, sidepeak_params={'N': 2, 'Poisson': 0.5, 'Offset': -200})
+        model = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, frozen_shape=True, **kws)
+        exact = satlas.HFSModel(3.5, [0.5, 1.5], [1000, 100, 30, 10, 0, 0], 0, **kws)
+        assert not exact.frozen_shape
+        assert not model._frozen()
+        variation = dict([(name, False) for name in model.params if name not in ('Centroid', 'Scale', 'Background0')])
+        model.set_variation(variation)
+        exact.set_variation(variation)
+        assert model._frozen()
+        for centroid in [0, 13.3, -77.7, 500]:
+            for m in [model, exact]:
+                m.params['Centroid'].value = centroid
+                m.params = m.params
+            assert np.allclose(model(x), exact(x), rtol=0, atol=1e-3)
+        assert model._grid is not None
+        with satlas.stats.fitting.exact_profiles(model):
+            assert np.allclose(model(x), exact(x), rtol=1e-12)
+        assert model.frozen_shape
+        # The grid is calculated again with the new tolerance
+        model(x)
+        model.tolerance = 1e-6
+        assert model._grid is None
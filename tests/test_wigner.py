@@ -0,0 +1,27 @@
+import satlas.wigner
+import numpy as np
+
+def test_symbols():
+    assert np.isclose(satlas.wigner.wigner_6j(1, 1, 1, 1, 1, 1), 1 / 6.0, rtol=1e-15)
+    assert np.isclose(satlas.wigner.wigner_6j(0.5, 0.5, 1, 0.5, 0.5, 0), 0.5, rtol=1e-15)
+    assert satlas.wigner.wigner_6j(0.5, 0.5, 3, 0.5, 0.5, 0) == 0
+    assert np.isclose(satlas.wigner.wigner_3j(1, 1, 0, 0, 0, 0), -1 / np.sqrt(3), rtol=1e-15)
+    assert np.isclose(satlas.wigner.wigner_3j(0.5, 0.5, 1, 0.5, -0.5, 0), 1 / np.sqrt(6), rtol=1e-15)
+    assert satlas.wigner.wigner_3j(1, 1, 1, 0, 0, 0) == 0
+
+def test_racah_intensities():
+    for I, J_lower, J_upper in [(3.5, 0.5, 1.5), (1, 0.5, 0.5), (4.5, 2, 3), (0, 1, 2)]:
+        intensities = satlas.wigner.racah_intensities(I, J_lower, J_upper)
+        # Sum rule for the line strengths
+        assert np.isclose(sum(intensities.values()), 2 * I + 1)
+
+def test_cache_file(tmpdir):
+    filename = str(tmpdir.join('racah.json'))
+    satlas.wigner.set_cache_file(filename)
+    try:
+        intensities = satlas.wigner.racah_intensities(5.5, 2.5, 1.5)
+        satlas.wigner._intensities.clear()
+        satlas.wigner.set_cache_file(filename)
+        assert satlas.wigner.racah_intensities(5.5, 2.5, 1.5) == intensities
+    finally:
+        satlas.wigner.set_cache_file(None)